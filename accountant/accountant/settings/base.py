@@ -143,3 +143,23 @@ STATICFILES_DIRS = (
 )
 
 TEST_RUNNER='accountant.testrunner.StagingTestRunner'
+
+# Number of seconds the response to an action with an Idempotency-Key is
+# kept, retries with the same key within this window are not performed again
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# A snapshot of the state of a game is stored every this many log entries,
+# the state at any entry is found by replaying at most this many entries
+LOG_SNAPSHOT_INTERVAL = 50
+
+# Once the log of a game has more than LOG_COMPACT_THRESHOLD entries all but
+# the last LOG_COMPACT_KEEP are compacted into a single entry, they can no
+# longer be undone. None turns automatic compaction off.
+LOG_COMPACT_THRESHOLD = None
+LOG_COMPACT_KEEP = 200
+LOG_COMPACT_KEEP_TEXT = True
+
+# Number of hash partitions the log table is split into by game when the
+# migrations run, needs PostgreSQL 12 or newer. None keeps a single table,
+# the partitionlog command changes this on an existing database.
+LOG_PARTITIONS = None
@@ -29,7 +29,8 @@ class PlayerShareFactory(factory.django.DjangoModelFactory):
         model = models.PlayerShare
 
     owner = factory.SubFactory(PlayerFactory)
-    company = factory.SubFactory(CompanyFactory)
+    company = factory.SubFactory(CompanyFactory,
+        game=factory.SelfAttribute('..owner.game'))
 
 
 class CompanyShareFactory(factory.django.DjangoModelFactory):
@@ -37,7 +38,8 @@ class CompanyShareFactory(factory.django.DjangoModelFactory):
         model = models.CompanyShare
 
     owner = factory.SubFactory(CompanyFactory)
-    company = factory.SubFactory(CompanyFactory)
+    company = factory.SubFactory(CompanyFactory,
+        game=factory.SelfAttribute('..owner.game'))
 
 
 class LogEntryFactory(factory.django.DjangoModelFactory):
@@ -46,3 +48,13 @@ class LogEntryFactory(factory.django.DjangoModelFactory):
 
     text = factory.Sequence(lambda n: 'Log entry %d' % n)
     game = factory.SubFactory(GameFactory)
+
+
+class IdempotencyKeyFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = models.IdempotencyKey
+
+    game = factory.SubFactory(GameFactory)
+    key = factory.Sequence(lambda n: 'key-%d' % n)
+    status = 200
+    response = '{}'
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import connection
+import time
+import uuid
+
+from core import models
+
+class Command(BaseCommand):
+    help = 'Compares insert speed and primary key index size of uuid4 ' + \
+        'and time ordered uuids, in temporary tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000)
+        parser.add_argument('--batch', type=int, default=1,
+            help='Number of rows inserted per statement')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<10} {:>12} {:>14}'.format('key', 'rows/s',
+            'index bytes'))
+        for name, key in (('uuid4', uuid.uuid4),
+                          ('time_uuid', models.time_uuid)):
+            rows_per_second, size = self.benchmark(name, key,
+                options['rows'], max(options['batch'], 1))
+            self.stdout.write('{:<10} {:>12.0f} {:>14}'.format(name,
+                rows_per_second, size))
+
+    def benchmark(self, name, key, rows, batch):
+        """
+        Insert rows shaped like log entries with primary keys from key into
+        a temporary table, returns the rows inserted per second and the size
+        of the primary key index.
+        """
+        table = 'benchmark_{}'.format(name)
+        game = uuid.uuid4()
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE {} (uuid uuid PRIMARY '
+                'KEY, game_id uuid NOT NULL, seq integer NOT NULL, '
+                'payload jsonb NOT NULL)'.format(table))
+            sql = 'INSERT INTO {} VALUES {}'.format(table,
+                ', '.join(["(%s, %s, %s, '{}')"] * batch))
+            start = time.perf_counter()
+            for seq in range(0, rows - rows % batch, batch):
+                params = []
+                for i in range(batch):
+                    params += [key(), game, seq + i]
+                cursor.execute(sql, params)
+            elapsed = time.perf_counter() - start
+            cursor.execute("SELECT pg_relation_size('{}_pkey')".format(
+                table))
+            size = cursor.fetchone()[0]
+            cursor.execute('DROP TABLE {}'.format(table))
+        return (rows - rows % batch) / elapsed, size
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from core import utils
+
+class Command(BaseCommand):
+    help = 'Checks the cash of every game, player and company against ' + \
+        'the ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+            help='Set the cash of every mismatch to its balance in the ledger')
+
+    def handle(self, *args, **options):
+        mismatches = 0
+        for model, pk, cash, balance in utils.ledger_mismatches():
+            mismatches += 1
+            self.stdout.write('{} {} has {} cash, the ledger has {}'.format(
+                model._meta.model_name, pk, cash, balance))
+            if options['fix']:
+                model.objects.filter(pk=pk).update(cash=balance)
+        if mismatches and not options['fix']:
+            raise CommandError('{} mismatches found'.format(mismatches))
+        self.stdout.write(str(mismatches))
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from core import utils
+from core.models import IdempotencyKey
+
+class Command(BaseCommand):
+    help = 'Deletes the stored responses of expired idempotency keys'
+
+    def handle(self, *args, **options):
+        deleted, _ = IdempotencyKey.objects.filter(
+            time__lt=utils.idempotency_key_expiry()).delete()
+        self.stdout.write(str(deleted))
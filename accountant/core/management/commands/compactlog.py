@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core import models, utils
+
+class Command(BaseCommand):
+    help = 'Compacts the log of a game up to a checkpoint into a single ' + \
+        'entry that can not be undone'
+
+    def add_arguments(self, parser):
+        parser.add_argument('game')
+        parser.add_argument('--entry',
+            help='The checkpoint, by default the log cursor')
+        parser.add_argument('--keep', type=int, default=0,
+            help='Number of entries before the checkpoint to leave alone')
+        parser.add_argument('--keep-text', action='store_true',
+            help='Store the text of the compacted entries compressed')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            try:
+                game = models.Game.objects.select_for_update().get(
+                    pk=options['game'])
+            except models.Game.DoesNotExist:
+                raise CommandError('This is not a valid UUID')
+            if options['entry']:
+                entries = game.log.filter(pk=options['entry'])
+            else:
+                entries = game.log.filter(pk=game.log_cursor_id)
+            entry = entries.first()
+            if entry == None:
+                raise CommandError('This is not a valid log entry')
+            if options['keep']:
+                entry = game.log.filter(
+                    seq__lte=entry.seq - options['keep']).last()
+                if entry == None:
+                    raise CommandError('There is nothing to compact')
+            try:
+                deleted = utils.compact_log(game, entry,
+                    options['keep_text'])
+            except utils.InvalidCheckpoint:
+                raise CommandError('Entries after the log cursor can not '
+                    'be compacted')
+            except models.LogSnapshot.DoesNotExist:
+                raise CommandError('The state at this log entry is not '
+                    'available')
+        self.stdout.write(str(deleted))
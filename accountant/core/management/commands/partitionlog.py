@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from core import partitioning
+
+class Command(BaseCommand):
+    help = 'Splits the log into hash partitions by game, or creates and ' + \
+        'attaches the partitions that are missing from a partitioned log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--partitions', type=int,
+            help='Number of partitions, 0 turns the log back into a single '
+                 'table. Changing it copies the whole log.')
+
+    def handle(self, *args, **options):
+        if not partitioning.supports_partitioning(connection):
+            raise CommandError('Partitioning the log needs PostgreSQL 12 '
+                'or newer')
+        partitions = options['partitions']
+        if partitions != None and partitions < 0:
+            raise CommandError('The number of partitions can not be '
+                'negative')
+        with transaction.atomic(), connection.cursor() as cursor:
+            modulus = partitioning.log_partitions(cursor)[0]
+            partitioned = partitioning.is_partitioned(cursor)
+            if partitions == None:
+                if not partitioned:
+                    raise CommandError('The log is not partitioned, pass '
+                        '--partitions to partition it')
+                if modulus == None:
+                    raise CommandError('The log has no partitions, pass '
+                        '--partitions to create them')
+                partitions = modulus
+            if partitioned and modulus in (None, partitions):
+                partitioning.attach_partitions(cursor, partitions)
+            elif partitioned or partitions:
+                partitioning.partition_log(cursor, partitions or None)
+
+            for name, remainder in partitioning.log_partitions(cursor)[1]:
+                cursor.execute('SELECT count(*) FROM {}'.format(name))
+                self.stdout.write('{} {}'.format(name, cursor.fetchone()[0]))
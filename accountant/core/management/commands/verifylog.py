@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from django import db
+from django.core.management.base import BaseCommand, CommandError
+import multiprocessing
+import os
+import uuid
+
+from core import models, utils
+
+def verify_shard(shard, shards):
+    """
+    Verify the log of every game with a uuid in the shard-th of shards
+    equal ranges of uuids. Returns a line for every difference.
+    """
+    size = 2 ** 128 // shards
+    games = models.Game.objects.filter(uuid__gte=uuid.UUID(int=shard * size))
+    if shard < shards - 1:
+        games = games.filter(uuid__lt=uuid.UUID(int=(shard + 1) * size))
+    lines = []
+    for game in games.order_by('uuid').iterator():
+        for seq, name, key, column, replayed, stored in \
+                utils.verify_log(game):
+            where = 'in the snapshot of #{}'.format(seq) if seq != None \
+                else 'stored'
+            what = ' '.join(part for part in (name, key, column) if part)
+            lines.append('game {}: {} is {} {}, replaying gives {}'.format(
+                game.pk, what, stored, where, replayed))
+    return lines
+
+
+class Command(BaseCommand):
+    help = 'Replays the log of every game and compares it with the ' + \
+        'stored cash and shares'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+            default=os.cpu_count() or 1,
+            help='Number of processes, games are sharded by uuid')
+
+    def handle(self, *args, **options):
+        processes = max(options['processes'], 1)
+        if processes == 1:
+            results = [verify_shard(0, 1)]
+        else:
+            # Every process has to open its own database connection
+            db.connections.close_all()
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.starmap(verify_shard,
+                    [(shard, processes) for shard in range(processes)])
+        differences = 0
+        for lines in results:
+            for line in lines:
+                differences += 1
+                self.stdout.write(line)
+        if differences:
+            raise CommandError('{} differences found'.format(differences))
+        self.stdout.write(str(differences))
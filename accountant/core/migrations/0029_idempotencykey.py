@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_remove_logentry_revenue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('key', models.CharField(max_length=255)),
+                ('time', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('status', models.IntegerField()),
+                ('response', models.TextField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='idempotencykey',
+            unique_together=set([('game', 'key')]),
+        ),
+    ]
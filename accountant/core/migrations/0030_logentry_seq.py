@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='logentry',
+            name='seq',
+            field=models.IntegerField(null=True, editable=False),
+        ),
+        # Number the existing entries of every game in chronological order
+        migrations.RunSQL(
+            '''
+            UPDATE core_logentry SET seq = numbered.seq
+            FROM (
+                SELECT uuid, row_number() OVER (
+                    PARTITION BY game_id ORDER BY time, uuid) AS seq
+                FROM core_logentry
+            ) AS numbered
+            WHERE core_logentry.uuid = numbered.uuid
+            ''',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='logentry',
+            name='seq',
+            field=models.IntegerField(default=None, editable=False),
+        ),
+        migrations.AlterModelOptions(
+            name='logentry',
+            options={'ordering': ['seq']},
+        ),
+        migrations.AlterUniqueTogether(
+            name='logentry',
+            unique_together=set([('game', 'seq')]),
+        ),
+    ]
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_logentry_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='logentry',
+            name='payload',
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                default=dict),
+        ),
+        # Move the details of every action into the payload, leaving out
+        # the references that are not set
+        migrations.RunSQL(
+            '''
+            UPDATE core_logentry SET payload = COALESCE((
+                SELECT json_object_agg(key, value)
+                FROM json_each(json_build_object(
+                    'acting_player', acting_player_id,
+                    'receiving_player', receiving_player_id,
+                    'receiving_company', receiving_company_id,
+                    'company', company_id,
+                    'player_buyer', player_buyer_id,
+                    'player_source', player_source_id,
+                    'company_buyer', company_buyer_id,
+                    'company_source', company_source_id,
+                    'amount', amount,
+                    'buyer', buyer,
+                    'source', source,
+                    'shares', shares,
+                    'price', price,
+                    'mode', mode
+                ))
+                WHERE value::text <> 'null'
+            ), '{}')::jsonb
+            ''',
+            '''
+            UPDATE core_logentry SET
+                acting_player_id = (payload->>'acting_player')::uuid,
+                receiving_player_id = (payload->>'receiving_player')::uuid,
+                receiving_company_id = (payload->>'receiving_company')::uuid,
+                company_id = (payload->>'company')::uuid,
+                player_buyer_id = (payload->>'player_buyer')::uuid,
+                player_source_id = (payload->>'player_source')::uuid,
+                company_buyer_id = (payload->>'company_buyer')::uuid,
+                company_source_id = (payload->>'company_source')::uuid,
+                amount = COALESCE((payload->>'amount')::integer, 0),
+                buyer = COALESCE((payload->>'buyer')::text, ''),
+                source = COALESCE((payload->>'source')::text, ''),
+                shares = COALESCE((payload->>'shares')::integer, 0),
+                price = COALESCE((payload->>'price')::integer, 0),
+                mode = (payload->>'mode')::integer
+            ''',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='acting_player',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='amount',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='buyer',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='company',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='company_buyer',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='company_source',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='mode',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='player_buyer',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='player_source',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='price',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='receiving_company',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='receiving_player',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='shares',
+        ),
+        migrations.RemoveField(
+            model_name='logentry',
+            name='source',
+        ),
+    ]
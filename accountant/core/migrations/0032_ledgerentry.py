@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_logentry_payload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('movement', models.UUIDField()),
+                ('account', models.UUIDField(null=True)),
+                ('amount', models.IntegerField()),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger', to='core.Game')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='ledgerentry',
+            index_together=set([('account', 'time')]),
+        ),
+        # Open the ledger with the current cash of every account
+        migrations.RunSQL(
+            '''
+            INSERT INTO core_ledgerentry
+                (uuid, game_id, movement, account, amount, time)
+            SELECT md5(a.account::text || legs.sign)::uuid, a.game_id,
+                md5('opening' || a.account::text)::uuid,
+                CASE WHEN legs.sign = 1 THEN a.account END,
+                legs.sign * a.cash, now()
+            FROM (
+                SELECT uuid AS account, uuid AS game_id, cash FROM core_game
+                UNION ALL SELECT uuid, game_id, cash FROM core_player
+                UNION ALL SELECT uuid, game_id, cash FROM core_company
+            ) AS a, (VALUES (1), (-1)) AS legs (sign)
+            WHERE a.cash <> 0
+            ''',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogSnapshot',
+            fields=[
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='core.LogEntry')),
+                ('seq', models.IntegerField()),
+                ('state', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='logsnapshot',
+            unique_together=set([('game', 'seq')]),
+        ),
+        # The current state of every game is its state at its log cursor
+        migrations.RunSQL(
+            '''
+            INSERT INTO core_logsnapshot (entry_id, game_id, seq, state)
+            SELECT g.log_cursor_id, g.uuid, e.seq, json_build_object(
+                'game', json_build_object('cash', g.cash),
+                'players', COALESCE((SELECT json_object_agg(uuid,
+                        json_build_object('cash', cash))
+                    FROM core_player WHERE game_id = g.uuid), '{}'),
+                'companies', COALESCE((SELECT json_object_agg(uuid,
+                        json_build_object('cash', cash,
+                            'ipo_shares', ipo_shares,
+                            'bank_shares', bank_shares))
+                    FROM core_company WHERE game_id = g.uuid), '{}'),
+                'playershares', COALESCE((SELECT json_object_agg(owner_id,
+                        shares)
+                    FROM (SELECT owner_id, json_object_agg(company_id, shares)
+                            AS shares
+                        FROM core_playershare JOIN core_company
+                            ON core_company.uuid = company_id
+                        WHERE game_id = g.uuid GROUP BY owner_id) AS h),
+                    '{}'),
+                'companyshares', COALESCE((SELECT json_object_agg(owner_id,
+                        shares)
+                    FROM (SELECT owner_id, json_object_agg(company_id, shares)
+                            AS shares
+                        FROM core_companyshare JOIN core_company
+                            ON core_company.uuid = company_id
+                        WHERE game_id = g.uuid GROUP BY owner_id) AS h),
+                    '{}')
+            )::jsonb
+            FROM core_game AS g JOIN core_logentry AS e
+                ON e.uuid = g.log_cursor_id
+            ''',
+            migrations.RunSQL.noop,
+        ),
+    ]
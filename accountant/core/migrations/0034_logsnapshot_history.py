@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_logsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='logsnapshot',
+            name='history',
+            field=models.BinaryField(default=None, null=True),
+        ),
+    ]
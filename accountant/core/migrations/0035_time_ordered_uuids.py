@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:49
+from __future__ import unicode_literals
+
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_logsnapshot_history'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='companyshare',
+            name='uuid',
+            field=models.UUIDField(default=core.models.time_uuid, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='uuid',
+            field=models.UUIDField(default=core.models.time_uuid, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='logentry',
+            name='uuid',
+            field=models.UUIDField(default=core.models.time_uuid, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='playershare',
+            name='uuid',
+            field=models.UUIDField(default=core.models.time_uuid, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_time_ordered_uuids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='companyshare',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='share_set', to='core.Company'),
+        ),
+        migrations.AlterField(
+            model_name='logentry',
+            name='game',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='log', to='core.Game'),
+        ),
+        migrations.AlterField(
+            model_name='playershare',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='share_set', to='core.Player'),
+        ),
+        migrations.AlterIndexTogether(
+            name='logentry',
+            index_together=set([('game', 'time')]),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BACKFILL_SQL = '''
+    UPDATE core_{0} SET game_id = core_company.game_id
+    FROM core_company WHERE core_company.uuid = core_{0}.company_id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_log_and_holding_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='companyshare',
+            name='game',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game'),
+        ),
+        migrations.AddField(
+            model_name='playershare',
+            name='game',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game'),
+        ),
+        migrations.RunSQL(BACKFILL_SQL.format('companyshare'),
+            migrations.RunSQL.noop),
+        migrations.RunSQL(BACKFILL_SQL.format('playershare'),
+            migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='companyshare',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game'),
+        ),
+        migrations.AlterField(
+            model_name='playershare',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game'),
+        ),
+    ]
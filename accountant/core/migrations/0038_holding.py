@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:00
+from __future__ import unicode_literals
+
+import core.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+HOLDING_SQL = '''
+    ALTER TABLE core_holding ADD CONSTRAINT core_holding_one_owner
+        CHECK ((player_id IS NULL) <> (owner_company_id IS NULL));
+    CREATE UNIQUE INDEX core_holding_company_id_owner
+        ON core_holding (company_id, COALESCE(player_id, owner_company_id));
+'''
+
+# Move the rows of a share table into core_holding and replace the table
+# by an updatable view with the same columns
+VIEW_SQL = '''
+    INSERT INTO core_holding (uuid, company_id, {owner}, shares, game_id)
+        SELECT uuid, company_id, owner_id, shares, game_id FROM core_{table};
+    DROP TABLE core_{table};
+    CREATE VIEW core_{table} AS
+        SELECT uuid, {owner} AS owner_id, company_id, shares, game_id
+        FROM core_holding WHERE {owner} IS NOT NULL
+        WITH CASCADED CHECK OPTION;
+'''
+
+TABLE_SQL = '''
+    DROP VIEW core_{table};
+    CREATE TABLE core_{table} AS
+        SELECT uuid, {owner} AS owner_id, company_id, shares, game_id
+        FROM core_holding WHERE {owner} IS NOT NULL;
+    ALTER TABLE core_{table} ADD PRIMARY KEY (uuid),
+        ALTER owner_id SET NOT NULL, ALTER company_id SET NOT NULL,
+        ALTER shares SET NOT NULL, ALTER game_id SET NOT NULL,
+        ADD UNIQUE (owner_id, company_id),
+        ADD FOREIGN KEY (owner_id) REFERENCES {owner_table} (uuid)
+            DEFERRABLE INITIALLY DEFERRED,
+        ADD FOREIGN KEY (company_id) REFERENCES core_company (uuid)
+            DEFERRABLE INITIALLY DEFERRED,
+        ADD FOREIGN KEY (game_id) REFERENCES core_game (uuid)
+            DEFERRABLE INITIALLY DEFERRED;
+    CREATE INDEX ON core_{table} (company_id);
+    CREATE INDEX ON core_{table} (game_id);
+'''
+
+SHARE_TABLES = (
+    {'table': 'playershare', 'owner': 'player_id',
+     'owner_table': 'core_player'},
+    {'table': 'companyshare', 'owner': 'owner_company_id',
+     'owner_table': 'core_company'},
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_share_game'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holding',
+            fields=[
+                ('uuid', models.UUIDField(default=core.models.time_uuid, editable=False, primary_key=True, serialize=False)),
+                ('shares', models.IntegerField(default=1)),
+                ('company', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to='core.Company')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Game')),
+                ('owner_company', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Company')),
+                ('player', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Player')),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='companyshare',
+            options={'managed': False},
+        ),
+        migrations.AlterModelOptions(
+            name='playershare',
+            options={'managed': False},
+        ),
+        migrations.RunSQL(HOLDING_SQL, migrations.RunSQL.noop),
+    ] + [
+        migrations.RunSQL(VIEW_SQL.format(**tables),
+            TABLE_SQL.format(**tables))
+        for tables in SHARE_TABLES
+    ]
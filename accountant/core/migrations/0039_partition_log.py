@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import migrations
+
+from core import partitioning
+
+
+def partition_log(apps, schema_editor):
+    connection = schema_editor.connection
+    if not settings.LOG_PARTITIONS:
+        return
+    if not partitioning.supports_partitioning(connection):
+        raise ImproperlyConfigured('LOG_PARTITIONS needs PostgreSQL 12 or '
+            'newer')
+    with connection.cursor() as cursor:
+        partitioning.partition_log(cursor, settings.LOG_PARTITIONS)
+
+def merge_log(apps, schema_editor):
+    connection = schema_editor.connection
+    if partitioning.supports_partitioning(connection):
+        with connection.cursor() as cursor:
+            if partitioning.is_partitioned(cursor):
+                partitioning.partition_log(cursor, None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_holding'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_log, merge_log),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# The game of a holding is the game of its company. Checking it with a
+# foreign key on the table keeps the share views, and their check option,
+# limited to core_holding.
+FOREIGN_KEY_SQL = '''
+    UPDATE core_holding SET game_id = core_company.game_id
+        FROM core_company WHERE core_company.uuid = core_holding.company_id
+        AND core_holding.game_id <> core_company.game_id;
+    ALTER TABLE core_company ADD CONSTRAINT core_company_uuid_game_id_uniq
+        UNIQUE (uuid, game_id);
+    ALTER TABLE core_holding ADD CONSTRAINT core_holding_company_game_fk
+        FOREIGN KEY (company_id, game_id)
+        REFERENCES core_company (uuid, game_id)
+        DEFERRABLE INITIALLY DEFERRED;
+'''
+
+DROP_FOREIGN_KEY_SQL = '''
+    ALTER TABLE core_holding DROP CONSTRAINT core_holding_company_game_fk;
+    ALTER TABLE core_company DROP CONSTRAINT core_company_uuid_game_id_uniq;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_partition_log'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FOREIGN_KEY_SQL, DROP_FOREIGN_KEY_SQL),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0040_holding_company_game'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='log_cursor',
+            field=models.UUIDField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='request_hash',
+            field=models.CharField(default='', max_length=64),
+        ),
+    ]
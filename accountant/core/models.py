@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.db import connection, models, transaction
 from django.utils import timezone
+import json
+import os
+import time
 import uuid
+import zlib
 
 colors = ('red', 'pink', 'purple', 'deep purple', 'indigo', 'blue',
     'light blue', 'cyan', 'teal', 'green', 'light green', 'lime', 'yellow',
@@ -10,7 +15,65 @@ shades = (50,) + tuple(range(100, 1000, 100))
 color_options = ('black', 'white') + \
     tuple(('{} {}'.format(c, s) for c in colors for s in shades))
 
-class Game(models.Model):
+def time_uuid():
+    """
+    Return a UUID that starts with the current time in milliseconds, laid
+    out like a version 7 UUID. Rows with these keys are added at the end of
+    the primary key index instead of at a random place in it, which keeps
+    the index of tables that mostly grow compact.
+    """
+    value = int(time.time() * 1000) << 80 | \
+        int.from_bytes(os.urandom(10), 'big')
+    # Version 7 and the RFC 4122 variant
+    value = value & ~(0xf << 76) | 7 << 76
+    value = value & ~(0x3 << 62) | 0x2 << 62
+    return uuid.UUID(int=value)
+
+class CashAccount(models.Model):
+    """
+    Base of everything that holds cash: the bank of a game, players and
+    companies. Their cash caches their balance in the ledger. It is only
+    changed by the atomic updates in utils, which record every movement,
+    so saving an existing row never writes its cash and a stale instance
+    can't undo those changes. Saving an instance whose cash was changed to
+    something else than what is stored raises a ValueError. The cash of a
+    new row is recorded as coming from outside the game.
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(CashAccount, cls).from_db(db, field_names, values)
+        instance._loaded_cash = instance.__dict__.get('cash')
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            super(CashAccount, self).save(*args, **kwargs)
+            if self.cash != 0:
+                LedgerEntry.record_balance(self)
+            self._loaded_cash = self.cash
+            return
+        update_fields = kwargs.get('update_fields')
+        if update_fields == None:
+            update_fields = [field.name for field in self._meta.concrete_fields
+                if not field.primary_key]
+        # The utils change the cash of instances along with the row, so only
+        # a value that is neither loaded nor stored was set by the caller
+        cash = self.__dict__.get('cash')
+        if 'cash' in update_fields and \
+                cash != getattr(self, '_loaded_cash', cash) and \
+                type(self).objects.filter(pk=self.pk).exclude(
+                    cash=cash).exists():
+            raise ValueError('The cash of {} can only be changed by '
+                'transferring money'.format(self))
+        kwargs['update_fields'] = [name for name in update_fields
+            if name != 'cash']
+        super(CashAccount, self).save(*args, **kwargs)
+
+
+class Game(CashAccount):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4,
         editable=False)
     cash = models.IntegerField(default=12000)
@@ -23,8 +86,24 @@ class Game(models.Model):
     def __str__(self):
         return 'Game {}'.format(self.uuid)
 
-
-class Player(models.Model):
+    def delete(self, *args, **kwargs):
+        """
+        Delete the game. Its log and snapshots are removed first by game in
+        one statement each, which only reads the partition of the game when
+        the log is partitioned, instead of by the primary key of every entry.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('UPDATE core_game SET log_cursor_id = NULL '
+                'WHERE uuid = %s', [self.pk])
+            self.log_cursor = None
+            cursor.execute('DELETE FROM core_logsnapshot WHERE game_id = %s',
+                [self.pk])
+            cursor.execute('DELETE FROM core_logentry WHERE game_id = %s',
+                [self.pk])
+            return super(Game, self).delete(*args, **kwargs)
+
+
+class Player(CashAccount):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4,
         editable=False)
     name = models.CharField(max_length=16, default='Player')
@@ -39,7 +118,7 @@ class Player(models.Model):
         return self.name
 
 
-class Company(models.Model):
+class Company(CashAccount):
     COLOR_CODES = tuple(((opt.replace(' ', '-'), opt.title())
         for opt in color_options))
 
@@ -79,34 +158,114 @@ class Company(models.Model):
         super(Company, self).save(*args, **kwargs)
 
 
+class Holding(models.Model):
+    """
+    The shares of a company held by a player or a company, exactly one of
+    which is set. The migration adds a unique index on the company and the
+    owner, which also serves every lookup of the holders of a company, and a
+    foreign key on the company and the game so the game is always that of
+    the company. PlayerShare and CompanyShare are views over this table.
+    """
+    uuid = models.UUIDField(primary_key=True, default=time_uuid,
+        editable=False)
+    company = models.ForeignKey(Company, related_name='holdings',
+        db_index=False, on_delete=models.CASCADE)
+    player = models.ForeignKey(Player, related_name='+', null=True,
+        on_delete=models.CASCADE)
+    owner_company = models.ForeignKey(Company, related_name='+', null=True,
+        on_delete=models.CASCADE)
+    shares = models.IntegerField(default=1)
+    game = models.ForeignKey(Game, related_name='+',
+        on_delete=models.CASCADE)
+
+    @property
+    def owner(self):
+        if self.player_id != None:
+            return self.player
+        return self.owner_company
+
+    def save(self, *args, **kwargs):
+        # The game always follows the company, also when it is changed
+        self.game_id = self.company.game_id
+        super(Holding, self).save(*args, **kwargs)
+
+
 class PlayerShare(models.Model):
-    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4,
+    uuid = models.UUIDField(primary_key=True, default=time_uuid,
         editable=False)
     owner = models.ForeignKey(Player, related_name='share_set')
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     shares = models.IntegerField(default=1)
+    game = models.ForeignKey(Game, related_name='+',
+        on_delete=models.CASCADE)
 
     class Meta:
+        # A view over the holdings of players
+        managed = False
         unique_together = (('owner', 'company'),)
 
-    @property
-    def game(self):
-        return self.company.game
+    def save(self, *args, **kwargs):
+        # The game always follows the company, also when it is changed
+        self.game_id = self.company.game_id
+        super(PlayerShare, self).save(*args, **kwargs)
 
 
 class CompanyShare(models.Model):
-    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4,
+    uuid = models.UUIDField(primary_key=True, default=time_uuid,
         editable=False)
     owner = models.ForeignKey(Company, related_name='share_set')
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     shares = models.IntegerField(default=1)
+    game = models.ForeignKey(Game, related_name='+',
+        on_delete=models.CASCADE)
 
     class Meta:
+        # A view over the holdings of companies
+        managed = False
         unique_together = (('owner', 'company'),)
 
-    @property
-    def game(self):
-        return self.company.game
+    def save(self, *args, **kwargs):
+        # The game always follows the company, also when it is changed
+        self.game_id = self.company.game_id
+        super(CompanyShare, self).save(*args, **kwargs)
+
+
+def payload_value(name, default):
+    """Property that stores a value in the payload of a log entry"""
+    def get(self):
+        return self.payload.get(name, default)
+
+    def set(self, value):
+        if value == None:
+            self.payload.pop(name, None)
+        else:
+            self.payload[name] = value
+    return property(get, set)
+
+
+def payload_reference(name, model):
+    """Property that stores a reference to an instance of model in the
+    payload of a log entry, the instance is only retrieved when needed.
+    """
+    cache_name = '_{}_cache'.format(name)
+
+    def get(self):
+        pk = self.payload.get(name)
+        if pk == None:
+            return None
+        instance = getattr(self, cache_name, None)
+        if instance == None or str(instance.pk) != pk:
+            instance = model.objects.filter(pk=pk).first()
+            setattr(self, cache_name, instance)
+        return instance
+
+    def set(self, instance):
+        setattr(self, cache_name, instance)
+        if instance == None:
+            self.payload.pop(name, None)
+        else:
+            self.payload[name] = str(instance.pk)
+    return property(get, set)
 
 
 class LogEntry(models.Model):
@@ -128,52 +287,156 @@ class LogEntry(models.Model):
         (WITHHOLD, 'Withhold dividends'),
     )
 
-    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4,
+    uuid = models.UUIDField(primary_key=True, default=time_uuid,
         editable=False)
+    # Looked up through the indexes on (game, seq) and (game, time)
     game = models.ForeignKey(Game, related_name='log',
-        on_delete=models.CASCADE)
+        on_delete=models.CASCADE, db_index=False)
+    seq = models.IntegerField(default=None, editable=False)
     time = models.DateTimeField(default=timezone.now)
     text = models.TextField(default='')
     action = models.IntegerField(default=None, choices=ACTION_CHOICES,
         null=True, blank=True)
 
-    # Transfer money related
-    acting_player = models.ForeignKey(Player, related_name='+', null=True,
-        default=None)
+    # Companies are linked from the API so they keep a real reference, all
+    # other details of the action are stored in the payload
     acting_company = models.ForeignKey(Company, related_name='+', null=True,
         default=None)
-    receiving_player = models.ForeignKey(Player, related_name='+', null=True,
-        default=None)
-    receiving_company = models.ForeignKey(Company, related_name='+', null=True,
-        default=None)
-    amount = models.IntegerField(default=0)
+    payload = JSONField(default=dict)
+
+    # Transfer money related
+    acting_player = payload_reference('acting_player', Player)
+    receiving_player = payload_reference('receiving_player', Player)
+    receiving_company = payload_reference('receiving_company', Company)
+    amount = payload_value('amount', 0)
 
     # Transfer share related
-    buyer = models.CharField(max_length=8, default='')
-    source = models.CharField(max_length=8, default='')
-    shares = models.IntegerField(default=0)
-    price = models.IntegerField(default=0)
-    company = models.ForeignKey(Company, related_name='+', null=True,
-        default=None)
-    player_buyer = models.ForeignKey(Player, related_name='+', null=True,
-        default=None)
-    player_source = models.ForeignKey(Player, related_name='+', null=True,
-        default=None)
-    company_buyer = models.ForeignKey(Company, related_name='+', null=True,
-        default=None)
-    company_source = models.ForeignKey(Company, related_name='+', null=True,
-        default=None)
+    buyer = payload_value('buyer', '')
+    source = payload_value('source', '')
+    shares = payload_value('shares', 0)
+    price = payload_value('price', 0)
+    company = payload_reference('company', Company)
+    player_buyer = payload_reference('player_buyer', Player)
+    player_source = payload_reference('player_source', Player)
+    company_buyer = payload_reference('company_buyer', Company)
+    company_source = payload_reference('company_source', Company)
 
     # Operate related
-    mode = models.IntegerField(default=None, choices=OPERATE_CHOICES,
-        null=True, blank=True)
+    mode = payload_value('mode', None)
+
+    # Changes to cash and shares made by the action, see utils.apply_deltas
+    deltas = payload_value('deltas', None)
 
     class Meta:
-        ordering = ['time']
+        ordering = ['seq']
+        unique_together = (('game', 'seq'),)
+        index_together = (('game', 'time'),)
 
     def __str__(self):
         return '[{}] {}'.format(self.time, self.text)
 
+    def save(self, *args, **kwargs):
+        # Entries are numbered in the order they are added to their game
+        if self.seq == None:
+            last = LogEntry.objects.filter(game_id=self.game_id).aggregate(
+                last=models.Max('seq'))['last']
+            self.seq = (last or 0) + 1
+        super(LogEntry, self).save(*args, **kwargs)
+
     @property
     def is_undoable(self):
         return self.action != None
+
+
+class LogSnapshot(models.Model):
+    """
+    State of a game at a log entry: the cash of the bank, players and
+    companies, the pool shares of the companies and all holdings. It has
+    the same form as the deltas of a log entry.
+    """
+    entry = models.OneToOneField(LogEntry, primary_key=True,
+        related_name='snapshot', on_delete=models.CASCADE)
+    game = models.ForeignKey(Game, related_name='+',
+        on_delete=models.CASCADE)
+    seq = models.IntegerField()
+    state = JSONField()
+    # The text of the entries that were compacted into this one, see
+    # utils.compact_log
+    history = models.BinaryField(null=True, default=None)
+
+    class Meta:
+        unique_together = (('game', 'seq'),)
+
+    def __str__(self):
+        return '{} #{}'.format(self.game_id, self.seq)
+
+    def history_entries(self):
+        """The (seq, time, text) of every compacted entry, oldest first"""
+        if self.history == None:
+            return []
+        return [tuple(entry) for entry in
+            json.loads(zlib.decompress(bytes(self.history)).decode())]
+
+
+class IdempotencyKey(models.Model):
+    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4,
+        editable=False)
+    game = models.ForeignKey(Game, related_name='+',
+        on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # SHA-256 of the path and the body of the request the key was used for
+    request_hash = models.CharField(max_length=64, default='')
+    time = models.DateTimeField(default=timezone.now, db_index=True)
+    status = models.IntegerField()
+    response = models.TextField()
+    log_cursor = models.UUIDField(null=True, default=None)
+
+    class Meta:
+        unique_together = (('game', 'key'),)
+
+    def __str__(self):
+        return '[{}] {}'.format(self.time, self.key)
+
+
+class LedgerEntry(models.Model):
+    """
+    One side of a movement of cash. The entries of a movement take cash
+    from some accounts and add it to others, so their amounts add up to 0.
+    The account is the uuid of the game (the bank), a player or a company,
+    cash that comes from outside the game has None as account.
+    """
+    uuid = models.UUIDField(primary_key=True, default=time_uuid,
+        editable=False)
+    game = models.ForeignKey(Game, related_name='ledger',
+        on_delete=models.CASCADE)
+    movement = models.UUIDField()
+    account = models.UUIDField(null=True)
+    amount = models.IntegerField()
+    time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        index_together = (('account', 'time'),)
+
+    def __str__(self):
+        return '[{}] {} {}'.format(self.time, self.account, self.amount)
+
+    @classmethod
+    def record_balance(cls, account):
+        """
+        Record the difference between the cash of account and its balance
+        in the ledger as cash coming from outside the game, so that the
+        ledger agrees with what is stored.
+        """
+        game_id = account.pk if isinstance(account, Game) else \
+            account.game_id
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} (uuid, game_id, movement, account, '
+                'amount, time) SELECT legs.uuid, %s, %s, legs.account, '
+                'legs.sign * change.amount, %s FROM (SELECT %s - COALESCE('
+                'SUM(amount), 0) AS amount FROM {table} WHERE account = %s) '
+                'AS change, (VALUES (%s, %s, 1), (%s, NULL, -1)) AS legs '
+                '(uuid, account, sign) WHERE change.amount <> 0'.format(
+                    table=connection.ops.quote_name(cls._meta.db_table)),
+                [game_id, time_uuid(), timezone.now(), account.cash,
+                 account.pk, time_uuid(), account.pk, time_uuid()])
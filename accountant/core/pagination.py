@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from rest_framework.pagination import CursorPagination
+
+class LogEntryPagination(CursorPagination):
+    """
+    Keyset pagination over the log in both directions, ordered by seq. The
+    cursor holds the seq to continue from so every page is found with the
+    index on (game, seq), however far into the log it is. Pagination is
+    only used when the client asks for it with a cursor or page_size, so
+    the log is still available as a plain list.
+    """
+    ordering = 'seq'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and \
+                self.page_size_query_param not in request.query_params:
+            return None
+        return super(LogEntryPagination, self).paginate_queryset(queryset,
+            request, view)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
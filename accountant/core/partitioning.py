@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import re
+
+LOG_TABLE = 'core_logentry'
+PARTITION_BOUND = re.compile(r'modulus (\d+), remainder (\d+)')
+
+def supports_partitioning(connection):
+    return connection.vendor == 'postgresql' and \
+        connection.pg_version >= 120000
+
+def partition_name(modulus, remainder):
+    return '{}_p{}_{}'.format(LOG_TABLE, modulus, remainder)
+
+def log_partitions(cursor):
+    """
+    Return the modulus the log is partitioned with and the attached
+    partitions as (name, remainder) pairs. The modulus is None when the log
+    is a plain table or when no partitions are attached.
+    """
+    cursor.execute('SELECT relname, pg_get_expr(relpartbound, oid) '
+        'FROM pg_inherits JOIN pg_class ON pg_class.oid = inhrelid '
+        'WHERE inhparent = %s::regclass ORDER BY relname', [LOG_TABLE])
+    modulus, partitions = None, []
+    for name, bound in cursor.fetchall():
+        modulus, remainder = map(int, PARTITION_BOUND.search(bound).groups())
+        partitions.append((name, remainder))
+    return modulus, sorted(partitions, key=lambda p: p[1])
+
+def is_partitioned(cursor):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table '
+        'WHERE partrelid = %s::regclass', [LOG_TABLE])
+    return cursor.fetchone() != None
+
+def attach_partitions(cursor, modulus):
+    """
+    Make sure there is a partition for every remainder of modulus. Tables
+    that were detached earlier are attached again, missing ones are
+    created. Returns the names of the partitions that were added.
+    """
+    attached = {remainder for name, remainder in log_partitions(cursor)[1]}
+    added = []
+    for remainder in range(modulus):
+        if remainder in attached:
+            continue
+        name = partition_name(modulus, remainder)
+        bound = 'FOR VALUES WITH (MODULUS {}, REMAINDER {})'.format(modulus,
+            remainder)
+        cursor.execute('SELECT to_regclass(%s)', [name])
+        if cursor.fetchone()[0] == None:
+            cursor.execute('CREATE TABLE {} PARTITION OF {} {}'.format(name,
+                LOG_TABLE, bound))
+        else:
+            cursor.execute('ALTER TABLE {} ATTACH PARTITION {} {}'.format(
+                LOG_TABLE, name, bound))
+        added.append(name)
+    return added
+
+def partition_log(cursor, modulus):
+    """
+    Rebuild the log table with modulus hash partitions by game, or as a
+    single table when modulus is None. Queries for the log of one game are
+    then pruned to a single partition. Every unique constraint of a
+    partitioned table must contain the game, so the primary key becomes
+    (uuid, game_id) and foreign keys to the log include the game as well.
+    The other constraints and indexes are recreated with the same names.
+    The rows are copied in the current transaction, which keeps the log
+    locked until it commits.
+    """
+    # Deferred checks can't be pending while the tables are swapped
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) "
+        "FROM pg_constraint WHERE conrelid = %s::regclass "
+        "AND contype IN ('c', 'f', 'u') ORDER BY conname", [LOG_TABLE])
+    constraints = cursor.fetchall()
+    cursor.execute('SELECT pg_get_indexdef(indexrelid) FROM pg_index '
+        'WHERE indrelid = %s::regclass AND NOT EXISTS (SELECT 1 FROM '
+        'pg_constraint WHERE conindid = indexrelid)', [LOG_TABLE])
+    indexes = [row[0].replace(' ON ONLY ', ' ON ')
+        for row in cursor.fetchall()]
+    cursor.execute('SELECT conrelid::regclass::text, conname, attname '
+        'FROM pg_constraint JOIN pg_attribute ON attrelid = conrelid '
+        'AND attnum = conkey[1] WHERE confrelid = %s::regclass '
+        'AND conparentid = 0 ORDER BY conname', [LOG_TABLE])
+    references = cursor.fetchall()
+
+    for table, name, column in references:
+        cursor.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table,
+            name))
+    cursor.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(LOG_TABLE))
+    sql = 'CREATE TABLE {0} (LIKE {0}_old INCLUDING DEFAULTS)'.format(
+        LOG_TABLE)
+    if modulus:
+        cursor.execute(sql + ' PARTITION BY HASH (game_id)')
+        attach_partitions(cursor, modulus)
+    else:
+        cursor.execute(sql)
+    cursor.execute('INSERT INTO {0} SELECT * FROM {0}_old'.format(LOG_TABLE))
+    cursor.execute('DROP TABLE {}_old'.format(LOG_TABLE))
+
+    key = '(uuid, game_id)' if modulus else '(uuid)'
+    cursor.execute('ALTER TABLE {} ADD PRIMARY KEY {}'.format(LOG_TABLE, key))
+    for name, definition in constraints:
+        cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+            LOG_TABLE, name, definition))
+    for definition in indexes:
+        cursor.execute(definition)
+    for table, name, column in references:
+        # The game of the referencing row is the uuid of a game itself
+        game = 'uuid' if table == 'core_game' else 'game_id'
+        columns = '{}, {}'.format(column, game) if modulus else column
+        cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) '
+            'REFERENCES {} {} DEFERRABLE INITIALLY DEFERRED'.format(table,
+                name, columns, LOG_TABLE, key))
+    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.http import Http404
 from django.utils.translation import ugettext as _
 from rest_framework import serializers
 
@@ -16,6 +17,15 @@ DUPLICATE_COMPANY_ERROR = \
     _('There is already a company with this name in your game')
 DUPLICATE_PLAYER_ERROR = \
     _('There is already a player with this name in your game')
+CASH_CHANGED_ERROR = _('Cash can only be changed by transferring money')
+
+def _pop_unchanged_cash(instance, validated_data):
+    """
+    Remove the cash from validated_data, cash only changes through
+    transfers which record it in the ledger so a different value is refused.
+    """
+    if validated_data.pop('cash', instance.cash) != instance.cash:
+        raise serializers.ValidationError({'cash': [CASH_CHANGED_ERROR]})
 
 class GameSerializer(serializers.ModelSerializer):
     class Meta:
@@ -25,10 +35,15 @@ class GameSerializer(serializers.ModelSerializer):
         read_only_fields = ('players', 'companies')
 
     def create(self, validated_data):
-        game = models.Game.objects.create(**validated_data)
-        utils.create_log_entry(game, None, text='New game started')
+        with transaction.atomic():
+            game = models.Game.objects.create(**validated_data)
+            utils.create_log_entry(game, None, text='New game started')
         return game
 
+    def update(self, instance, validated_data):
+        _pop_unchanged_cash(instance, validated_data)
+        return super(GameSerializer, self).update(instance, validated_data)
+
 
 class PlayerSerializer(serializers.ModelSerializer):
     class Meta:
@@ -44,15 +59,24 @@ class PlayerSerializer(serializers.ModelSerializer):
         )
 
     def create(self, validated_data):
-        player = models.Player.objects.create(**validated_data)
-        game = player.game
-        game.cash -= validated_data['cash']
-        # Create log entry
-        utils.create_log_entry(game, None,
-            text='Added player {name} with {cash} starting cash'.format(
-                name=validated_data['name'], cash=validated_data['cash']))
+        with transaction.atomic():
+            # Wait for actions on the game, they move the log cursor too
+            game = utils.IdentityMap().lock_game(validated_data['game'].pk)
+            # The starting cash comes from the bank
+            player = models.Player.objects.create(
+                **dict(validated_data, game=game, cash=0))
+            utils.transfer_money(None, player, validated_data['cash'])
+            # Create log entry
+            utils.create_log_entry(game, None,
+                text='Added player {name} with {cash} starting cash'.format(
+                    name=validated_data['name'],
+                    cash=validated_data['cash']))
         return player
 
+    def update(self, instance, validated_data):
+        _pop_unchanged_cash(instance, validated_data)
+        return super(PlayerSerializer, self).update(instance, validated_data)
+
 
 class CompanySerializer(serializers.ModelSerializer):
     class Meta:
@@ -70,32 +94,40 @@ class CompanySerializer(serializers.ModelSerializer):
         )
 
     def create(self, validated_data):
-        company = models.Company.objects.create(**validated_data)
-        game = company.game
-        game.cash -= validated_data['cash']
-        utils.create_log_entry(game, None,
-            text='Added {}-share company {} with {} starting cash'.format(
-                validated_data['share_count'], validated_data['name'],
-                validated_data['cash']),
-            acting_company=company)
+        with transaction.atomic():
+            # Wait for actions on the game, they move the log cursor too
+            game = utils.IdentityMap().lock_game(validated_data['game'].pk)
+            company = models.Company.objects.create(
+                **dict(validated_data, game=game, cash=0))
+            utils.transfer_money(None, company, validated_data['cash'])
+            utils.create_log_entry(game, None,
+                text='Added {}-share company {} with {} starting cash'.format(
+                    validated_data['share_count'], validated_data['name'],
+                    validated_data['cash']),
+                acting_company=company)
         return company
 
     def update(self, instance, validated_data):
-        if instance.share_count != validated_data['share_count']:
-            share_delta = validated_data['share_count'] - instance.share_count
-            # Removing more shares then there are in the IPO
-            if share_delta < -instance.ipo_shares:
-                validated_data['ipo_shares'] = 0
-                validated_data['bank_shares'] += share_delta + \
-                    instance.ipo_shares
-            else:
-                validated_data['ipo_shares'] += share_delta
-        company = super(CompanySerializer, self).update(instance,
-            validated_data)
-        game = company.game
-        utils.create_log_entry(game, None,
-            text='Company {} has been edited'.format(company.name),
-            acting_company=company)
+        with transaction.atomic():
+            # Wait for actions on the game, they move the log cursor too
+            game = utils.IdentityMap().lock_game(instance.game_id)
+            instance.game = game
+            _pop_unchanged_cash(instance, validated_data)
+            if instance.share_count != validated_data['share_count']:
+                share_delta = validated_data['share_count'] - \
+                    instance.share_count
+                # Removing more shares then there are in the IPO
+                if share_delta < -instance.ipo_shares:
+                    validated_data['ipo_shares'] = 0
+                    validated_data['bank_shares'] += share_delta + \
+                        instance.ipo_shares
+                else:
+                    validated_data['ipo_shares'] += share_delta
+            company = super(CompanySerializer, self).update(instance,
+                validated_data)
+            utils.create_log_entry(game, None,
+                text='Company {} has been edited'.format(company.name),
+                acting_company=company)
         return company
 
 
@@ -104,21 +136,43 @@ class PlayerShareSerializer(serializers.ModelSerializer):
         model = models.PlayerShare
         fields = ('url', 'uuid', 'owner', 'company', 'shares')
 
+    def validate(self, data):
+        owner = data.get('owner', getattr(self.instance, 'owner', None))
+        company = data.get('company', getattr(self.instance, 'company', None))
+        if owner.game_id != company.game_id:
+            raise serializers.ValidationError(DIFFERENT_GAME_ERROR)
+        return data
+
 
 class CompanyShareSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.CompanyShare
         fields = ('url', 'uuid', 'owner', 'company', 'shares')
 
+    def validate(self, data):
+        owner = data.get('owner', getattr(self.instance, 'owner', None))
+        company = data.get('company', getattr(self.instance, 'company', None))
+        if owner.game_id != company.game_id:
+            raise serializers.ValidationError(DIFFERENT_GAME_ERROR)
+        return data
+
 
 class LogEntrySerializer(serializers.ModelSerializer):
     class Meta:
         model = models.LogEntry
-        fields = ('url', 'uuid', 'game', 'time', 'text', 'acting_company',
-            'is_undoable')
+        fields = ('url', 'uuid', 'game', 'seq', 'time', 'text',
+            'acting_company', 'is_undoable')
+
 
+class ActionSerializer(serializers.Serializer):
+    """
+    Base for the serializers of actions, the client can send the log cursor
+    of the game it has seen to make sure it acts on the current state.
+    """
+    log_cursor = serializers.UUIDField(required=False, allow_null=True)
 
-class TransferMoneySerializer(serializers.Serializer):
+
+class TransferMoneySerializer(ActionSerializer):
     amount = serializers.IntegerField()
     to_player = serializers.ModelField(required=False,
         model_field=models.Player._meta.get_field('uuid'))
@@ -139,30 +193,49 @@ class TransferMoneySerializer(serializers.Serializer):
             raise serializers.ValidationError(DUPLICATE_SOURCE_OR_DEST_ERROR)
         if 'to_player' in data.keys() and 'to_company' in data.keys():
             raise serializers.ValidationError(DUPLICATE_SOURCE_OR_DEST_ERROR)
+        self._resolve_instances(data)
+        if self.source_instance != None and self.dest_instance != None and \
+                self.source_instance.game_id != self.dest_instance.game_id:
+            raise serializers.ValidationError(DIFFERENT_GAME_ERROR)
         return data
 
     @property
     def source_instance(self):
-        if 'from_player' in self.validated_data.keys():
-            return get_object_or_404(models.Player,
-                uuid=self.validated_data['from_player'])
-        if 'from_company' in self.validated_data.keys():
-            return get_object_or_404(models.Company,
-                uuid=self.validated_data['from_company'])
-        return None
+        return self._source_instance
 
     @property
     def dest_instance(self):
-        if 'to_player' in self.validated_data.keys():
-            return get_object_or_404(models.Player,
-                uuid=self.validated_data['to_player'])
-        if 'to_company' in self.validated_data.keys():
-            return get_object_or_404(models.Company,
-                uuid=self.validated_data['to_company'])
-        return None
+        return self._dest_instance
+
+    def _resolve_instances(self, data):
+        """
+        Look up the source and destination of the transfer, using one query
+        for the players and one for the companies.
+        """
+        instances = {}
+        for model, fields in ((models.Player, ('from_player', 'to_player')),
+                (models.Company, ('from_company', 'to_company'))):
+            pks = [data[field] for field in fields if field in data.keys()]
+            if not pks:
+                continue
+            found = model.objects.in_bulk(pks)
+            for field in fields:
+                if field not in data.keys():
+                    continue
+                if data[field] not in found:
+                    raise Http404()
+                instances[field] = found[data[field]]
+        # Share instances with the rest of the request when possible
+        if 'identity_map' in self.context:
+            for field, instance in instances.items():
+                instances[field] = self.context['identity_map'].add(instance)
+        self._source_instance = instances.get('from_player',
+            instances.get('from_company'))
+        self._dest_instance = instances.get('to_player',
+            instances.get('to_company'))
 
 
-class TransferShareSerializer(serializers.Serializer):
+class TransferShareSerializer(ActionSerializer):
     amount = serializers.IntegerField(required=False, default=1)
     price = serializers.IntegerField()
     share = serializers.ModelField(
@@ -198,14 +271,21 @@ class TransferShareSerializer(serializers.Serializer):
         return data
 
 
-class OperateSerializer(serializers.Serializer):
+class OperateSerializer(ActionSerializer):
     company = serializers.ModelField(
         model_field=models.Company._meta.get_field('uuid'))
     amount = serializers.IntegerField()
     method = serializers.ChoiceField(choices=['full', 'half', 'withhold'])
 
 
-class UndoRedoSerializer(serializers.Serializer):
+class UndoRedoSerializer(ActionSerializer):
     game = serializers.ModelField(
         model_field=models.Game._meta.get_field('uuid'))
     action = serializers.ChoiceField(choices=['undo', 'redo'])
+
+
+class JumpSerializer(ActionSerializer):
+    game = serializers.ModelField(
+        model_field=models.Game._meta.get_field('uuid'))
+    entry = serializers.ModelField(
+        model_field=models.LogEntry._meta.get_field('uuid'))
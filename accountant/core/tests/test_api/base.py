@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from ... import models
+
+class GameAPITestCase(APITestCase):
+    """
+    Base for tests that play a game through the API, so its log is written
+    the way clients write it.
+    """
+    def start_game(self):
+        """
+        Create a game with 1000 cash, Alice with 100 cash and the 10-share
+        B&O with 200 cash. self.before is the entry of adding the B&O.
+        """
+        response = self.client.post(reverse('game-list'), {'cash': 1000})
+        self.game = models.Game.objects.get(pk=response.data['uuid'])
+        response = self.client.post(reverse('player-list'),
+            {'game': self.game.pk, 'name': 'Alice', 'cash': 100})
+        self.alice = models.Player.objects.get(pk=response.data['uuid'])
+        response = self.client.post(reverse('company-list'),
+            {'game': self.game.pk, 'name': 'B&O', 'cash': 200,
+             'share_count': 10})
+        self.company = models.Company.objects.get(pk=response.data['uuid'])
+        self.game.refresh_from_db()
+        self.before = self.game.log_cursor
+
+    def act(self, name, data):
+        """Post data to the action view name, return the new log cursor"""
+        self.client.post(reverse(name), data)
+        self.game.refresh_from_db()
+        return self.game.log_cursor
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from unittest import mock
+import datetime
+import json
+import uuid
+
+from ... import factories
+from ... import models
+from ... import utils
+from ... import views
+
+lock_game = utils.IdentityMap.lock_game
+
+class ActionRollbackTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.player = factories.PlayerFactory(game=self.game, cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=100,
+            ipo_shares=10)
+
+    def assertUnchanged(self):
+        self.game.refresh_from_db()
+        self.player.refresh_from_db()
+        self.company.refresh_from_db()
+        self.assertEqual(self.game.cash, 1000)
+        self.assertEqual(self.player.cash, 100)
+        self.assertEqual(self.company.cash, 100)
+        self.assertEqual(self.company.ipo_shares, 10)
+        self.assertEqual(models.LogEntry.objects.count(), 0)
+        self.assertEqual(models.PlayerShare.objects.count(), 0)
+
+    @mock.patch.object(utils, 'create_log_entry', side_effect=RuntimeError)
+    def test_failing_to_log_money_transfer_rolls_back_transfer(self, mock):
+        data = {'from_player': self.player.pk, 'to_company': self.company.pk,
+            'amount': 10}
+        with self.assertRaises(RuntimeError):
+            self.client.post(reverse('transfer_money'), data)
+        self.assertUnchanged()
+
+    @mock.patch.object(utils, 'create_log_entry', side_effect=RuntimeError)
+    def test_failing_to_log_share_transfer_rolls_back_transfer(self, mock):
+        data = {'buyer_type': 'player', 'player_buyer': self.player.pk,
+            'source_type': 'ipo', 'share': self.company.pk, 'price': 10,
+            'amount': 2}
+        with self.assertRaises(RuntimeError):
+            self.client.post(reverse('transfer_share'), data)
+        self.assertUnchanged()
+
+    @mock.patch.object(utils, 'create_log_entry', side_effect=RuntimeError)
+    def test_failing_to_log_operation_rolls_back_payout(self, mock):
+        data = {'company': self.company.pk, 'amount': 50,
+            'method': 'withhold'}
+        with self.assertRaises(RuntimeError):
+            self.client.post(reverse('operate'), data)
+        self.assertUnchanged()
+
+class ActionValidationTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.player = factories.PlayerFactory(cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=100,
+            ipo_shares=10)
+
+    @mock.patch.object(utils, 'buy_share')
+    def test_share_transfer_between_games_is_rejected_before_buying(self,
+            mock_buy_share):
+        data = {'buyer_type': 'player', 'player_buyer': self.player.pk,
+            'source_type': 'ipo', 'share': self.company.pk, 'price': 10,
+            'amount': 1}
+        response = self.client.post(reverse('transfer_share'), data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['non_field_errors'],
+            [views.DIFFERENT_GAME_ERROR])
+        self.assertFalse(mock_buy_share.called)
+
+    @mock.patch.object(utils, 'transfer_money')
+    def test_money_transfer_between_games_is_rejected_before_transfer(self,
+            mock_transfer_money):
+        data = {'from_player': self.player.pk, 'to_company': self.company.pk,
+            'amount': 10}
+        response = self.client.post(reverse('transfer_money'), data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(mock_transfer_money.called)
+        self.assertEqual(models.LogEntry.objects.count(), 0)
+
+class ActionLockTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.player = factories.PlayerFactory(game=self.game, cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=100,
+            ipo_shares=10)
+
+    def assertLocked(self, mock_lock_game):
+        self.assertEqual(mock_lock_game.call_count, 1)
+        self.assertEqual(str(mock_lock_game.call_args[0][1]),
+            str(self.game.pk))
+
+    @mock.patch.object(utils.IdentityMap, 'lock_game', autospec=True,
+        side_effect=lock_game)
+    def test_transfering_money_locks_game(self, mock_lock_game):
+        data = {'from_player': self.player.pk, 'amount': 10}
+        self.client.post(reverse('transfer_money'), data)
+        self.assertLocked(mock_lock_game)
+
+    @mock.patch.object(utils.IdentityMap, 'lock_game', autospec=True,
+        side_effect=lock_game)
+    def test_transfering_shares_locks_game(self, mock_lock_game):
+        data = {'buyer_type': 'player', 'player_buyer': self.player.pk,
+            'source_type': 'ipo', 'share': self.company.pk, 'price': 10,
+            'amount': 1}
+        self.client.post(reverse('transfer_share'), data)
+        self.assertLocked(mock_lock_game)
+
+    @mock.patch.object(utils.IdentityMap, 'lock_game', autospec=True,
+        side_effect=lock_game)
+    def test_operating_locks_game(self, mock_lock_game):
+        data = {'company': self.company.pk, 'amount': 10,
+            'method': 'withhold'}
+        self.client.post(reverse('operate'), data)
+        self.assertLocked(mock_lock_game)
+
+    @mock.patch.object(utils.IdentityMap, 'lock_game', autospec=True,
+        side_effect=lock_game)
+    def test_undo_locks_game(self, mock_lock_game):
+        self.client.post(reverse('transfer_money'),
+            {'from_player': self.player.pk, 'amount': 10})
+        mock_lock_game.reset_mock()
+        self.client.post(reverse('undo'),
+            {'action': 'undo', 'game': self.game.pk})
+        self.assertLocked(mock_lock_game)
+
+    @mock.patch.object(utils.IdentityMap, 'lock_game', autospec=True,
+        side_effect=lock_game)
+    def test_rejected_action_does_not_lock_game(self, mock_lock_game):
+        data = {'from_player': factories.PlayerFactory().pk,
+            'to_company': self.company.pk, 'amount': 10}
+        self.client.post(reverse('transfer_money'), data)
+        self.assertFalse(mock_lock_game.called)
+
+class ActionLogCursorTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.player = factories.PlayerFactory(game=self.game, cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=100)
+        self.entry = factories.LogEntryFactory(game=self.game)
+        self.game.log_cursor = self.entry
+        self.game.save()
+        self.url = reverse('transfer_money')
+        self.data = {'from_player': self.player.pk, 'amount': 10}
+
+    def assertStale(self, response):
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['detail'],
+            views.STALE_LOG_CURSOR_ERROR)
+        self.assertEqual(response.data['log_cursor'], self.entry.pk)
+        self.assertEqual(response['ETag'], '"{}"'.format(self.entry.pk))
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 100)
+        self.assertEqual(self.game.log.count(), 1)
+
+    def test_action_without_expected_cursor_is_performed(self):
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_action_with_current_cursor_is_performed(self):
+        self.data['log_cursor'] = self.entry.pk
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_action_with_stale_cursor_is_refused(self):
+        self.data['log_cursor'] = uuid.uuid4()
+        response = self.client.post(self.url, self.data)
+        self.assertStale(response)
+
+    def test_action_with_stale_cursor_does_not_lock_game(self):
+        self.data['log_cursor'] = uuid.uuid4()
+        with mock.patch.object(utils.IdentityMap, 'lock_game') \
+                as mock_lock_game:
+            self.client.post(self.url, self.data)
+        self.assertFalse(mock_lock_game.called)
+
+    def test_cursor_that_moves_before_lock_is_taken_is_refused(self):
+        def move_cursor(identity_map, pk):
+            models.Game.objects.filter(pk=pk).update(
+                log_cursor=factories.LogEntryFactory(game=self.game))
+            return lock_game(identity_map, pk)
+        self.data['log_cursor'] = self.entry.pk
+        with mock.patch.object(utils.IdentityMap, 'lock_game', autospec=True,
+                side_effect=move_cursor):
+            response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 100)
+
+    def test_action_with_current_if_match_is_performed(self):
+        response = self.client.post(self.url, self.data,
+            HTTP_IF_MATCH='"{}"'.format(self.entry.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_action_with_stale_if_match_is_refused(self):
+        response = self.client.post(self.url, self.data,
+            HTTP_IF_MATCH='"{}"'.format(uuid.uuid4()))
+        self.assertStale(response)
+
+    def test_if_match_accepts_any_of_several_cursors(self):
+        response = self.client.post(self.url, self.data,
+            HTTP_IF_MATCH='"{}", W/"{}"'.format(uuid.uuid4(), self.entry.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_if_match_wildcard_accepts_any_cursor(self):
+        response = self.client.post(self.url, self.data, HTTP_IF_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_invalid_if_match_is_bad_request(self):
+        response = self.client.post(self.url, self.data,
+            HTTP_IF_MATCH='"not a cursor"')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['log_cursor'],
+            [views.INVALID_IF_MATCH_ERROR])
+
+    def test_log_cursor_field_takes_precedence_over_if_match(self):
+        self.data['log_cursor'] = self.entry.pk
+        response = self.client.post(self.url, self.data,
+            HTTP_IF_MATCH='"{}"'.format(uuid.uuid4()))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_response_has_new_cursor_as_etag(self):
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response['ETag'],
+            '"{}"'.format(response.data['log']['uuid']))
+
+    def test_stale_undo_is_refused(self):
+        response = self.client.post(reverse('undo'), {'action': 'undo',
+            'game': self.game.pk, 'log_cursor': uuid.uuid4()})
+        self.assertStale(response)
+
+    def test_stale_operate_is_refused(self):
+        response = self.client.post(reverse('operate'),
+            {'company': self.company.pk, 'amount': 10, 'method': 'full',
+             'log_cursor': uuid.uuid4()})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_stale_share_transfer_is_refused(self):
+        response = self.client.post(reverse('transfer_share'),
+            {'buyer_type': 'player', 'player_buyer': self.player.pk,
+             'source_type': 'ipo', 'share': self.company.pk, 'price': 10,
+             'log_cursor': uuid.uuid4()})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+class ActionIdempotencyKeyTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.player = factories.PlayerFactory(game=self.game, cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=100,
+            ipo_shares=10)
+        self.url = reverse('transfer_money')
+        self.data = {'from_player': self.player.pk, 'amount': 10}
+
+    def post(self, url, data, key='retry-key'):
+        return self.client.post(url, data, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_money_transfer_is_performed_once(self):
+        self.post(self.url, self.data)
+        self.post(self.url, self.data)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 90)
+        self.assertEqual(self.game.log.count(), 1)
+
+    def test_retry_returns_stored_response(self):
+        first = self.post(self.url, self.data)
+        second = self.post(self.url, self.data)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, json.loads(first.content.decode()))
+
+    def test_retry_does_not_call_utils(self):
+        self.post(self.url, self.data)
+        with mock.patch.object(utils, 'transfer_money') as mock_transfer, \
+                mock.patch.object(utils.IdentityMap, 'lock_game') \
+                as mock_lock_game:
+            self.post(self.url, self.data)
+        self.assertFalse(mock_transfer.called)
+        self.assertFalse(mock_lock_game.called)
+
+    def test_retried_share_transfer_is_performed_once(self):
+        url = reverse('transfer_share')
+        data = {'buyer_type': 'player', 'player_buyer': self.player.pk,
+            'source_type': 'ipo', 'share': self.company.pk, 'price': 10,
+            'amount': 2}
+        self.post(url, data)
+        self.post(url, data)
+        self.player.refresh_from_db()
+        self.company.refresh_from_db()
+        self.assertEqual(self.player.cash, 80)
+        self.assertEqual(self.company.ipo_shares, 8)
+        self.assertEqual(self.game.log.count(), 1)
+
+    def test_retry_is_not_refused_for_stale_cursor(self):
+        self.game.log_cursor = factories.LogEntryFactory(game=self.game)
+        self.game.save()
+        self.data['log_cursor'] = self.game.log_cursor.pk
+        self.post(self.url, self.data)
+        response = self.post(self.url, self.data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_different_keys_are_performed_separately(self):
+        self.post(self.url, self.data, key='first')
+        self.post(self.url, self.data, key='second')
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 80)
+
+    def test_requests_without_key_are_always_performed(self):
+        self.client.post(self.url, self.data)
+        self.client.post(self.url, self.data)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 80)
+        self.assertEqual(models.IdempotencyKey.objects.count(), 0)
+
+    def test_keys_are_stored_per_game(self):
+        player = factories.PlayerFactory(cash=100)
+        self.post(self.url, self.data)
+        self.post(self.url, {'from_player': player.pk, 'amount': 10})
+        player.refresh_from_db()
+        self.assertEqual(player.cash, 90)
+
+    def test_expired_key_is_performed_again(self):
+        self.post(self.url, self.data)
+        models.IdempotencyKey.objects.update(
+            time=utils.idempotency_key_expiry() - datetime.timedelta(1))
+        self.post(self.url, self.data)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 80)
+        self.assertEqual(models.IdempotencyKey.objects.count(), 1)
+
+    def test_storing_key_deletes_expired_keys_of_game(self):
+        old = factories.IdempotencyKeyFactory(game=self.game,
+            time=utils.idempotency_key_expiry() - datetime.timedelta(1))
+        other = factories.IdempotencyKeyFactory(
+            time=utils.idempotency_key_expiry() - datetime.timedelta(1))
+        self.post(self.url, self.data)
+        self.assertFalse(models.IdempotencyKey.objects.filter(
+            pk=old.pk).exists())
+        self.assertTrue(models.IdempotencyKey.objects.filter(
+            pk=other.pk).exists())
+
+    def test_retry_returns_stored_etag(self):
+        first = self.post(self.url, self.data)
+        self.post(reverse('transfer_money'), self.data, key='other')
+        second = self.post(self.url, self.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_key_with_different_body_is_refused(self):
+        self.post(self.url, self.data)
+        response = self.post(self.url, {'from_player': self.player.pk,
+            'amount': 20})
+        self.assertEqual(response.status_code,
+            status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(response.data['detail'],
+            views.REUSED_IDEMPOTENCY_KEY_ERROR)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 90)
+
+    def test_key_for_different_action_is_refused(self):
+        self.post(self.url, self.data)
+        response = self.post(reverse('operate'), {'company': self.company.pk,
+            'amount': 10, 'method': 'withhold'})
+        self.assertEqual(response.status_code,
+            status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.cash, 100)
+
+    def test_key_stored_without_request_hash_matches_any_request(self):
+        self.post(self.url, self.data)
+        models.IdempotencyKey.objects.update(request_hash='')
+        response = self.post(self.url, {'from_player': self.player.pk,
+            'amount': 20})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 90)
+
+    def test_failed_action_does_not_store_key(self):
+        self.post(self.url, {'from_player': self.player.pk})
+        self.assertEqual(models.IdempotencyKey.objects.count(), 0)
+
+    def test_too_long_key_is_bad_request(self):
+        response = self.post(self.url, self.data, key='k' * 256)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['non_field_errors'],
+            [views.INVALID_IDEMPOTENCY_KEY_ERROR])
+
+class ActionQueryCountTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        utils.create_log_entry(self.game, None, text='Start')
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=100,
+            ipo_shares=8)
+        factories.PlayerShareFactory(owner=self.bob, company=self.company,
+            shares=2)
+
+    def add_holders(self, count):
+        for player in factories.PlayerFactory.create_batch(size=count,
+                game=self.game):
+            factories.PlayerShareFactory(owner=player, company=self.company)
+
+    def test_transfer_money_between_player_and_company(self):
+        data = {'from_player': self.alice.pk, 'to_company': self.company.pk,
+            'amount': 10}
+        with self.assertNumQueries(16):
+            self.client.post(reverse('transfer_money'), data)
+
+    def test_transfer_money_between_players(self):
+        data = {'from_player': self.alice.pk, 'to_player': self.bob.pk,
+            'amount': 10}
+        with self.assertNumQueries(12):
+            self.client.post(reverse('transfer_money'), data)
+
+    def test_transfer_money_to_bank(self):
+        data = {'from_player': self.alice.pk, 'amount': 10}
+        with self.assertNumQueries(14):
+            self.client.post(reverse('transfer_money'), data)
+
+    def test_transfer_share_from_ipo(self):
+        data = {'buyer_type': 'player', 'player_buyer': self.alice.pk,
+            'source_type': 'ipo', 'share': self.company.pk, 'price': 10}
+        with self.assertNumQueries(21):
+            self.client.post(reverse('transfer_share'), data)
+
+    def test_transfer_share_between_players(self):
+        factories.PlayerShareFactory(owner=self.alice, company=self.company)
+        data = {'buyer_type': 'player', 'player_buyer': self.alice.pk,
+            'source_type': 'player', 'player_source': self.bob.pk,
+            'share': self.company.pk, 'price': 10}
+        with self.assertNumQueries(19):
+            self.client.post(reverse('transfer_share'), data)
+
+    def test_operate_does_not_depend_on_number_of_holders(self):
+        data = {'company': self.company.pk, 'amount': 10, 'method': 'full'}
+        with self.assertNumQueries(15):
+            self.client.post(reverse('operate'), data)
+        self.add_holders(6)
+        with self.assertNumQueries(15):
+            self.client.post(reverse('operate'), data)
+
+    def test_undo_operate_does_not_depend_on_number_of_holders(self):
+        self.add_holders(6)
+        self.client.post(reverse('operate'),
+            {'company': self.company.pk, 'amount': 10, 'method': 'full'})
+        with self.assertNumQueries(13):
+            self.client.post(reverse('undo'),
+                {'action': 'undo', 'game': self.game.pk})
+        with self.assertNumQueries(12):
+            self.client.post(reverse('undo'),
+                {'action': 'redo', 'game': self.game.pk})
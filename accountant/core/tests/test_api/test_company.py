@@ -35,8 +35,7 @@ class CompanyTests(APITestCase):
         self.assertEqual(models.Company.objects.count(), 1)
 
     def test_creating_company_decreases_cash_in_bank(self):
-        self.game.cash = 1000
-        self.game.save()
+        self.game = factories.GameFactory(cash=1000)
         url = reverse('company-list')
         data = {'name': 'PRR', 'game': self.game.pk, 'cash': 300,
             'share_count': 10}
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+import uuid
+
+from ... import models
+from ... import factories
+from .base import GameAPITestCase
+
+class ForkTests(GameAPITestCase):
+    def setUp(self):
+        self.start_game()
+        self.act('transfer_money', {'from_player': self.alice.pk,
+            'amount': 30})
+        self.url = reverse('game-fork', kwargs={'pk': self.game.pk})
+
+    def test_fork_creates_game(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        fork = models.Game.objects.get(pk=response.data['uuid'])
+        self.assertNotEqual(fork, self.game)
+        self.assertEqual(response.data['cash'], 730)
+        self.assertEqual(len(response.data['players']), 1)
+        self.assertEqual(fork.players.get().cash, 70)
+        self.assertEqual(fork.log.count(), 4)
+
+    def test_fork_at_entry(self):
+        response = self.client.post(self.url, {'entry': self.before.pk})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        fork = models.Game.objects.get(pk=response.data['uuid'])
+        self.assertEqual(fork.cash, 700)
+        self.assertEqual(fork.players.get().cash, 100)
+        self.assertEqual(fork.log_cursor.seq, self.before.seq)
+
+    def test_fork_does_not_change_game(self):
+        self.client.post(self.url, {'entry': self.before.pk})
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.cash, 730)
+        self.assertEqual(self.game.log.count(), 4)
+
+    def test_entry_of_other_game_is_not_found(self):
+        entry = factories.LogEntryFactory()
+        response = self.client.post(self.url, {'entry': entry.pk})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(models.Game.objects.count(), 2)
+
+    def test_unknown_entry_is_not_found(self):
+        response = self.client.post(self.url, {'entry': uuid.uuid4()})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_game_is_not_found(self):
+        response = self.client.post(
+            reverse('game-fork', kwargs={'pk': uuid.uuid4()}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+import uuid
+
+from ... import models
+from ... import factories
+from ... import views
+from .base import GameAPITestCase
+
+class JumpTests(GameAPITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.alice = factories.PlayerFactory(game=self.game, cash=0)
+        self.bob = factories.PlayerFactory(game=self.game, cash=0)
+        self.company = factories.CompanyFactory(game=self.game, cash=0)
+        self.start_entry = models.LogEntry.objects.create(game=self.game,
+            text='New game started')
+        self.game.log_cursor = self.start_entry
+        self.game.save()
+        self.url = reverse('jump')
+
+        self.entry = self.act('transfer_money', {'to_player': self.alice.pk,
+            'amount': 10})
+        self.act('transfer_money', {'to_player': self.bob.pk, 'amount': 20})
+        self.last_entry = self.act('transfer_money',
+            {'from_player': self.alice.pk, 'to_company': self.company.pk,
+             'amount': 5})
+
+    def test_GET_request_is_empty(self):
+        """GET is for debug (and doc) purposes only"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.data)
+
+    def test_requires_entry(self):
+        response = self.client.post(self.url, {'game': str(self.game.pk)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('entry', response.data.keys())
+
+    def test_can_jump_back_over_several_entries(self):
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.entry.pk)})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.entry)
+        self.assertEqual(response.data['game']['cash'], 990)
+        self.assertCountEqual([(p['uuid'], p['cash'])
+            for p in response.data['players']],
+            [(str(self.alice.pk), 10), (str(self.bob.pk), 0)])
+        self.assertEqual([(c['uuid'], c['cash'])
+            for c in response.data['companies']],
+            [(str(self.company.pk), 0)])
+
+    def test_can_jump_forward_over_several_entries(self):
+        self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.start_entry.pk)})
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.last_entry.pk)})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.last_entry)
+        self.assertEqual(response.data['game']['cash'], 970)
+        self.assertCountEqual([(p['uuid'], p['cash'])
+            for p in response.data['players']],
+            [(str(self.alice.pk), 5), (str(self.bob.pk), 20)])
+        self.assertEqual([(c['uuid'], c['cash'])
+            for c in response.data['companies']],
+            [(str(self.company.pk), 5)])
+
+    def test_jumping_keeps_log_entries(self):
+        self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.start_entry.pk)})
+        self.assertEqual(self.game.log.count(), 4)
+
+    def test_entry_of_other_game_is_not_found(self):
+        entry = models.LogEntry.objects.create(game=factories.GameFactory())
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(entry.pk)})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.last_entry)
+
+    def test_unknown_entry_is_not_found(self):
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(uuid.uuid4())})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stale_jump_is_refused(self):
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.entry.pk), 'log_cursor': str(self.entry.pk)})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.last_entry)
+
+    def test_can_not_jump_back_past_adding_a_player(self):
+        self.client.post(reverse('player-list'), {'game': self.game.pk,
+            'name': 'Carol', 'cash': 100})
+        self.act('transfer_money', {'to_player': self.alice.pk, 'amount': 1})
+        cursor = self.game.log_cursor
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.start_entry.pk)})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(views.NOT_UNDOABLE_ERROR,
+            response.data['non_field_errors'])
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, cursor)
+        self.assertTrue(self.game.log.filter(
+            text__startswith='Added player Carol').exists())
+
+    def test_can_jump_back_to_adding_a_player(self):
+        self.client.post(reverse('player-list'), {'game': self.game.pk,
+            'name': 'Carol', 'cash': 100})
+        added = self.game.log.last()
+        self.act('transfer_money', {'to_player': self.alice.pk, 'amount': 1})
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(added.pk)})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, added)
+
+    def test_query_count_does_not_depend_on_number_of_entries(self):
+        with self.assertNumQueries(17):
+            self.client.post(self.url, {'game': str(self.game.pk),
+                'entry': str(self.entry.pk)})
+        self.client.post(self.url, {'game': str(self.game.pk),
+            'entry': str(self.last_entry.pk)})
+        for i in range(10):
+            self.act('transfer_money', {'from_player': self.bob.pk,
+                'to_player': self.alice.pk, 'amount': 1})
+        with self.assertNumQueries(17):
+            self.client.post(self.url, {'game': str(self.game.pk),
+                'entry': str(self.entry.pk)})
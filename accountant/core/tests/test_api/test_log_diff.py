@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+import uuid
+
+from ... import factories
+from .base import GameAPITestCase
+
+class LogDiffTests(GameAPITestCase):
+    def setUp(self):
+        self.start_game()
+        self.act('transfer_share', {'buyer_type': 'player',
+            'player_buyer': self.alice.pk, 'source_type': 'ipo',
+            'share': self.company.pk, 'price': 10, 'amount': 2})
+        self.after = self.act('transfer_money',
+            {'from_company': self.company.pk, 'to_player': self.alice.pk,
+             'amount': 50})
+
+    def diff(self, start, end):
+        return self.client.get(
+            reverse('logentry-diff', kwargs={'pk': start.pk}),
+            {'to': str(end.pk)})
+
+    def test_returns_only_changes(self):
+        response = self.diff(self.before, self.after)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['entry'], self.before.pk)
+        self.assertEqual(response.data['to'], self.after.pk)
+        self.assertEqual(response.data['game'],
+            {'uuid': self.game.pk, 'cash': 20})
+        self.assertEqual(response.data['players'],
+            [{'uuid': str(self.alice.pk), 'cash': 30}])
+        self.assertEqual(response.data['companies'],
+            [{'uuid': str(self.company.pk), 'cash': -50, 'ipo_shares': -2}])
+        self.assertEqual(response.data['playershares'],
+            [{'owner': str(self.alice.pk), 'company': str(self.company.pk),
+              'shares': 2}])
+        self.assertEqual(response.data['companyshares'], [])
+
+    def test_diff_backwards_is_negated(self):
+        response = self.diff(self.after, self.before)
+        self.assertEqual(response.data['game']['cash'], -20)
+        self.assertEqual(response.data['players'],
+            [{'uuid': str(self.alice.pk), 'cash': -30}])
+
+    def test_unchanged_game_is_none(self):
+        start = self.game.log.get(seq=self.after.seq - 1)
+        response = self.diff(start, self.after)
+        self.assertIsNone(response.data['game'])
+
+    def test_does_not_change_game(self):
+        self.diff(self.after, self.before)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.after)
+        self.assertEqual(self.game.cash, 720)
+
+    def test_requires_to(self):
+        response = self.client.get(
+            reverse('logentry-diff', kwargs={'pk': self.before.pk}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('to', response.data.keys())
+
+    def test_entry_of_other_game_is_not_found(self):
+        entry = factories.LogEntryFactory()
+        response = self.diff(self.before, entry)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_entry_is_not_found(self):
+        response = self.client.get(
+            reverse('logentry-diff', kwargs={'pk': self.before.pk}),
+            {'to': str(uuid.uuid4())})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(
+            reverse('logentry-diff', kwargs={'pk': self.before.pk}),
+            {'to': 'foo'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+
+from ... import factories
+from .base import GameAPITestCase
+
+class LogStateTests(GameAPITestCase):
+    def setUp(self):
+        self.start_game()
+        self.act('transfer_share', {'buyer_type': 'player',
+            'player_buyer': self.alice.pk, 'source_type': 'ipo',
+            'share': self.company.pk, 'price': 10, 'amount': 2})
+        self.after = self.act('transfer_money',
+            {'from_company': self.company.pk, 'amount': 50})
+
+    def url(self, entry):
+        return reverse('logentry-state', kwargs={'pk': entry.pk})
+
+    def test_returns_state_before_actions(self):
+        response = self.client.get(self.url(self.before))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['seq'], self.before.seq)
+        self.assertEqual(response.data['game'],
+            {'uuid': self.game.pk, 'cash': 700})
+        self.assertEqual(response.data['players'],
+            [{'uuid': str(self.alice.pk), 'cash': 100}])
+        self.assertEqual(response.data['companies'],
+            [{'uuid': str(self.company.pk), 'cash': 200, 'ipo_shares': 10,
+              'bank_shares': 0}])
+        self.assertEqual(response.data['playershares'], [])
+        self.assertEqual(response.data['companyshares'], [])
+
+    def test_returns_state_after_actions(self):
+        response = self.client.get(self.url(self.after))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['game']['cash'], 770)
+        self.assertEqual(response.data['players'],
+            [{'uuid': str(self.alice.pk), 'cash': 80}])
+        self.assertEqual(response.data['companies'],
+            [{'uuid': str(self.company.pk), 'cash': 150, 'ipo_shares': 8,
+              'bank_shares': 0}])
+        self.assertEqual(response.data['playershares'],
+            [{'owner': str(self.alice.pk), 'company': str(self.company.pk),
+              'shares': 2}])
+
+    def test_returns_state_of_undone_entries(self):
+        self.client.post(reverse('undo'),
+            {'game': self.game.pk, 'action': 'undo'})
+        response = self.client.get(self.url(self.after))
+        self.assertEqual(response.data['game']['cash'], 770)
+
+    def test_state_is_not_available_without_snapshot(self):
+        entry = factories.LogEntryFactory()
+        response = self.client.get(self.url(entry))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cannot_write_to_view(self):
+        response = self.client.post(self.url(self.after), {})
+        self.assertEqual(response.status_code,
+            status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -185,3 +185,30 @@ class OperateTests(APITestCase):
         self.assertEqual(entry.acting_company, self.company)
         self.assertEqual(entry.amount, 170)
         self.assertEqual(entry.mode, models.LogEntry.WITHHOLD)
+
+
+class OperateLockTests(APITestCase):
+    def setUp(self):
+        self.url = reverse('operate')
+        self.game = factories.GameFactory(cash=1000, pool_shares_pay=True)
+        self.company = factories.CompanyFactory(game=self.game)
+
+    def test_pays_pool_as_it_is_once_game_is_locked(self):
+        lock_game = utils.IdentityMap.lock_game
+
+        def sell_to_pool_then_lock(identity_map, pk):
+            # Another action sells shares to the pool after the company was
+            # loaded and commits before this action gets the lock
+            models.Company.objects.filter(pk=self.company.pk).update(
+                bank_shares=2)
+            return lock_game(identity_map, pk)
+
+        data = {'company': self.company.pk, 'amount': 100, 'method': 'full'}
+        with mock.patch.object(utils.IdentityMap, 'lock_game',
+                sell_to_pool_then_lock):
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.bank_shares, 2)
+        self.assertEqual(self.company.cash, 20)
+        self.assertEqual(response.data['companies'][0]['cash'], 20)
@@ -82,6 +82,29 @@ class PlayerTests(APITestCase):
             'Added player Alice with 100 starting cash')
         self.assertEqual(self.game.log_cursor, self.game.log.last())
 
+    def test_updating_player_cash_is_refused(self):
+        player = factories.PlayerFactory.create(game=self.game, cash=100)
+        url = reverse('player-detail', kwargs={'pk': player.pk})
+        data = {'name': 'Alice', 'game': self.game.pk, 'cash': 50}
+
+        response = self.client.put(url, data)
+
+        player.refresh_from_db()
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('cash', response.data)
+        self.assertEqual(player.cash, 100)
+
+    def test_updating_player_with_unchanged_cash(self):
+        player = factories.PlayerFactory.create(game=self.game, cash=100)
+        url = reverse('player-detail', kwargs={'pk': player.pk})
+        data = {'name': 'Alice', 'game': self.game.pk, 'cash': 100}
+
+        response = self.client.put(url, data)
+
+        player.refresh_from_db()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(player.name, 'Alice')
+
 
 class PlayerShareTests(APITestCase):
     def setUp(self):
@@ -2,6 +2,7 @@
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
+import json
 
 from ... import models
 from ... import factories
@@ -115,6 +116,19 @@ class LogEntryAPITests(APITestCase):
         self.assertCountEqual([str(e.uuid) for e in entries[:3]],
             [e['uuid'] for e in response.data])
 
+    def test_retrieve_log_entries_of_game_in_one_query(self):
+        game = factories.GameFactory()
+        game.log_cursor = factories.LogEntryFactory.create_batch(game=game,
+            size=5)[3]
+        game.save()
+        url = reverse('logentry-list') + '?game=' + str(game.pk)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+
+        self.assertEqual([e.seq for e in game.log.all()[:4]],
+            [e['seq'] for e in response.data])
+
     def test_returns_empty_list_when_game_has_no_log_entries(self):
         game = factories.GameFactory()
         url = reverse('logentry-list') + '?game=' + str(game.pk)
@@ -139,3 +153,103 @@ class LogEntryAPITests(APITestCase):
         response = self.client.post(url, {})
         self.assertEqual(response.status_code,
             status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class LogEntryPaginationTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory()
+        self.entries = factories.LogEntryFactory.create_batch(game=self.game,
+            size=7)
+        self.game.log_cursor = self.entries[5]
+        self.game.save()
+        self.url = reverse('logentry-list') + '?game=' + str(self.game.pk)
+
+    def seqs(self, response):
+        return [e['seq'] for e in response.data['results']]
+
+    def test_is_paginated_when_page_size_is_given(self):
+        response = self.client.get(self.url + '&page_size=4')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.seqs(response),
+            [e.seq for e in self.entries[:4]])
+        self.assertIsNone(response.data['previous'])
+
+    def test_next_page_continues_after_last_entry(self):
+        response = self.client.get(self.url + '&page_size=4')
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.seqs(response),
+            [e.seq for e in self.entries[4:6]])
+        self.assertIsNone(response.data['next'])
+
+    def test_previous_page_goes_back(self):
+        response = self.client.get(self.url + '&page_size=2')
+        response = self.client.get(response.data['next'])
+        response = self.client.get(response.data['next'])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(self.seqs(response),
+            [e.seq for e in self.entries[2:4]])
+
+    def test_page_size_is_limited(self):
+        factories.LogEntryFactory.create_batch(game=self.game, size=1000)
+        self.game.log_cursor = self.game.log.last()
+        self.game.save()
+        response = self.client.get(self.url + '&page_size=5000')
+        self.assertEqual(len(response.data['results']), 1000)
+
+    def test_page_is_read_in_one_query(self):
+        response = self.client.get(self.url + '&page_size=2')
+        with self.assertNumQueries(1):
+            self.client.get(response.data['next'])
+
+    def test_page_keeps_its_place_when_entries_are_added(self):
+        response = self.client.get(self.url + '&page_size=3')
+        self.game.log_cursor = self.entries[6]
+        self.game.save()
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.seqs(response),
+            [e.seq for e in self.entries[3:6]])
+
+
+class LogEntryStreamTests(APITestCase):
+    def setUp(self):
+        self.game = factories.GameFactory()
+        self.entries = factories.LogEntryFactory.create_batch(game=self.game,
+            size=5)
+        self.game.log_cursor = self.entries[3]
+        self.game.save()
+        self.url = reverse('logentry-list') + '?stream=1&game=' + \
+            str(self.game.pk)
+
+    def test_streams_entries_up_to_log_cursor(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual([e['uuid'] for e in data],
+            [str(e.pk) for e in self.entries[:4]])
+
+    def test_streamed_entries_match_list(self):
+        response = self.client.get(self.url)
+        data = json.loads(b''.join(response.streaming_content).decode())
+        response = self.client.get(reverse('logentry-list') + '?game=' +
+            str(self.game.pk))
+        self.assertEqual(data, json.loads(response.content.decode()))
+
+    def test_streams_empty_list(self):
+        game = factories.GameFactory()
+        response = self.client.get(reverse('logentry-list') +
+            '?stream=1&game=' + str(game.pk))
+        self.assertEqual(b''.join(response.streaming_content), b'[]')
+
+    def test_streams_when_stream_is_true(self):
+        response = self.client.get(self.url.replace('stream=1', 'stream=True'))
+        self.assertTrue(response.streaming)
+
+    def test_does_not_stream_when_stream_is_false(self):
+        for value in ('0', 'false', ''):
+            response = self.client.get(self.url.replace('stream=1',
+                'stream=' + value))
+            self.assertFalse(response.streaming)
+            self.assertEqual([e['uuid'] for e in response.data],
+                [str(e.pk) for e in self.entries[:4]])
@@ -5,6 +5,8 @@ from rest_framework.test import APITestCase
 
 from ... import models
 from ... import factories
+from ... import utils
+from ... import views
 
 class UndoTests(APITestCase):
     def setUp(self):
@@ -23,6 +25,35 @@ class UndoTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsNone(response.data)
 
+    def test_undo_at_compacted_checkpoint_is_refused(self):
+        # Stores a snapshot of the state to compact from
+        utils.create_log_entry(self.game, None, text='Added player')
+        for amount in (10, 20):
+            self.client.post(reverse('transfer_money'),
+                {'to_player': self.player.pk, 'amount': amount})
+        self.game.refresh_from_db()
+        checkpoint = self.game.log_cursor
+        utils.compact_log(self.game, checkpoint)
+
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'action': 'undo'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(views.NOT_UNDOABLE_ERROR,
+            response.data['non_field_errors'])
+        self.game.refresh_from_db()
+        self.player.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, checkpoint)
+        self.assertEqual(self.player.cash, 130)
+
+    def test_undo_at_start_of_game_is_refused(self):
+        response = self.client.post(self.url, {'game': str(self.game.pk),
+            'action': 'undo'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.start_entry)
+
     def test_undoing_bank_to_player_money_transfer_includes_instances(self):
         entry = models.LogEntry.objects.create(game=self.game,
             receiving_player=self.player, amount=25,
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command, CommandError
-from django.test import TestCase
+from django.db import connection, IntegrityError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils.six import StringIO
+from importlib import import_module
+from unittest import mock
+import datetime
 
+from ..management.commands import verifylog
 from .. import factories
 from .. import models
+from .. import partitioning
+from .. import utils
 
 FAKE_UUID = '00000000-0000-0000-0000-000000000000'
 
@@ -299,3 +309,300 @@ class CreatecompanyshareTests(TestCase):
             call_command('createcompanyshare', str(owner.pk), str(company.pk))
         self.assertIn('Owner and company are not in the same game',
             cm.exception.args)
+
+
+class ClearidempotencykeysTests(TestCase):
+    def setUp(self):
+        expired = utils.idempotency_key_expiry() - datetime.timedelta(1)
+        self.old = factories.IdempotencyKeyFactory.create_batch(size=2,
+            time=expired)
+        self.new = factories.IdempotencyKeyFactory()
+
+    def test_deletes_expired_keys(self):
+        call_command('clearidempotencykeys', stdout=StringIO())
+        self.assertEqual(list(models.IdempotencyKey.objects.all()),
+            [self.new])
+
+    def test_outputs_number_of_deleted_keys(self):
+        out = StringIO()
+        call_command('clearidempotencykeys', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '2')
+
+
+class CheckledgerTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.player = factories.PlayerFactory(game=self.game, cash=10)
+        utils.transfer_money(self.player, None, 5)
+
+    def test_outputs_0_when_everything_matches(self):
+        out = StringIO()
+        call_command('checkledger', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '0')
+
+    def test_fails_on_mismatch(self):
+        models.Player.objects.filter(pk=self.player.pk).update(cash=7)
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('checkledger', stdout=out)
+        self.assertIn(str(self.player.pk), out.getvalue())
+
+    def test_fix_sets_cash_to_balance(self):
+        models.Player.objects.filter(pk=self.player.pk).update(cash=7)
+        models.Game.objects.filter(pk=self.game.pk).update(cash=0)
+        out = StringIO()
+        call_command('checkledger', '--fix', stdout=out)
+        self.assertEqual(out.getvalue().strip().splitlines()[-1], '2')
+        self.player.refresh_from_db()
+        self.game.refresh_from_db()
+        self.assertEqual(self.player.cash, 5)
+        self.assertEqual(self.game.cash, 105)
+
+
+class VerifylogTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.player = factories.PlayerFactory(game=self.game, cash=10)
+        utils.create_log_entry(self.game, None, text='New game')
+        utils.transfer_money(self.player, None, 5)
+        utils.create_log_entry(self.game, models.LogEntry.TRANSFER_MONEY,
+            acting=self.player, amount=5)
+
+    def test_outputs_0_when_log_matches(self):
+        out = StringIO()
+        call_command('verifylog', processes=1, stdout=out)
+        self.assertEqual(out.getvalue().strip(), '0')
+
+    def test_fails_on_difference(self):
+        models.Player.objects.filter(pk=self.player.pk).update(cash=7)
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('verifylog', processes=1, stdout=out)
+        self.assertIn(str(self.player.pk), out.getvalue())
+
+    def test_does_not_write(self):
+        models.Player.objects.filter(pk=self.player.pk).update(cash=7)
+        with self.assertRaises(CommandError):
+            call_command('verifylog', processes=1, stdout=StringIO())
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 7)
+
+    def test_shards_cover_every_game_once(self):
+        games = [self.game] + factories.GameFactory.create_batch(size=20)
+        for game in games:
+            models.Game.objects.filter(pk=game.pk).update(cash=1)
+            utils.create_log_entry(game, None, text='Snapshot')
+            models.Game.objects.filter(pk=game.pk).update(cash=2)
+        lines = []
+        for shard in range(3):
+            lines += verifylog.verify_shard(shard, 3)
+        self.assertCountEqual([line.split(':')[0] for line in lines],
+            ['game {}'.format(game.pk) for game in games])
+
+
+class CompactlogTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.player = factories.PlayerFactory(game=self.game, cash=0)
+        utils.create_log_entry(self.game, None, text='New game')
+        for i in range(5):
+            utils.transfer_money(None, self.player, 1)
+            utils.create_log_entry(self.game, models.LogEntry.TRANSFER_MONEY,
+                acting=None, receiving=self.player, amount=1)
+
+    def test_compacts_up_to_log_cursor(self):
+        out = StringIO()
+        call_command('compactlog', str(self.game.pk), stdout=out)
+        self.assertEqual(out.getvalue().strip(), '5')
+        self.assertEqual(self.game.log.count(), 1)
+
+    def test_keep_leaves_entries(self):
+        call_command('compactlog', str(self.game.pk), keep=2,
+            stdout=StringIO())
+        self.assertEqual(self.game.log.count(), 3)
+
+    def test_compacts_up_to_entry(self):
+        entry = self.game.log.get(seq=3)
+        call_command('compactlog', str(self.game.pk), entry=str(entry.pk),
+            keep_text=True, stdout=StringIO())
+        self.assertEqual(self.game.log.first(), entry)
+        self.assertEqual(len(entry.snapshot.history_entries()), 3)
+
+    def test_raises_CommandError_when_game_doesnt_exist(self):
+        with self.assertRaises(CommandError):
+            call_command('compactlog', FAKE_UUID)
+
+    def test_raises_CommandError_when_entry_is_after_log_cursor(self):
+        entry = self.game.log_cursor
+        utils.undo(self.game)
+        with self.assertRaises(CommandError):
+            call_command('compactlog', str(self.game.pk),
+                entry=str(entry.pk))
+        self.assertEqual(self.game.log.count(), 6)
+
+
+class BenchmarkuuidsTests(TestCase):
+    def test_reports_both_kinds_of_keys(self):
+        out = StringIO()
+        call_command('benchmarkuuids', rows=50, batch=10, stdout=out)
+        lines = out.getvalue().strip().splitlines()
+        self.assertEqual([line.split()[0] for line in lines],
+            ['key', 'uuid4', 'time_uuid'])
+
+    def test_does_not_leave_tables_behind(self):
+        call_command('benchmarkuuids', rows=10, stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('benchmark_uuid4')")
+            self.assertIsNone(cursor.fetchone()[0])
+
+
+class PartitionlogTests(TestCase):
+    def setUp(self):
+        # Checked here and not at import, when the test database doesn't
+        # exist yet
+        if not partitioning.supports_partitioning(connection):
+            self.skipTest('Partitioning the log needs PostgreSQL 12 or newer')
+        self.games = factories.GameFactory.create_batch(size=3, cash=100)
+        for game in self.games:
+            player = factories.PlayerFactory(game=game, cash=0)
+            utils.create_log_entry(game, None, text='New game')
+            utils.transfer_money(None, player, 5)
+            utils.create_log_entry(game, models.LogEntry.TRANSFER_MONEY,
+                acting=None, receiving=player, amount=5)
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            return partitioning.log_partitions(cursor)
+
+    def scanned_tables(self, queryset):
+        return self.scanned_tables_of_sql(*queryset.query.sql_with_params())
+
+    def scanned_tables_of_sql(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        return [name for name, remainder in self.partitions()[1]
+            if name in plan]
+
+    def test_partitions_log_and_keeps_entries(self):
+        out = StringIO()
+        call_command('partitionlog', partitions=4, stdout=out)
+        self.assertEqual(self.partitions()[0], 4)
+        lines = out.getvalue().strip().splitlines()
+        self.assertEqual([line.split()[0] for line in lines],
+            [partitioning.partition_name(4, r) for r in range(4)])
+        self.assertEqual(sum(int(line.split()[1]) for line in lines), 6)
+        self.assertEqual(models.LogEntry.objects.count(), 6)
+
+    def test_log_of_game_is_pruned_to_one_partition(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        self.assertEqual(len(self.scanned_tables(self.games[0].log.all())),
+            1)
+
+    def test_log_cursor_is_found_in_one_partition(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        game = models.Game.objects.get(pk=self.games[0].pk)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(utils.get_log_cursor(game).pk,
+                game.log_cursor_id)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(self.scanned_tables_of_sql(queries[0]['sql'])),
+            1)
+
+    def test_log_of_game_is_listed_from_one_partition(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('logentry-list') + '?game=' +
+                str(self.games[0].pk))
+        self.assertEqual(len(response.data), 2)
+        for query in queries:
+            self.assertEqual(len(self.scanned_tables_of_sql(query['sql'])),
+                1)
+
+    def test_deleting_game_only_reads_its_partition(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        game = models.Game.objects.get(pk=self.games[0].pk)
+        with CaptureQueriesContext(connection) as queries:
+            game.delete()
+        log_queries = [query['sql'] for query in queries
+            if 'core_logentry' in query['sql']]
+        self.assertTrue(log_queries)
+        for sql in log_queries:
+            self.assertEqual(len(self.scanned_tables_of_sql(sql)), 1)
+        self.assertEqual(models.LogEntry.objects.count(), 4)
+
+    def test_log_can_be_used_after_partitioning(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        game = self.games[0]
+        player = game.players.get()
+        utils.transfer_money(player, None, 2)
+        entry = utils.create_log_entry(game,
+            models.LogEntry.TRANSFER_MONEY, acting=player, amount=2)
+        game.refresh_from_db()
+        self.assertEqual(game.log_cursor, entry)
+        self.assertEqual(game.log.count(), 3)
+        game.delete()
+        self.assertEqual(models.LogEntry.objects.count(), 4)
+
+    def test_log_cursor_must_be_entry_of_same_game(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        with self.assertRaises(IntegrityError), connection.cursor() as c:
+            c.execute('UPDATE core_game SET log_cursor_id = %s '
+                'WHERE uuid = %s', [self.games[1].log_cursor_id,
+                    self.games[0].pk])
+            c.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    def test_creates_and_attaches_missing_partitions(self):
+        call_command('partitionlog', partitions=8, stdout=StringIO())
+        # Three games leave at least two partitions empty
+        with connection.cursor() as cursor:
+            empty = []
+            for name, remainder in self.partitions()[1]:
+                cursor.execute('SELECT count(*) FROM {}'.format(name))
+                if cursor.fetchone()[0] == 0:
+                    empty.append(name)
+            for name in empty[:2]:
+                cursor.execute('ALTER TABLE core_logentry DETACH PARTITION '
+                    '{}'.format(name))
+            cursor.execute('DROP TABLE {}'.format(empty[1]))
+        self.assertEqual(len(self.partitions()[1]), 6)
+        call_command('partitionlog', stdout=StringIO())
+        self.assertEqual([r for name, r in self.partitions()[1]],
+            list(range(8)))
+        self.assertEqual(models.LogEntry.objects.count(), 6)
+
+    def test_changes_number_of_partitions(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        call_command('partitionlog', partitions=2, stdout=StringIO())
+        self.assertEqual(self.partitions()[0], 2)
+        self.assertEqual(models.LogEntry.objects.count(), 6)
+
+    def test_zero_partitions_turns_log_back_into_one_table(self):
+        call_command('partitionlog', partitions=4, stdout=StringIO())
+        call_command('partitionlog', partitions=0, stdout=StringIO())
+        with connection.cursor() as cursor:
+            self.assertFalse(partitioning.is_partitioned(cursor))
+        self.assertEqual(models.LogEntry.objects.count(), 6)
+
+    def test_fails_when_log_is_not_partitioned(self):
+        with self.assertRaises(CommandError):
+            call_command('partitionlog', stdout=StringIO())
+
+
+class PartitionLogMigrationTests(TestCase):
+    def setUp(self):
+        self.migration = import_module('core.migrations.0039_partition_log')
+        self.schema_editor = mock.Mock(connection=connection)
+
+    @override_settings(LOG_PARTITIONS=4)
+    def test_fails_when_partitioning_is_not_supported(self):
+        with mock.patch('core.partitioning.supports_partitioning',
+                return_value=False):
+            with self.assertRaises(ImproperlyConfigured):
+                self.migration.partition_log(None, self.schema_editor)
+
+    @override_settings(LOG_PARTITIONS=None)
+    def test_does_nothing_without_partitions(self):
+        with mock.patch('core.partitioning.supports_partitioning',
+                return_value=False):
+            self.migration.partition_log(None, self.schema_editor)
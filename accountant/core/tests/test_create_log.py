@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from .. import factories
 from .. import models
@@ -191,3 +194,109 @@ class CreateLogEntryTests(TestCase):
         self.assertEqual(list(self.game.log.all()), [entry1, entry3])
         with self.assertRaises(models.LogEntry.DoesNotExist):
             entry2.refresh_from_db()
+
+    def test_new_entry_directly_follows_log_cursor(self):
+        entry1 = models.LogEntry.objects.create(game=self.game)
+        models.LogEntry.objects.create(game=self.game)
+        self.game.log_cursor = entry1
+        self.game.save()
+
+        entry3 = utils.create_log_entry(self.game, None)
+
+        self.assertEqual(entry3.seq, entry1.seq + 1)
+
+    def test_clears_redo_stack_of_entries_with_same_time(self):
+        time = timezone.now()
+        entry1 = models.LogEntry.objects.create(game=self.game, time=time)
+        entry2 = models.LogEntry.objects.create(game=self.game, time=time)
+        self.game.log_cursor = entry1
+        self.game.save()
+
+        entry3 = utils.create_log_entry(self.game, None)
+
+        self.assertEqual(list(self.game.log.all()), [entry1, entry3])
+        with self.assertRaises(models.LogEntry.DoesNotExist):
+            entry2.refresh_from_db()
+
+    def test_entry_is_written_with_a_single_insert(self):
+        self.game.log_cursor = models.LogEntry.objects.create(game=self.game)
+        self.game.save()
+        with CaptureQueriesContext(connection) as queries:
+            utils.create_log_entry(self.game, models.LogEntry.TRANSFER_SHARE,
+                buyer=self.alice, source=self.bob, company=self.company,
+                shares=2, price=10)
+        writes = [q['sql'] for q in queries if q['sql'].startswith(
+            ('INSERT INTO "core_logentry"', 'UPDATE "core_logentry"'))]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('INSERT'))
+
+    def test_stored_entry_has_same_details(self):
+        entry = utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_SHARE, buyer=self.company,
+            source=self.bob, company=self.company2, shares=2, price=10)
+        entry = models.LogEntry.objects.get(pk=entry.pk)
+        self.verify_entry(entry, models.LogEntry.TRANSFER_SHARE, shares=2,
+            price=10, buyer='company', company_buyer=self.company,
+            acting_company=self.company, source='player',
+            player_source=self.bob, company=self.company2)
+
+
+class LogEntryDeltasTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory()
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game)
+        self.company, self.company2 = factories.CompanyFactory.create_batch(
+            size=2, game=self.game)
+
+    def test_money_transfer_stores_cash_deltas(self):
+        entry = utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_MONEY, amount=10, acting=self.alice,
+            receiving=self.company)
+        self.assertEqual(entry.deltas, {
+            'players': {str(self.alice.pk): {'cash': -10}},
+            'companies': {str(self.company.pk): {'cash': 10}}})
+
+    def test_money_transfer_to_bank_stores_game_delta(self):
+        entry = utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_MONEY, amount=10, acting=self.alice)
+        self.assertEqual(entry.deltas, {'game': {'cash': 10},
+            'players': {str(self.alice.pk): {'cash': -10}}})
+
+    def test_share_transfer_from_ipo_stores_pool_deltas(self):
+        entry = utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_SHARE, buyer=self.alice,
+            source=utils.Share.IPO, company=self.company, shares=2, price=10)
+        self.assertEqual(entry.deltas, {'game': {'cash': 20},
+            'players': {str(self.alice.pk): {'cash': -20}},
+            'companies': {str(self.company.pk): {'ipo_shares': -2}},
+            'playershares': {str(self.alice.pk): {str(self.company.pk): 2}}})
+
+    def test_share_transfer_between_companies_stores_share_deltas(self):
+        entry = utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_SHARE, buyer=self.company,
+            source=self.company2, company=self.company, shares=1, price=5)
+        self.assertEqual(entry.deltas, {
+            'companies': {str(self.company.pk): {'cash': -5},
+                          str(self.company2.pk): {'cash': 5}},
+            'companyshares': {
+                str(self.company.pk): {str(self.company.pk): 1},
+                str(self.company2.pk): {str(self.company.pk): -1}}})
+
+    def test_operating_stores_payments(self):
+        entry = utils.create_log_entry(self.game, models.LogEntry.OPERATE,
+            mode=models.LogEntry.HALF, amount=30, company=self.company,
+            payments={self.alice: 10.0, self.company: 15.0, self.bob: 0.5})
+        self.assertEqual(entry.deltas, {'game': {'cash': -26},
+            'players': {str(self.alice.pk): {'cash': 10},
+                        str(self.bob.pk): {'cash': 1}},
+            'companies': {str(self.company.pk): {'cash': 15}}})
+
+    def test_operating_without_payments_stores_no_deltas(self):
+        entry = utils.create_log_entry(self.game, models.LogEntry.OPERATE,
+            mode=models.LogEntry.FULL, amount=30, company=self.company)
+        self.assertIsNone(entry.deltas)
+
+    def test_entry_without_action_stores_no_deltas(self):
+        entry = utils.create_log_entry(self.game, None, text='New game')
+        self.assertIsNone(entry.deltas)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+import datetime
+
+from .. import models
+
+GAMES = 200
+PLAYERS = 5
+COMPANIES = 8
+ENTRIES = 500
+
+class IndexTests(TestCase):
+    """
+    Load a large synthetic dataset and check with EXPLAIN that the hot query
+    shapes are answered from an index instead of scanning a whole table.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO core_game (uuid, cash, pool_shares_pay,
+                    ipo_shares_pay, treasury_shares_pay)
+                SELECT md5('game' || g)::uuid, 12000, false, false, true
+                FROM generate_series(1, %s) AS g
+            ''', [GAMES])
+            cursor.execute('''
+                INSERT INTO core_player (uuid, name, game_id, cash)
+                SELECT md5('player' || g || '-' || p)::uuid, 'Player' || p,
+                    md5('game' || g)::uuid, 100
+                FROM generate_series(1, %s) AS g, generate_series(1, %s) AS p
+            ''', [GAMES, PLAYERS])
+            cursor.execute('''
+                INSERT INTO core_company (uuid, name, game_id, text_color,
+                    background_color, cash, share_count, ipo_shares,
+                    bank_shares)
+                SELECT md5('company' || g || '-' || c)::uuid, 'Co' || c,
+                    md5('game' || g)::uuid, 'black', 'white', 100, 10, 5, 1
+                FROM generate_series(1, %s) AS g, generate_series(1, %s) AS c
+            ''', [GAMES, COMPANIES])
+            cursor.execute('''
+                INSERT INTO core_playershare (uuid, owner_id, company_id,
+                    game_id, shares)
+                SELECT md5('playershare' || g || '-' || p || '-' || c)::uuid,
+                    md5('player' || g || '-' || p)::uuid,
+                    md5('company' || g || '-' || c)::uuid,
+                    md5('game' || g)::uuid, 1
+                FROM generate_series(1, %s) AS g, generate_series(1, %s) AS p,
+                    generate_series(1, %s) AS c
+            ''', [GAMES, PLAYERS, COMPANIES])
+            cursor.execute('''
+                INSERT INTO core_companyshare (uuid, owner_id, company_id,
+                    game_id, shares)
+                SELECT md5('companyshare' || g || '-' || o || '-' || c)::uuid,
+                    md5('company' || g || '-' || o)::uuid,
+                    md5('company' || g || '-' || c)::uuid,
+                    md5('game' || g)::uuid, 1
+                FROM generate_series(1, %s) AS g, generate_series(1, %s) AS o,
+                    generate_series(1, %s) AS c
+            ''', [GAMES, COMPANIES, COMPANIES])
+            cursor.execute('''
+                INSERT INTO core_logentry (uuid, game_id, seq, time, text,
+                    payload)
+                SELECT md5('entry' || g || '-' || s)::uuid,
+                    md5('game' || g)::uuid, s,
+                    %s - (%s - s) * interval '1 minute', '', '{}'
+                FROM generate_series(1, %s) AS g, generate_series(1, %s) AS s
+            ''', [timezone.now(), ENTRIES, GAMES, ENTRIES])
+            cursor.execute('ANALYZE')
+        cls.game = models.Game.objects.get(pk=models.Game.objects.values(
+            'pk').order_by('pk')[GAMES // 2]['pk'])
+        cls.company = cls.game.companies.first()
+
+    def assertUsesIndex(self, queryset, index=None):
+        """Assert that queryset is read through index or any index"""
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertNotIn('Seq Scan', plan)
+        self.assertIn(index or 'Index', plan)
+        return plan
+
+    def test_log_since_time(self):
+        since = timezone.now() - datetime.timedelta(minutes=10)
+        self.assertUsesIndex(self.game.log.filter(time__gt=since)
+            .order_by('time'), 'core_logentry_game_id_time')
+
+    def test_log_up_to_cursor(self):
+        self.assertUsesIndex(self.game.log.filter(seq__lte=ENTRIES // 2),
+            'core_logentry_game_id_seq')
+
+    def test_playershares_of_game(self):
+        self.assertUsesIndex(models.PlayerShare.objects.filter(
+            game=self.game.pk), 'core_holding_game_id')
+
+    def test_companyshares_of_game(self):
+        self.assertUsesIndex(models.CompanyShare.objects.filter(
+            game=self.game.pk), 'core_holding_game_id')
+
+    def test_holders_of_company(self):
+        self.assertUsesIndex(self.company.holdings.all(),
+            'core_holding_company_id_owner')
+
+    def test_playershares_of_company(self):
+        self.assertUsesIndex(self.company.playershare_set.all())
+
+    def test_companyshares_of_company(self):
+        self.assertUsesIndex(self.company.companyshare_set.all())
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+from django.db import connection, transaction
 from django.db.utils import IntegrityError
 from django.test import TestCase
 from django.utils import timezone
+from unittest import mock
+import time
 import uuid
 
 from .. import factories
+from .. import utils
 from ..models import Game, Player, Company, PlayerShare, CompanyShare, LogEntry
+from ..models import Holding, LedgerEntry, LogSnapshot, time_uuid
 
 class GameTests(TestCase):
     def test_pk_is_uuid(self):
@@ -30,6 +35,18 @@ class GameTests(TestCase):
         game = Game()
         self.assertTrue(game.treasury_shares_pay)
 
+    def test_deleting_game_deletes_only_its_log(self):
+        game, other = Game.objects.create(), Game.objects.create()
+        for g in (game, other):
+            g.log_cursor = LogEntry.objects.create(game=g)
+            g.save()
+            LogSnapshot.objects.create(entry=g.log_cursor, game=g, seq=1,
+                state={})
+        game.delete()
+        self.assertFalse(Game.objects.filter(pk=game.pk).exists())
+        self.assertEqual(list(LogEntry.objects.all()), [other.log_cursor])
+        self.assertEqual(LogSnapshot.objects.get().game, other)
+
     def test_log_cursor_can_point_to_log_entries(self):
         game = Game.objects.create()
         entry = LogEntry.objects.create(game=game)
@@ -219,9 +236,33 @@ class PlayerShareTests(TestCase):
         self.assertEqual(share.shares, 1)
 
     def test_game_is_equal_to_company_game(self):
-        share = PlayerShare(owner=self.player, company=self.company)
+        share = PlayerShare.objects.create(owner=self.player,
+            company=self.company)
         self.assertEqual(self.company.game, share.game)
 
+    def test_game_is_stored_with_the_holding(self):
+        share = PlayerShare.objects.create(owner=self.player,
+            company=self.company)
+        self.assertEqual(list(PlayerShare.objects.filter(
+            game=self.company.game_id)), [share])
+
+    def test_game_follows_company_when_it_changes(self):
+        share = PlayerShare.objects.create(owner=self.player,
+            company=self.company)
+        company = factories.CompanyFactory.create()
+        share.company = company
+        share.save()
+        self.assertEqual(PlayerShare.objects.get(pk=share.pk).game_id,
+            company.game_id)
+
+    def test_game_must_be_game_of_company(self):
+        share = PlayerShare.objects.create(owner=self.player,
+            company=self.company)
+        game = factories.GameFactory.create()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PlayerShare.objects.filter(pk=share.pk).update(game=game)
+            connection.cursor().execute('SET CONSTRAINTS ALL IMMEDIATE')
+
     def test_cannot_create_duplicate_share_holdings(self):
         PlayerShare.objects.create(owner=self.player, company=self.company)
         with self.assertRaises(IntegrityError):
@@ -261,9 +302,32 @@ class CompanyShareTests(TestCase):
         self.assertEqual(share.shares, 1)
 
     def test_game_is_equal_to_company_game(self):
-        share = CompanyShare(owner=self.company1, company=self.company2)
+        share = CompanyShare.objects.create(owner=self.company1,
+            company=self.company2)
         self.assertEqual(self.company2.game, share.game)
 
+    def test_game_is_stored_with_the_holding(self):
+        share = CompanyShare.objects.create(owner=self.company1,
+            company=self.company2)
+        self.assertEqual(list(CompanyShare.objects.filter(
+            game=self.company2.game_id)), [share])
+
+    def test_game_follows_company_when_it_changes(self):
+        share = CompanyShare.objects.create(owner=self.company1,
+            company=self.company2)
+        company = factories.CompanyFactory.create()
+        share.company = company
+        share.save()
+        self.assertEqual(CompanyShare.objects.get(pk=share.pk).game_id,
+            company.game_id)
+
+    def test_game_must_be_game_of_company(self):
+        game = factories.GameFactory.create()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CompanyShare.objects.bulk_create([CompanyShare(
+                owner=self.company1, company=self.company2, game=game)])
+            connection.cursor().execute('SET CONSTRAINTS ALL IMMEDIATE')
+
     def test_cannot_create_duplicate_share_holdings(self):
         CompanyShare.objects.create(owner=self.company1, company=self.company2)
         with self.assertRaises(IntegrityError):
@@ -274,6 +338,81 @@ class CompanyShareTests(TestCase):
         CompanyShare.objects.create(owner=self.company1, company=self.company1)
 
 
+class HoldingTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory.create()
+        self.player = factories.PlayerFactory.create(game=self.game)
+        self.company1, self.company2 = factories.CompanyFactory.create_batch(
+            size=2, game=self.game)
+
+    def test_player_shares_are_holdings(self):
+        share = PlayerShare.objects.create(owner=self.player,
+            company=self.company1, shares=3)
+        holding = Holding.objects.get(pk=share.pk)
+        self.assertEqual(holding.owner, self.player)
+        self.assertEqual(holding.company, self.company1)
+        self.assertEqual(holding.shares, 3)
+        self.assertEqual(holding.game, self.game)
+
+    def test_company_shares_are_holdings(self):
+        share = CompanyShare.objects.create(owner=self.company1,
+            company=self.company2, shares=2)
+        holding = Holding.objects.get(pk=share.pk)
+        self.assertEqual(holding.owner, self.company1)
+        self.assertEqual(holding.company, self.company2)
+
+    def test_holdings_of_company_list_players_and_companies(self):
+        PlayerShare.objects.create(owner=self.player, company=self.company1)
+        CompanyShare.objects.create(owner=self.company2,
+            company=self.company1)
+        self.assertCountEqual([h.owner for h in self.company1.holdings.all()],
+            [self.player, self.company2])
+
+    def test_share_views_only_contain_their_owners(self):
+        Holding.objects.create(player=self.player, company=self.company1)
+        Holding.objects.create(owner_company=self.company2,
+            company=self.company1)
+        self.assertEqual([s.owner for s in PlayerShare.objects.all()],
+            [self.player])
+        self.assertEqual([s.owner for s in CompanyShare.objects.all()],
+            [self.company2])
+
+    def test_game_follows_company_when_it_changes(self):
+        holding = Holding.objects.create(player=self.player,
+            company=self.company1)
+        company = factories.CompanyFactory.create()
+        holding.company = company
+        holding.save()
+        self.assertEqual(Holding.objects.get(pk=holding.pk).game_id,
+            company.game_id)
+
+    def test_game_must_be_game_of_company(self):
+        game = factories.GameFactory.create()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Holding.objects.bulk_create([Holding(player=self.player,
+                company=self.company1, game=game)])
+            connection.cursor().execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    def test_share_views_only_read_holdings(self):
+        for model in (PlayerShare, CompanyShare):
+            sql, params = model.objects.filter(game=self.game).query \
+                .sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            self.assertNotIn('core_company', plan)
+
+    def test_holding_needs_exactly_one_owner(self):
+        with self.assertRaises(IntegrityError):
+            Holding.objects.create(player=self.player,
+                owner_company=self.company2, company=self.company1)
+
+    def test_owner_can_only_have_one_holding_per_company(self):
+        Holding.objects.create(player=self.player, company=self.company1)
+        with self.assertRaises(IntegrityError):
+            Holding.objects.create(player=self.player, company=self.company1)
+
+
 class LogEntryTests(TestCase):
     def setUp(self):
         self.game = factories.GameFactory.create()
@@ -394,7 +533,29 @@ class LogEntryTests(TestCase):
     def test_mode_field_can_be_WITHHOLD(self):
         LogEntry.objects.create(game=self.game, mode=LogEntry.WITHHOLD)
 
-    def test_are_sorted_chronological(self):
+    def test_payload_is_empty_by_default(self):
+        self.assertEqual(self.entry.payload, {})
+
+    def test_action_details_are_stored_in_payload(self):
+        entry = LogEntry.objects.create(game=self.game, amount=10,
+            receiving_player=self.player, mode=LogEntry.HALF)
+        self.assertEqual(entry.payload, {'amount': 10, 'mode': LogEntry.HALF,
+            'receiving_player': str(self.player.pk)})
+
+    def test_references_in_payload_are_loaded_from_database(self):
+        entry = LogEntry.objects.create(game=self.game,
+            player_buyer=self.player, company_source=self.company)
+        entry = LogEntry.objects.get(pk=entry.pk)
+        self.assertEqual(entry.player_buyer, self.player)
+        self.assertEqual(entry.company_source, self.company)
+
+    def test_clearing_reference_removes_it_from_payload(self):
+        entry = LogEntry.objects.create(game=self.game, company=self.company)
+        entry.company = None
+        self.assertIsNone(entry.company)
+        self.assertNotIn('company', entry.payload)
+
+    def test_are_sorted_in_order_of_creation(self):
         self.entry.delete()
         entry1 = LogEntry.objects.create(game=self.game,
             time=timezone.make_aware(datetime(1970, 1, 1, 12, 0, 0)))
@@ -402,7 +563,24 @@ class LogEntryTests(TestCase):
             time=timezone.make_aware(datetime(1970, 1, 2, 1, 0, 0)))
         entry3 = LogEntry.objects.create(game=self.game,
             time=timezone.make_aware(datetime(1970, 1, 1, 18, 0, 0)))
-        self.assertEqual(list(self.game.log.all()), [entry1, entry3, entry2])
+        self.assertEqual(list(self.game.log.all()), [entry1, entry2, entry3])
+
+    def test_entries_with_same_time_keep_their_order(self):
+        time = timezone.now()
+        entries = [LogEntry.objects.create(game=self.game, time=time)
+            for i in range(5)]
+        self.assertEqual(list(self.game.log.all()), [self.entry] + entries)
+
+    def test_seq_numbers_entries_per_game(self):
+        entry = LogEntry.objects.create(game=self.game)
+        other = LogEntry.objects.create(game=factories.GameFactory())
+        self.assertEqual(self.entry.seq, 1)
+        self.assertEqual(entry.seq, 2)
+        self.assertEqual(other.seq, 1)
+
+    def test_seq_is_unique_within_game(self):
+        with self.assertRaises(IntegrityError):
+            LogEntry.objects.create(game=self.game, seq=self.entry.seq)
 
     def test_string_representation(self):
         entry = LogEntry(game=self.game, text='Test log entry')
@@ -423,3 +601,119 @@ class LogEntryTests(TestCase):
     def test_operate_is_undoable(self):
         self.entry.action = LogEntry.OPERATE
         self.assertTrue(self.entry.is_undoable)
+
+
+class LedgerEntryTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=0)
+
+    def balance(self, account):
+        return sum(LedgerEntry.objects.filter(account=account.pk)
+            .values_list('amount', flat=True))
+
+    def test_pk_is_uuid(self):
+        entry = LedgerEntry.objects.create(game=self.game,
+            movement=uuid.uuid4(), amount=0)
+        self.assertIsInstance(entry.pk, uuid.UUID)
+
+    def test_time_field_is_set_to_current_time(self):
+        entry = LedgerEntry.objects.create(game=self.game,
+            movement=uuid.uuid4(), amount=0)
+        self.assertAlmostEqual(entry.time, timezone.now(),
+            delta=timedelta(seconds=5))
+
+    def test_account_can_be_None(self):
+        entry = LedgerEntry.objects.create(game=self.game,
+            movement=uuid.uuid4(), amount=0)
+        self.assertIsNone(entry.account)
+
+    def test_creating_account_with_cash_records_it(self):
+        player = Player.objects.create(game=self.game, cash=30)
+        entries = LedgerEntry.objects.filter(game=self.game)
+        self.assertCountEqual(entries.values_list('account', 'amount'),
+            [(player.pk, 30), (None, -30)])
+        self.assertEqual(len(set(entries.values_list('movement',
+            flat=True))), 1)
+
+    def test_creating_account_without_cash_records_nothing(self):
+        Company.objects.create(game=self.game, cash=0)
+        self.assertFalse(LedgerEntry.objects.exists())
+
+    def test_saving_does_not_overwrite_cash(self):
+        company = Company.objects.create(game=self.game, cash=30)
+        # Cash moves while this instance is stale
+        Company.objects.filter(pk=company.pk).update(cash=35)
+        company.name = 'PRR'
+        company.save()
+        company.refresh_from_db()
+        self.assertEqual(company.name, 'PRR')
+        self.assertEqual(company.cash, 35)
+        self.assertEqual(LedgerEntry.objects.count(), 2)
+
+    def test_saving_changed_cash_fails(self):
+        company = Company.objects.create(game=self.game, cash=30)
+        company.cash = 20
+        with self.assertRaises(ValueError):
+            company.save()
+        company.refresh_from_db()
+        self.assertEqual(company.cash, 30)
+        self.assertEqual(self.balance(company), 30)
+
+    def test_saving_changed_cash_of_loaded_row_fails(self):
+        company = Company.objects.create(game=self.game, cash=30)
+        company = Company.objects.get(pk=company.pk)
+        company.cash = 20
+        with self.assertRaises(ValueError):
+            company.save()
+
+    def test_saving_cash_changed_by_transfer_succeeds(self):
+        company = Company.objects.create(game=self.game, cash=30)
+        utils.transfer_money(None, company, 5)
+        company.name = 'PRR'
+        company.save()
+        company.refresh_from_db()
+        self.assertEqual(company.cash, 35)
+        self.assertEqual(self.balance(company), 35)
+
+    def test_saving_unchanged_cash_records_nothing(self):
+        company = Company.objects.create(game=self.game, cash=30)
+        company.save()
+        self.assertEqual(LedgerEntry.objects.count(), 2)
+
+    def test_saving_other_fields_does_not_check_ledger(self):
+        self.game.cash = 10
+        with self.assertNumQueries(1):
+            self.game.save(update_fields=['pool_shares_pay'])
+        self.assertEqual(self.balance(self.game), 0)
+
+    def test_entries_are_deleted_with_game(self):
+        Player.objects.create(game=self.game, cash=30)
+        self.game.delete()
+        self.assertFalse(LedgerEntry.objects.exists())
+
+
+class TimeUuidTests(TestCase):
+    def test_is_version_7_uuid(self):
+        key = time_uuid()
+        self.assertEqual(key.int >> 76 & 0xf, 7)
+        self.assertEqual(key.variant, uuid.RFC_4122)
+
+    def test_starts_with_current_time(self):
+        before = int(timezone.now().timestamp() * 1000)
+        key = time_uuid()
+        after = int(timezone.now().timestamp() * 1000)
+        self.assertTrue(before <= key.int >> 80 <= after + 1)
+
+    def test_later_uuids_sort_after_earlier_ones(self):
+        first = time_uuid()
+        with mock.patch('time.time', return_value=time.time() + 1):
+            second = time_uuid()
+        self.assertLess(first, second)
+        self.assertLess(str(first), str(second))
+
+    def test_uuids_are_unique(self):
+        self.assertEqual(len({time_uuid() for i in range(1000)}), 1000)
+
+    def test_write_heavy_tables_use_time_uuid(self):
+        for model in (LogEntry, PlayerShare, CompanyShare, LedgerEntry):
+            self.assertIs(model._meta.pk.default, time_uuid)
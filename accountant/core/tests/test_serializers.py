@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
+from django.db import connection
+from django.http import Http404
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase as DjangoTestCase
 from rest_framework import exceptions
 from unittest import TestCase
 
 from ..models import LogEntry
 from .. import factories
+from .. import models
 from .. import serializers
+from .. import utils
 
 class GameSerializerTests(TestCase):
     def test_creates_log_entry_on_game_creation(self):
@@ -121,6 +127,46 @@ class CompanySerializerTests(TestCase):
         self.assertEqual(company.ipo_shares, 0)
         self.assertEqual(company.bank_shares, -3)
 
+    def test_company_update_refuses_to_change_cash(self):
+        company = factories.CompanyFactory(game=self.game, cash=30)
+        s = serializers.CompanySerializer(company, data={'name': 'TEST',
+            'game': self.game.pk, 'share_count': company.share_count,
+            'cash': 500})
+        s.is_valid(raise_exception=True)
+        with self.assertRaises(exceptions.ValidationError) as cm:
+            s.save()
+        self.assertEqual(cm.exception.detail['cash'],
+            [serializers.CASH_CHANGED_ERROR])
+
+        company.refresh_from_db()
+        self.assertNotEqual(company.name, 'TEST')
+        self.assertEqual(company.cash, 30)
+        self.assertEqual(list(utils.ledger_mismatches()), [])
+
+    def test_company_update_accepts_unchanged_cash(self):
+        company = factories.CompanyFactory(game=self.game, cash=30)
+        s = serializers.CompanySerializer(company, data={'name': 'TEST',
+            'game': self.game.pk, 'share_count': company.share_count,
+            'cash': 30})
+        s.is_valid(raise_exception=True)
+        self.assertEqual(s.save().name, 'TEST')
+
+    def test_company_update_follows_log_cursor_of_locked_game(self):
+        company = factories.CompanyFactory(game=self.game)
+        utils.create_log_entry(company.game, None, text='First')
+        # Another request moves the log on while company is still loaded
+        utils.create_log_entry(models.Game.objects.get(pk=self.game.pk),
+            None, text='Second')
+        s = serializers.CompanySerializer(company, data={'name': 'TEST',
+            'share_count': company.share_count}, partial=True)
+        s.is_valid(raise_exception=True)
+        s.save()
+
+        self.game.refresh_from_db()
+        self.assertEqual([e.text for e in self.game.log.all()],
+            ['First', 'Second', 'Company TEST has been edited'])
+        self.assertEqual(self.game.log_cursor, self.game.log.last())
+
 
 class PlayerSerializerTests(TestCase):
     def test_returns_user_friendly_message_when_player_not_unique(self):
@@ -133,6 +179,16 @@ class PlayerSerializerTests(TestCase):
         self.assertIn(serializers.DUPLICATE_PLAYER_ERROR,
             s.errors['non_field_errors'])
 
+    def test_locks_game_while_adding_player(self):
+        game = factories.GameFactory()
+        s = serializers.PlayerSerializer(data={'game': game.pk,
+            'name': 'Alice', 'cash': 1})
+        s.is_valid(raise_exception=True)
+        with CaptureQueriesContext(connection) as queries:
+            s.save()
+        self.assertTrue(any('FOR UPDATE' in q['sql'] and 'core_game' in
+            q['sql'] for q in queries.captured_queries))
+
     def test_creates_log_entry_on_player_creation(self):
         game = factories.GameFactory()
         s = serializers.PlayerSerializer(data={'game': game.pk,
@@ -147,6 +203,33 @@ class PlayerSerializerTests(TestCase):
         self.assertEqual(game.log_cursor, game.log.last())
 
 
+class ShareSerializerTests(TestCase):
+    def test_player_share_owner_must_be_in_the_game_of_the_company(self):
+        player = factories.PlayerFactory()
+        company = factories.CompanyFactory()
+        s = serializers.PlayerShareSerializer(data={'owner': player.pk,
+            'company': company.pk, 'shares': 1})
+        self.assertFalse(s.is_valid())
+        self.assertIn(serializers.DIFFERENT_GAME_ERROR,
+            s.errors['non_field_errors'])
+
+    def test_company_share_owner_must_be_in_the_game_of_the_company(self):
+        owner = factories.CompanyFactory()
+        company = factories.CompanyFactory()
+        s = serializers.CompanyShareSerializer(data={'owner': owner.pk,
+            'company': company.pk, 'shares': 1})
+        self.assertFalse(s.is_valid())
+        self.assertIn(serializers.DIFFERENT_GAME_ERROR,
+            s.errors['non_field_errors'])
+
+    def test_created_holding_is_part_of_the_game_of_the_company(self):
+        company = factories.CompanyFactory()
+        player = factories.PlayerFactory(game=company.game)
+        s = serializers.PlayerShareSerializer(data={'owner': player.pk,
+            'company': company.pk, 'shares': 2})
+        s.is_valid(raise_exception=True)
+        self.assertEqual(s.save().game_id, company.game_id)
+
 class TransferMoneySerializerTests(TestCase):
     def setUp(self):
         self.game = factories.GameFactory()
@@ -239,6 +322,62 @@ class TransferMoneySerializerTests(TestCase):
             s.errors['non_field_errors'])
 
 
+class TransferMoneySerializerInstanceTests(DjangoTestCase):
+    def setUp(self):
+        self.game = factories.GameFactory()
+        self.player = factories.PlayerFactory(game=self.game)
+        self.company = factories.CompanyFactory(game=self.game)
+
+    def test_source_and_dest_must_be_in_same_game(self):
+        s = serializers.TransferMoneySerializer(data={'amount': 14,
+            'from_player': self.player.pk,
+            'to_company': factories.CompanyFactory().pk})
+        with self.assertRaises(exceptions.ValidationError):
+            s.is_valid(raise_exception=True)
+        self.assertIn(serializers.DIFFERENT_GAME_ERROR,
+            s.errors['non_field_errors'])
+
+    def test_unknown_instance_raises_Http404(self):
+        s = serializers.TransferMoneySerializer(data={'amount': 15,
+            'from_player': self.company.pk})
+        with self.assertRaises(Http404):
+            s.is_valid()
+
+    def test_players_are_resolved_with_one_query(self):
+        player = factories.PlayerFactory(game=self.game)
+        s = serializers.TransferMoneySerializer(data={'amount': 16,
+            'from_player': self.player.pk, 'to_player': player.pk})
+        with self.assertNumQueries(1):
+            s.is_valid(raise_exception=True)
+        self.assertEqual(s.source_instance, self.player)
+        self.assertEqual(s.dest_instance, player)
+
+    def test_player_and_company_are_resolved_with_one_query_each(self):
+        s = serializers.TransferMoneySerializer(data={'amount': 17,
+            'from_company': self.company.pk, 'to_player': self.player.pk})
+        with self.assertNumQueries(2):
+            s.is_valid(raise_exception=True)
+
+    def test_instances_are_not_loaded_again_on_access(self):
+        s = serializers.TransferMoneySerializer(data={'amount': 18,
+            'from_player': self.player.pk, 'to_company': self.company.pk})
+        s.is_valid(raise_exception=True)
+        with self.assertNumQueries(0):
+            self.assertIs(s.source_instance, s.source_instance)
+            self.assertIs(s.dest_instance, s.dest_instance)
+
+    def test_instances_are_added_to_identity_map(self):
+        identity_map = utils.IdentityMap()
+        s = serializers.TransferMoneySerializer(data={'amount': 19,
+            'from_player': self.player.pk, 'to_company': self.company.pk},
+            context={'identity_map': identity_map})
+        s.is_valid(raise_exception=True)
+        self.assertIs(identity_map.get(models.Player, self.player.pk),
+            s.source_instance)
+        self.assertIs(identity_map.get(models.Company, self.company.pk),
+            s.dest_instance)
+
+
 class TransferShareSerializerTests(TestCase):
     def setUp(self):
         self.game = factories.GameFactory()
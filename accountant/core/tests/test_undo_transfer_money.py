@@ -521,3 +521,22 @@ class RedoTransferMoneyTests(TestCase):
         self.assertCountEqual(affected['companies'],
             [self.company, other_company])
         self.assertNotIn('shares', affected.keys())
+
+    def test_undo_and_redo_follow_order_of_entries_with_same_time(self,
+            mock_transfer_money):
+        time = self.start_entry.time
+        entry1 = models.LogEntry.objects.create(game=self.game, time=time,
+            action=models.LogEntry.TRANSFER_MONEY,
+            receiving_player=self.player, amount=1)
+        entry2 = models.LogEntry.objects.create(game=self.game, time=time,
+            action=models.LogEntry.TRANSFER_MONEY,
+            receiving_player=self.player, amount=2)
+        self.game.log_cursor = entry2
+        self.game.save()
+
+        utils.undo(self.game)
+        self.assertEqual(self.game.log_cursor, entry1)
+        utils.undo(self.game)
+        self.assertEqual(self.game.log_cursor, self.start_entry)
+        utils.redo(self.game)
+        self.assertEqual(self.game.log_cursor, entry1)
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from unittest import mock
 
 from .. import factories
@@ -52,6 +55,30 @@ class TransferMoneyTests(TestCase):
         self.assertEqual(self.player.cash, 20)
         self.assertEqual(self.company.cash, 0)
 
+    def test_transfering_updates_instances_with_new_balances(self):
+        utils.transfer_money(self.player, None, 3)
+        self.assertEqual(self.player.cash, 7)
+        self.assertEqual(self.player.game.cash, 103)
+
+    def test_transfering_does_not_overwrite_concurrent_changes(self):
+        models.Player.objects.filter(pk=self.player.pk).update(cash=50)
+        models.Game.objects.filter(pk=self.game.pk).update(cash=500)
+        utils.transfer_money(self.player, None, 10)
+        self.game.refresh_from_db()
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.cash, 40)
+        self.assertEqual(self.game.cash, 510)
+
+    def test_add_cash_returns_new_balance(self):
+        self.assertEqual(utils.add_cash(self.company, 5), 15)
+        self.assertEqual(self.company.cash, 15)
+
+    def test_add_cash_only_updates_cash(self):
+        self.company.name = 'Changed'
+        utils.add_cash(self.company, 5)
+        self.company.refresh_from_db()
+        self.assertNotEqual(self.company.name, 'Changed')
+
     def test_raises_SameEntityError_when_receiver_sender_are_the_bank(self):
         with self.assertRaises(utils.SameEntityError):
             utils.transfer_money(None, None, 0)
@@ -96,6 +123,7 @@ class PlayerShareTransactionTests(TestCase):
 
     def test_player_buying_from_bank_pool_gives_share_to_player(self):
         self.company.bank_shares = 10
+        self.company.save()
         utils.buy_share(self.player, self.company, utils.Share.BANK, 10)
         self.assertEqual(1,
             self.player.share_set.get(company=self.company).shares)
@@ -104,26 +132,31 @@ class PlayerShareTransactionTests(TestCase):
     def test_player_buying_from_bank_pool_gives_money_to_bank(self,
             mock_transfer_money):
         self.company.bank_shares = 10
+        self.company.save()
         utils.buy_share(self.player, self.company, utils.Share.BANK, 6)
         mock_transfer_money.assert_called_once_with(self.player, None, 6)
 
     def test_player_cannot_buy_from_pool_if_there_are_no_pool_shares(self):
         self.company.bank_shares = 0
+        self.company.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.player, self.company, utils.Share.BANK, 8)
 
     def test_player_cannot_buy_from_ipo_if_there_are_no_ipo_shares(self):
         self.company.ipo_shares = 0
+        self.company.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.player, self.company, utils.Share.IPO, 10)
 
     def test_player_buying_from_ipo_removes_share_from_ipo(self):
         self.company.ipo_shares = 10
+        self.company.save()
         utils.buy_share(self.player, self.company, utils.Share.IPO, 1)
         self.assertEqual(self.company.ipo_shares, 9)
 
     def test_player_buying_from_bank_pool_removes_share_from_pool(self):
         self.company.bank_shares = 10
+        self.company.save()
         utils.buy_share(self.player, self.company, utils.Share.BANK, 1)
         self.assertEqual(self.company.bank_shares, 9)
 
@@ -154,11 +187,13 @@ class PlayerShareTransactionTests(TestCase):
 
     def test_player_cannot_buy_from_ipo_if_it_has_too_few_shares(self):
         self.company.ipo_shares = 2
+        self.company.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.player, self.company, utils.Share.IPO, 1, 3)
 
     def test_player_cannot_buy_from_bank_pool_if_it_has_too_few_shares(self):
         self.company.bank_shares = 2
+        self.company.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.player, self.company, utils.Share.BANK, 1, 3)
 
@@ -176,6 +211,7 @@ class PlayerShareTransactionTests(TestCase):
 
     def test_player_can_buy_additional_share_from_bank_pool(self):
         self.company.bank_shares = 10
+        self.company.save()
         factories.PlayerShareFactory(owner=self.player, company=self.company)
         utils.buy_share(self.player, self.company, utils.Share.BANK, 2)
         self.assertEqual(2,
@@ -212,6 +248,7 @@ class PlayerShareTransactionTests(TestCase):
 
     def test_player_selling_share_to_ipo_increases_ipo_shares(self):
         self.company.ipo_shares = 0
+        self.company.save()
         factories.PlayerShareFactory(owner=self.player, company=self.company)
         utils.buy_share(utils.Share.IPO, self.company, self.player, 2)
         self.assertEqual(self.company.ipo_shares, 1)
@@ -232,6 +269,7 @@ class PlayerShareTransactionTests(TestCase):
 
     def test_player_selling_share_to_bank_pool_increase_pool_shares(self):
         self.company.bank_shares = 0
+        self.company.save()
         factories.PlayerShareFactory(owner=self.player, company=self.company)
         utils.buy_share(utils.Share.BANK, self.company, self.player, 5)
         self.assertEqual(self.company.bank_shares, 1)
@@ -261,6 +299,14 @@ class PlayerShareTransactionTests(TestCase):
         self.assertEqual(-1,
             self.player.share_set.get(company=self.company).shares)
 
+    def test_buying_returns_changed_holdings(self):
+        share = factories.PlayerShareFactory(owner=self.player,
+            company=self.company, shares=1)
+        holdings = utils.buy_share(self.player, self.company, utils.Share.IPO,
+            10)
+        self.assertEqual(holdings, [share])
+        self.assertEqual(holdings[0].shares, 2)
+
     def test_player_cant_buy_share_from_ipo_when_company_in_other_game(self):
         company = factories.CompanyFactory(ipo_shares=2)
         with self.assertRaises(utils.DifferentGameException):
@@ -322,6 +368,7 @@ class CompanyShareTransactionTests(TestCase):
 
     def test_company_buying_from_bank_pool_gives_share_to_company(self):
         self.company2.bank_shares = 10
+        self.company2.save()
         utils.buy_share(self.company1, self.company2, utils.Share.BANK, 10)
         self.assertEqual(1,
             self.company1.share_set.get(company=self.company2).shares)
@@ -330,21 +377,25 @@ class CompanyShareTransactionTests(TestCase):
     def test_company_buying_from_bank_pool_gives_money_to_bank(self,
             mock_transfer_money):
         self.company2.bank_shares = 10
+        self.company2.save()
         utils.buy_share(self.company1, self.company2, utils.Share.BANK, 7)
         mock_transfer_money.assert_called_once_with(self.company1, None, 7)
 
     def test_company_cannot_buy_from_pool_if_there_are_no_pool_shares(self):
         self.company2.bank_shares = 0
+        self.company2.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.company1, self.company2, utils.Share.BANK, 9)
 
     def test_company_cannot_buy_from_ipo_if_there_are_no_ipo_shares(self):
         self.company2.ipo_shares = 0
+        self.company2.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.company1, self.company2, utils.Share.IPO, 11)
 
     def test_company_can_buy_shares_from_different_company_from_bank(self):
         self.company2.bank_shares = 10
+        self.company2.save()
         utils.buy_share(self.company1, self.company2, utils.Share.BANK, 16)
         self.assertEqual(1,
             self.company1.share_set.get(company=self.company2).shares)
@@ -397,6 +448,7 @@ class CompanyShareTransactionTests(TestCase):
 
     def test_company_can_buy_additional_share_from_bank_pool(self):
         self.company2.bank_shares = 10
+        self.company2.save()
         factories.CompanyShareFactory(owner=self.company1,
             company=self.company2)
         utils.buy_share(self.company1, self.company2, utils.Share.BANK, 5)
@@ -419,27 +471,32 @@ class CompanyShareTransactionTests(TestCase):
 
     def test_company_can_buy_its_own_shares_from_the_bank_pool(self):
         self.company1.bank_shares = 4
+        self.company1.save()
         utils.buy_share(self.company1, self.company1, utils.Share.BANK, 1, 4)
         self.assertEqual(4,
             self.company1.share_set.get(company=self.company1).shares)
 
     def test_company_buying_from_ipo_removes_share_from_ipo(self):
         self.company2.ipo_shares = 10
+        self.company2.save()
         utils.buy_share(self.company1, self.company2, utils.Share.IPO, 1)
         self.assertEqual(9, self.company2.ipo_shares)
 
     def test_company_buying_from_bank_pool_removes_share_from_pool(self):
         self.company2.bank_shares = 10
+        self.company2.save()
         utils.buy_share(self.company1, self.company2, utils.Share.BANK, 1)
         self.assertEqual(9, self.company2.bank_shares)
 
     def test_company_cannot_buy_from_ipo_if_it_has_too_few_shares(self):
         self.company2.ipo_shares = 0
+        self.company2.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.company1, self.company2, utils.Share.IPO, 1)
 
     def test_company_cannot_buy_from_bank_pool_if_it_has_too_few_shares(self):
         self.company2.bank_shares = 0
+        self.company2.save()
         with self.assertRaises(utils.InvalidShareTransaction):
             utils.buy_share(self.company1, self.company2, utils.Share.BANK, 1)
 
@@ -467,6 +524,7 @@ class CompanyShareTransactionTests(TestCase):
 
     def test_company_selling_share_to_ipo_increases_ipo_shares(self):
         self.company2.ipo_shares = 0
+        self.company2.save()
         factories.CompanyShareFactory(owner=self.company1,
             company=self.company2)
         utils.buy_share(utils.Share.IPO, self.company2, self.company1, 2)
@@ -489,6 +547,7 @@ class CompanyShareTransactionTests(TestCase):
 
     def test_company_selling_share_to_bank_pool_increases_pool_shares(self):
         self.company2.bank_shares = 0
+        self.company2.save()
         factories.CompanyShareFactory(owner=self.company1,
             company=self.company2)
         utils.buy_share(utils.Share.BANK, self.company2, self.company1, 5)
@@ -598,7 +657,88 @@ class CompanyShareTransactionTests(TestCase):
         self.company1.share_set.get(company=self.company2)
 
 
-@mock.patch.object(utils, 'transfer_money')
+class BuyShareQueryCountTests(TestCase):
+    """
+    Every buyer/source combination supported by the API needs the same small
+    number of statements: changing the pool or holdings plus moving the
+    money.
+    """
+    def setUp(self):
+        self.game = factories.GameFactory()
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=100)
+        self.company, self.company2 = factories.CompanyFactory.create_batch(
+            size=2, game=self.game, cash=100, bank_shares=2)
+        for owner in (self.alice, self.bob):
+            factories.PlayerShareFactory(owner=owner, company=self.company,
+                shares=2)
+        factories.CompanyShareFactory(owner=self.company2,
+            company=self.company, shares=2)
+
+    def test_player_buying_from_ipo(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.alice, self.company, utils.Share.IPO, 10)
+
+    def test_player_buying_from_bank(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.alice, self.company, utils.Share.BANK, 10)
+
+    def test_player_buying_from_player(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.alice, self.company, self.bob, 10)
+
+    def test_player_buying_from_company(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.alice, self.company, self.company2, 10)
+
+    def test_company_buying_from_ipo(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.company2, self.company, utils.Share.IPO, 10)
+
+    def test_company_buying_from_bank(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.company2, self.company, utils.Share.BANK, 10)
+
+    def test_company_buying_from_player(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(self.company2, self.company, self.alice, 10)
+
+    def test_company_buying_from_company(self):
+        factories.CompanyShareFactory(owner=self.company,
+            company=self.company, shares=2)
+        with self.assertNumQueries(3):
+            utils.buy_share(self.company2, self.company, self.company, 10)
+
+    def test_ipo_buying_from_player(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(utils.Share.IPO, self.company, self.alice, 10)
+
+    def test_ipo_buying_from_company(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(utils.Share.IPO, self.company, self.company2, 10)
+
+    def test_bank_buying_from_player(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(utils.Share.BANK, self.company, self.alice, 10)
+
+    def test_bank_buying_from_company(self):
+        with self.assertNumQueries(3):
+            utils.buy_share(utils.Share.BANK, self.company, self.company2, 10)
+
+    def test_creating_a_holding_takes_one_extra_statement(self):
+        player = factories.PlayerFactory(game=self.game, cash=100)
+        with self.assertNumQueries(4):
+            utils.buy_share(player, self.company, utils.Share.IPO, 10)
+
+    def test_failing_to_take_shares_from_a_company_writes_nothing(self):
+        with self.assertRaises(utils.InvalidShareTransaction):
+            utils.buy_share(utils.Share.IPO, self.company, self.company2, 10,
+                3)
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.ipo_shares, 10)
+
+
+@mock.patch.object(utils, 'pay_from_bank')
 class OperateTests(TestCase):
     def setUp(self):
         self.game = factories.GameFactory(cash=0)
@@ -606,6 +746,11 @@ class OperateTests(TestCase):
             game=self.game, cash=0)
         self.company = factories.CompanyFactory(game=self.game, cash=0)
 
+    def assertPaid(self, mock_pay_from_bank, entity, amount):
+        game, payments = mock_pay_from_bank.call_args[0]
+        self.assertEqual(game, self.game)
+        self.assertEqual(payments[entity], amount)
+
     def setup_test_shares(self):
         self.company.ipo_shares = 4
         self.company.bank_shares = 1
@@ -617,67 +762,68 @@ class OperateTests(TestCase):
             shares=1)
 
     def test_withholding_gives_all_cash_to_the_company(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         utils.operate(self.company, 180, utils.OperateMethod.WITHHOLD)
-        mock_transfer_money.assert_called_once_with(None, self.company, 180)
+        mock_pay_from_bank.assert_called_once_with(self.game,
+            {self.company: 180})
 
     def test_operating_gives_money_to_company_if_it_owns_its_own_shares(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         utils.operate(self.company, 140, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.company, 14)
+        self.assertPaid(mock_pay_from_bank, self.company, 14)
 
     def test_operating_gives_money_to_company_when_pool_shares_pay_dividend(
-            self, mock_transfer_money):
+            self, mock_pay_from_bank):
         self.game.pool_shares_pay = True
         self.game.save()
         self.setup_test_shares()
         utils.operate(self.company, 150, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.company, 30)
+        self.assertPaid(mock_pay_from_bank, self.company, 30)
 
     def test_operating_gives_money_to_company_when_pool_shares_pay_dividend2(
-            self, mock_transfer_money):
+            self, mock_pay_from_bank):
         self.game.pool_shares_pay = True
         self.game.save()
         self.company.bank_shares = 3
         self.company.save()
         utils.operate(self.company, 160, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.company, 48)
+        self.assertPaid(mock_pay_from_bank, self.company, 48)
 
     def test_operating_gives_money_to_company_when_ipo_shares_pay_dividend(
-            self, mock_transfer_money):
+            self, mock_pay_from_bank):
         self.game.ipo_shares_pay = True
         self.game.save()
         self.setup_test_shares()
         utils.operate(self.company, 170, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.company, 85)
+        self.assertPaid(mock_pay_from_bank, self.company, 85)
 
     def test_operating_gives_money_to_company_when_ipo_shares_pay_dividend2(
-            self, mock_transfer_money):
+            self, mock_pay_from_bank):
         self.game.ipo_shares_pay = True
         self.game.save()
         self.company.ipo_shares = 7
         self.company.save()
         utils.operate(self.company, 180, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.company, 126)
+        self.assertPaid(mock_pay_from_bank, self.company, 126)
 
-    def test_operating_gives_money_to_share_holders(self, mock_transfer_money):
+    def test_operating_gives_money_to_share_holders(self, mock_pay_from_bank):
         self.setup_test_shares()
         utils.operate(self.company, 520, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.alice, 156)
-        mock_transfer_money.assert_any_call(None, self.bob, 52)
+        self.assertPaid(mock_pay_from_bank, self.alice, 156)
+        self.assertPaid(mock_pay_from_bank, self.bob, 52)
 
     def test_operating_gives_money_to_different_company_that_owns_shares(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         company2 = factories.CompanyFactory(game=self.game, cash=0)
         factories.CompanyShareFactory(owner=company2, company=self.company,
             shares=2)
         utils.operate(self.company, 40, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, company2, 8)
+        self.assertPaid(mock_pay_from_bank, company2, 8)
 
     def test_operating_doesnt_give_money_to_company_when_treasury_doesnt_pay(
-            self, mock_transfer_money):
+            self, mock_pay_from_bank):
         self.game.treasury_shares_pay = False
         self.game.save()
         self.setup_test_shares()
@@ -686,87 +832,87 @@ class OperateTests(TestCase):
         self.assertEqual(self.company.cash, 0)
 
     def test_operating_gives_money_to_company_when_treasury_shares_pay(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.game.treasury_shares_pay = True
         self.game.save()
         self.setup_test_shares()
         utils.operate(self.company, 190, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.company, 19)
+        self.assertPaid(mock_pay_from_bank, self.company, 19)
 
     def test_shareholder_payout_is_proportional_to_percentage_owned(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.company.share_count = 4
         factories.PlayerShareFactory(owner=self.alice, company=self.company,
             shares=3)
         utils.operate(self.company, 40, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.alice, 30)
+        self.assertPaid(mock_pay_from_bank, self.alice, 30)
 
-    def test_payout_is_rounded_down_when_fraction(self, mock_transfer_money):
+    def test_payout_is_rounded_down_when_fraction(self, mock_pay_from_bank):
         self.setup_test_shares()
         utils.operate(self.company, 157, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.alice, 47)
-        mock_transfer_money.assert_any_call(None, self.bob, 15)
-        mock_transfer_money.assert_any_call(None, self.company, 15)
+        self.assertPaid(mock_pay_from_bank, self.alice, 47)
+        self.assertPaid(mock_pay_from_bank, self.bob, 15)
+        self.assertPaid(mock_pay_from_bank, self.company, 15)
 
     def test_players_with_short_shares_loose_money(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         self.bob.share_set.filter(company=self.company).update(shares=-1)
         utils.operate(self.company, 120, utils.OperateMethod.FULL)
-        mock_transfer_money.assert_any_call(None, self.bob, -12)
+        self.assertPaid(mock_pay_from_bank, self.bob, -12)
 
-    def test_player_owning_no_shares_gets_no_money(self, mock_transfer_money):
+    def test_player_owning_no_shares_gets_no_money(self, mock_pay_from_bank):
         self.setup_test_shares()
         self.bob.share_set.filter(company=self.company).update(shares=0)
         affected = utils.operate(self.company, 90, utils.OperateMethod.FULL)
         self.assertNotIn(self.bob, affected)
-        self.assertNotIn((None, self.bob, 0), mock_transfer_money.mock_calls)
+        self.assertNotIn(self.bob, mock_pay_from_bank.call_args[0][1])
 
     def test_paying_half_pays_half_dividends_to_the_shareholders(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         utils.operate(self.company, 320, utils.OperateMethod.HALF)
-        mock_transfer_money.assert_any_call(None, self.alice, 48)
-        mock_transfer_money.assert_any_call(None, self.bob, 16)
+        self.assertPaid(mock_pay_from_bank, self.alice, 48)
+        self.assertPaid(mock_pay_from_bank, self.bob, 16)
 
     def test_paying_half_only_transfers_money_once_to_company(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         utils.operate(self.company, 340, utils.OperateMethod.HALF)
-        mock_transfer_money.assert_any_call(None, self.company, 187)
+        self.assertPaid(mock_pay_from_bank, self.company, 187)
 
     def test_paying_half_rounds_in_favour_of_shareholders(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         self.company.share_set.get(company=self.company).shares = 0
         utils.operate(self.company, 70, utils.OperateMethod.HALF)
-        mock_transfer_money.assert_any_call(None, self.alice, 12)
-        mock_transfer_money.assert_any_call(None, self.bob, 4)
-        mock_transfer_money.assert_any_call(None, self.company, 34)
+        self.assertPaid(mock_pay_from_bank, self.alice, 12)
+        self.assertPaid(mock_pay_from_bank, self.bob, 4)
+        self.assertPaid(mock_pay_from_bank, self.company, 34)
 
     def test_players_with_shorted_shares_loose_money_when_paying_half(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         self.bob.share_set.filter(company=self.company).update(shares=-1)
         utils.operate(self.company, 200, utils.OperateMethod.HALF)
-        mock_transfer_money.assert_any_call(None, self.bob, -10)
+        self.assertPaid(mock_pay_from_bank, self.bob, -10)
 
     def test_paying_half_gives_no_money_to_players_without_shares(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         self.bob.share_set.filter(company=self.company).update(shares=0)
         affected = utils.operate(self.company, 280, utils.OperateMethod.HALF)
         self.assertNotIn(self.bob, affected)
-        self.assertNotIn((None, self.bob, 0), mock_transfer_money.mock_calls)
+        self.assertNotIn(self.bob, mock_pay_from_bank.call_args[0][1])
 
     def test_paying_half_gives_company_exactly_half_when_not_owning_shares(
-            self, mock_transfer_money):
+            self, mock_pay_from_bank):
         affected = utils.operate(self.company, 300, utils.OperateMethod.HALF)
         self.assertEqual(affected[self.company], 150)
-        mock_transfer_money.assert_any_call(None, self.company, 150)
+        self.assertPaid(mock_pay_from_bank, self.company, 150)
 
     def test_returns_dictionary_of_affected_entities(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         affected = utils.operate(self.company, 100, utils.OperateMethod.FULL)
         self.assertEqual(affected, {self.alice: 30,
@@ -774,7 +920,7 @@ class OperateTests(TestCase):
                                     self.company: 10})
 
     def test_does_not_return_unaffected_entities(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         player = factories.PlayerFactory(game=self.game)
         c1, c2 = factories.CompanyFactory.create_batch(size=2, game=self.game)
         factories.CompanyShareFactory(owner=c1, company=self.company, shares=1)
@@ -784,7 +930,7 @@ class OperateTests(TestCase):
         self.assertNotIn(c2, affected.keys())
 
     def test_returns_dictionary_of_affected_entities_when_paying_half(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         factories.PlayerFactory(game=self.game)
         c1, c2 = factories.CompanyFactory.create_batch(size=2, game=self.game)
         factories.CompanyShareFactory(owner=c1, company=self.company, shares=1)
@@ -796,7 +942,7 @@ class OperateTests(TestCase):
                                     c1: 5})
 
     def test_only_current_company_is_affected_when_withholding(self,
-            mock_transfer_money):
+            mock_pay_from_bank):
         self.setup_test_shares()
         affected = utils.operate(self.company, 100,
             utils.OperateMethod.WITHHOLD)
@@ -848,3 +994,898 @@ class NoMoneyOperateTests(TestCase):
         utils.operate(self.company, 109, utils.OperateMethod.FULL)
         self.company.refresh_from_db()
         self.assertEqual(self.company.cash, 10)
+
+    def test_paying_dividends_takes_the_total_from_the_bank(self):
+        self.setup_test_shares()
+        utils.operate(self.company, 100, utils.OperateMethod.FULL)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.cash, -50)
+
+    def test_paying_dividends_updates_the_paid_instances(self):
+        self.setup_test_shares()
+        affected = utils.operate(self.company, 100, utils.OperateMethod.FULL)
+        self.assertEqual({e: e.cash for e in affected}, {self.alice: 30,
+                                                         self.bob: 10,
+                                                         self.company: 10})
+        self.assertEqual(self.company.game.cash, -50)
+
+    def test_query_count_does_not_depend_on_number_of_share_holders(self):
+        factories.PlayerShareFactory(owner=self.alice, company=self.company)
+        with self.assertNumQueries(2):
+            utils.operate(self.company, 100, utils.OperateMethod.FULL)
+        for player in factories.PlayerFactory.create_batch(size=7,
+                game=self.game):
+            factories.PlayerShareFactory(owner=player, company=self.company)
+        company = models.Company.objects.select_related('game').get(
+            pk=self.company.pk)
+        with self.assertNumQueries(2):
+            utils.operate(company, 100, utils.OperateMethod.FULL)
+
+class IdentityMapTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.player = factories.PlayerFactory(game=self.game)
+        self.company = factories.CompanyFactory(game=self.game)
+        self.identity_map = utils.IdentityMap()
+
+    def test_get_loads_instance(self):
+        player = self.identity_map.get(models.Player, self.player.pk)
+        self.assertEqual(player, self.player)
+        self.assertIsNot(player, self.player)
+
+    def test_get_loads_row_only_once(self):
+        player = self.identity_map.get(models.Player, self.player.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(self.identity_map.get(models.Player,
+                str(self.player.pk)), player)
+
+    def test_get_distinguishes_models(self):
+        self.identity_map.get(models.Player, self.player.pk)
+        company = self.identity_map.get(models.Company, self.company.pk)
+        self.assertIsInstance(company, models.Company)
+
+    def test_get_raises_DoesNotExist_for_unknown_row(self):
+        with self.assertRaises(models.Player.DoesNotExist):
+            self.identity_map.get(models.Player, self.company.pk)
+
+    def test_add_returns_instance_already_in_map(self):
+        player = self.identity_map.get(models.Player, self.player.pk)
+        self.assertIs(self.identity_map.add(self.player), player)
+
+    def test_iterating_yields_instances(self):
+        player = self.identity_map.get(models.Player, self.player.pk)
+        company = self.identity_map.get(models.Company, self.company.pk)
+        self.assertCountEqual(list(self.identity_map), [player, company])
+
+    def test_lock_game_selects_game_row_for_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.identity_map.lock_game(self.game.pk)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('FOR UPDATE', queries[0]['sql'])
+
+    def test_lock_game_returns_game(self):
+        game = self.identity_map.lock_game(self.game.pk)
+        self.assertEqual(game, self.game)
+        self.assertIs(self.identity_map.game, game)
+        self.assertIs(self.identity_map.get(models.Game, self.game.pk), game)
+
+    def test_lock_game_shares_game_with_loaded_instances(self):
+        player = self.identity_map.get(models.Player, self.player.pk)
+        game = self.identity_map.lock_game(self.game.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(player.game, game)
+
+    def test_instances_loaded_after_lock_share_game(self):
+        game = self.identity_map.lock_game(self.game.pk)
+        company = self.identity_map.get(models.Company, self.company.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(company.game, game)
+
+    def test_lock_game_does_not_bind_other_games(self):
+        player = self.identity_map.add(factories.PlayerFactory())
+        self.identity_map.lock_game(self.game.pk)
+        self.assertNotEqual(player.game, self.game)
+
+    def test_lock_game_updates_stale_instance(self):
+        game = self.identity_map.get(models.Game, self.game.pk)
+        entry = factories.LogEntryFactory(game=self.game)
+        models.Game.objects.filter(pk=self.game.pk).update(cash=900,
+            log_cursor=entry)
+        self.assertIs(self.identity_map.lock_game(self.game.pk), game)
+        self.assertEqual(game.cash, 900)
+        self.assertEqual(game.log_cursor, entry)
+
+    def test_lock_game_reloads_instances_of_game(self):
+        company = self.identity_map.get(models.Company, self.company.pk)
+        models.Company.objects.filter(pk=self.company.pk).update(
+            bank_shares=3, cash=50)
+        self.identity_map.lock_game(self.game.pk)
+        self.assertEqual(company.bank_shares, 3)
+        self.assertEqual(company.cash, 50)
+
+    def test_lock_game_fails_when_loaded_instance_was_deleted(self):
+        self.identity_map.get(models.Player, self.player.pk)
+        models.Player.objects.filter(pk=self.player.pk).delete()
+        with self.assertRaises(models.Player.DoesNotExist):
+            self.identity_map.lock_game(self.game.pk)
+
+    def test_lock_game_keeps_log_cursor_if_it_did_not_move(self):
+        self.game.log_cursor = factories.LogEntryFactory(game=self.game)
+        self.game.save()
+        game = self.identity_map.get(models.Game, self.game.pk)
+        game.log_cursor
+        self.identity_map.lock_game(self.game.pk)
+        with self.assertNumQueries(0):
+            game.log_cursor
+
+
+class ApplyDeltasTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=50)
+        self.company = factories.CompanyFactory(game=self.game, cash=50,
+            ipo_shares=8, bank_shares=2)
+        self.share = factories.PlayerShareFactory(owner=self.alice,
+            company=self.company, shares=3)
+        self.company_share = factories.CompanyShareFactory(
+            owner=self.company, company=self.company, shares=1)
+        self.deltas = {'game': {'cash': -15},
+            'players': {str(self.alice.pk): {'cash': 10},
+                        str(self.bob.pk): {'cash': 5}},
+            'companies': {str(self.company.pk): {'ipo_shares': -2}},
+            'playershares': {str(self.alice.pk): {str(self.company.pk): 2}},
+            'companyshares': {
+                str(self.company.pk): {str(self.company.pk): -1}}}
+
+    def test_applies_deltas(self):
+        utils.apply_deltas(self.game, self.deltas)
+        for instance in (self.game, self.alice, self.bob, self.company,
+                         self.share, self.company_share):
+            instance.refresh_from_db()
+        self.assertEqual(self.game.cash, 85)
+        self.assertEqual(self.alice.cash, 60)
+        self.assertEqual(self.bob.cash, 55)
+        self.assertEqual(self.company.ipo_shares, 6)
+        self.assertEqual(self.company.bank_shares, 2)
+        self.assertEqual(self.share.shares, 5)
+        self.assertEqual(self.company_share.shares, 0)
+
+    def test_reverts_deltas(self):
+        utils.apply_deltas(self.game, self.deltas, -1)
+        for instance in (self.game, self.alice, self.company, self.share):
+            instance.refresh_from_db()
+        self.assertEqual(self.game.cash, 115)
+        self.assertEqual(self.alice.cash, 40)
+        self.assertEqual(self.company.ipo_shares, 10)
+        self.assertEqual(self.share.shares, 1)
+
+    def test_returns_changed_instances(self):
+        affected = utils.apply_deltas(self.game, self.deltas)
+        self.assertIs(affected['game'], self.game)
+        self.assertEqual(self.game.cash, 85)
+        self.assertCountEqual([(p, p.cash) for p in affected['players']],
+            [(self.alice, 60), (self.bob, 55)])
+        self.assertEqual([(c, c.ipo_shares) for c in affected['companies']],
+            [(self.company, 6)])
+        self.assertCountEqual([(s, s.shares) for s in affected['shares']],
+            [(self.share, 5), (self.company_share, 0)])
+
+    def test_leaves_out_tables_without_changes(self):
+        affected = utils.apply_deltas(self.game,
+            {'players': {str(self.alice.pk): {'cash': 10}}})
+        self.assertEqual(list(affected.keys()), ['players'])
+
+    def test_uses_one_query_per_table_and_ledger(self):
+        for i in range(5):
+            player = factories.PlayerFactory(game=self.game)
+            self.deltas['players'][str(player.pk)] = {'cash': 1}
+        with self.assertNumQueries(6):
+            utils.apply_deltas(self.game, self.deltas)
+
+
+class UndoDeltasTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        utils.create_log_entry(self.game, None)
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=0)
+        self.company = factories.CompanyFactory(game=self.game, cash=0)
+        factories.PlayerShareFactory(owner=self.alice, company=self.company,
+            shares=4)
+        factories.PlayerShareFactory(owner=self.bob, company=self.company,
+            shares=6)
+        payments = utils.operate(self.company, 50, utils.OperateMethod.FULL)
+        self.entry = utils.create_log_entry(self.game,
+            models.LogEntry.OPERATE, mode=models.LogEntry.FULL, amount=50,
+            company=self.company, payments=payments)
+
+    def test_undo_reverts_stored_deltas(self):
+        utils.undo(self.game)
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.game.refresh_from_db()
+        self.assertEqual(self.alice.cash, 0)
+        self.assertEqual(self.bob.cash, 0)
+        self.assertEqual(self.game.cash, 100)
+
+    def test_redo_applies_stored_deltas(self):
+        utils.undo(self.game)
+        utils.redo(self.game)
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.game.refresh_from_db()
+        self.assertEqual(self.alice.cash, 20)
+        self.assertEqual(self.bob.cash, 30)
+        self.assertEqual(self.game.cash, 50)
+
+    @mock.patch.object(utils, 'operate')
+    def test_undo_does_not_operate_again(self, mock_operate):
+        utils.undo(self.game)
+        self.assertFalse(mock_operate.called)
+
+    @mock.patch.object(utils, 'operate')
+    def test_redo_does_not_operate_again(self, mock_operate):
+        utils.undo(self.game)
+        utils.redo(self.game)
+        self.assertFalse(mock_operate.called)
+
+    def test_undo_returns_changed_instances(self):
+        affected = utils.undo(self.game)
+        self.assertEqual(affected['game'], self.game)
+        self.assertCountEqual(affected['players'], [self.alice, self.bob])
+        self.assertNotIn('companies', affected)
+
+    def test_redo_returns_log_entry(self):
+        utils.undo(self.game)
+        affected = utils.redo(self.game)
+        self.assertEqual(affected['log'], self.entry)
+
+
+class JumpTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.start = utils.create_log_entry(self.game, None, text='New game')
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=0)
+        self.company = factories.CompanyFactory(game=self.game, cash=0)
+        self.entries = []
+        for player in (self.alice, self.bob, self.alice):
+            self.entries.append(self.transfer(None, player, 10))
+        self.entries.append(self.transfer(self.alice, self.company, 5))
+
+    def transfer(self, sender, receiver, amount):
+        utils.transfer_money(sender, receiver, amount)
+        return utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_MONEY, acting=sender,
+            receiving=receiver, amount=amount)
+
+    def assertCash(self, game, alice, bob, company):
+        for instance in (self.game, self.alice, self.bob, self.company):
+            instance.refresh_from_db()
+        self.assertEqual((self.game.cash, self.alice.cash, self.bob.cash,
+            self.company.cash), (game, alice, bob, company))
+
+    def test_can_jump_back_to_start(self):
+        utils.jump(self.game, self.start.pk)
+        self.assertCash(100, 0, 0, 0)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.start)
+
+    def test_can_jump_back_to_entry(self):
+        utils.jump(self.game, self.entries[1].pk)
+        self.assertCash(80, 10, 10, 0)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.entries[1])
+
+    def test_can_jump_forward_to_entry(self):
+        utils.jump(self.game, self.start.pk)
+        utils.jump(self.game, self.entries[2].pk)
+        self.assertCash(70, 20, 10, 0)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.entries[2])
+
+    def test_jumping_to_cursor_changes_nothing(self):
+        affected = utils.jump(self.game, self.entries[3].pk)
+        self.assertEqual(affected, {})
+        self.assertCash(70, 15, 10, 5)
+
+    def test_returns_every_changed_instance_once(self):
+        affected = utils.jump(self.game, self.start.pk)
+        self.assertEqual(affected['game'], self.game)
+        self.assertCountEqual(affected['players'], [self.alice, self.bob])
+        self.assertEqual(affected['companies'], [self.company])
+
+    def test_leaves_out_instances_that_end_up_unchanged(self):
+        self.transfer(self.company, self.alice, 5)
+        affected = utils.jump(self.game, self.entries[2].pk)
+        self.assertNotIn('game', affected)
+        self.assertNotIn('players', affected)
+        self.assertNotIn('companies', affected)
+
+    def test_does_not_depend_on_number_of_entries(self):
+        with self.assertNumQueries(7):
+            utils.jump(self.game, self.start.pk)
+        utils.jump(self.game, self.entries[3].pk)
+        for i in range(10):
+            self.transfer(None, self.bob, 1)
+        with self.assertNumQueries(7):
+            utils.jump(self.game, self.start.pk)
+
+    def test_entries_without_deltas_are_performed_again(self):
+        entry = self.transfer(None, self.bob, 10)
+        entry.deltas = None
+        entry.save()
+        self.transfer(self.bob, self.alice, 15)
+        utils.jump(self.game, self.entries[3].pk)
+        self.assertCash(70, 15, 10, 5)
+        utils.jump(self.game, self.start.pk)
+        self.assertCash(100, 0, 0, 0)
+
+    def test_entry_must_be_of_game(self):
+        entry = models.LogEntry.objects.create(
+            game=factories.GameFactory())
+        with self.assertRaises(models.LogEntry.DoesNotExist):
+            utils.jump(self.game, entry.pk)
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=50)
+        self.company = factories.CompanyFactory(game=self.game, cash=50)
+        factories.PlayerShareFactory(owner=self.alice, company=self.company,
+            shares=3)
+        self.start = timezone.now()
+
+    def movements(self):
+        entries = models.LedgerEntry.objects.filter(time__gt=self.start)
+        movements = {}
+        for entry in entries:
+            movements.setdefault(entry.movement, {})[entry.account] = \
+                entry.amount
+        return list(movements.values())
+
+    def assertMatchesLedger(self, *instances):
+        for instance in instances:
+            instance.refresh_from_db()
+            self.assertEqual(utils.balance(instance), instance.cash)
+        self.assertEqual(list(utils.ledger_mismatches()), [])
+
+    def test_transfer_money_records_movement(self):
+        utils.transfer_money(self.alice, self.company, 20)
+        self.assertEqual(self.movements(),
+            [{self.alice.pk: -20, self.company.pk: 20}])
+        self.assertMatchesLedger(self.alice, self.company)
+
+    def test_transfer_money_with_bank_records_movement(self):
+        utils.transfer_money(None, self.bob, 20)
+        self.assertEqual(self.movements(),
+            [{self.game.pk: -20, self.bob.pk: 20}])
+        self.assertMatchesLedger(self.game, self.bob)
+
+    def test_add_cash_records_cash_from_outside_game(self):
+        utils.add_cash(self.alice, 20)
+        self.assertEqual(self.movements(), [{self.alice.pk: 20, None: -20}])
+        self.assertMatchesLedger(self.alice)
+
+    def test_transfer_money_to_missing_row_records_nothing(self):
+        self.bob.delete()
+        with self.assertRaises(models.Player.DoesNotExist), \
+                transaction.atomic():
+            utils.transfer_money(self.alice, self.bob, 20)
+        self.assertEqual(self.movements(), [])
+
+    def test_missing_row_rolls_back_outer_transaction(self):
+        self.bob.delete()
+        with self.assertRaises(models.Player.DoesNotExist), \
+                transaction.atomic():
+            try:
+                utils.transfer_money(self.alice, self.bob, 20)
+            finally:
+                self.assertTrue(transaction.get_rollback())
+
+    def test_buying_share_records_movement(self):
+        utils.buy_share(self.bob, self.company, self.alice, 30)
+        self.assertEqual(self.movements(),
+            [{self.bob.pk: -30, self.alice.pk: 30}])
+        self.assertMatchesLedger(self.alice, self.bob)
+
+    def test_operating_records_single_movement(self):
+        utils.operate(self.company, 50, utils.OperateMethod.HALF)
+        self.assertEqual(self.movements(), [{self.game.pk: -29,
+            self.alice.pk: 9, self.company.pk: 20}])
+        self.assertMatchesLedger(self.game, self.alice, self.company)
+
+    def test_operating_with_odd_payout_rounds_like_the_ledger(self):
+        # Splitting 25 leaves 12.5, the database would round it to even
+        company = factories.CompanyFactory(game=self.game, cash=50)
+        self.start = timezone.now()
+        utils.operate(company, 25, utils.OperateMethod.HALF)
+        self.assertEqual(self.movements(), [{self.game.pk: -13,
+            company.pk: 13}])
+        self.assertMatchesLedger(self.game, company)
+        self.assertEqual(company.cash, 63)
+
+    def test_undo_and_redo_record_movements(self):
+        utils.create_log_entry(self.game, None)
+        utils.transfer_money(self.alice, self.bob, 20)
+        utils.create_log_entry(self.game, models.LogEntry.TRANSFER_MONEY,
+            acting=self.alice, receiving=self.bob, amount=20)
+        affected = utils.undo(self.game)
+        self.assertMatchesLedger(*affected['players'])
+        affected = utils.redo(self.game)
+        self.assertMatchesLedger(*affected['players'])
+        self.assertEqual(len(self.movements()), 3)
+
+    def test_balance_at_time(self):
+        utils.transfer_money(self.alice, self.bob, 20)
+        time = timezone.now()
+        utils.transfer_money(self.alice, self.bob, 10)
+        self.assertEqual(utils.balance(self.alice, time), 30)
+        self.assertEqual(utils.balance(self.alice), 20)
+
+    def test_balance_is_single_query(self):
+        with self.assertNumQueries(1):
+            utils.balance(self.company)
+
+    def test_finds_cash_that_does_not_match_ledger(self):
+        models.Player.objects.filter(pk=self.bob.pk).update(cash=7)
+        self.assertEqual(list(utils.ledger_mismatches()),
+            [(models.Player, self.bob.pk, 7, 50)])
+
+
+class MoveCashTransactionTests(TransactionTestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=50)
+
+    def test_missing_row_outside_transaction_changes_nothing(self):
+        self.bob.delete()
+        with self.assertRaises(models.Player.DoesNotExist):
+            utils.transfer_money(self.alice, self.bob, 20)
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.cash, 50)
+        self.assertEqual(utils.balance(self.alice), 50)
+
+    def test_transfer_outside_transaction_is_committed(self):
+        utils.transfer_money(self.alice, self.bob, 20)
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual((self.alice.cash, self.bob.cash), (30, 70))
+
+
+@override_settings(LOG_SNAPSHOT_INTERVAL=4)
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=100)
+        self.alice, self.bob = factories.PlayerFactory.create_batch(size=2,
+            game=self.game, cash=0)
+        self.company = factories.CompanyFactory(game=self.game, cash=0)
+        factories.PlayerShareFactory(owner=self.bob, company=self.company,
+            shares=2)
+        self.start = utils.create_log_entry(self.game, None, text='New game')
+        self.states = {}
+
+    def state(self):
+        """The current state of the game, read from the database"""
+        holdings = {}
+        for name, model in (('playershares', models.PlayerShare),
+                            ('companyshares', models.CompanyShare)):
+            holdings[name] = {}
+            for share in model.objects.filter(company__game=self.game):
+                holdings[name].setdefault(str(share.owner_id), {})[
+                    str(share.company_id)] = share.shares
+        return dict(holdings,
+            game={'cash': models.Game.objects.get(pk=self.game.pk).cash},
+            players={str(p.pk): {'cash': p.cash}
+                for p in models.Player.objects.filter(game=self.game)},
+            companies={str(c.pk): {'cash': c.cash, 'ipo_shares': c.ipo_shares,
+                'bank_shares': c.bank_shares}
+                for c in models.Company.objects.filter(game=self.game)})
+
+    def diff(self, before, after):
+        """The changes between two states"""
+        diff = {}
+        utils._add_deltas(diff, after)
+        utils._add_deltas(diff, before, -1)
+        return diff
+
+    def play(self, turns):
+        """Play some turns, remember the state at every entry"""
+        for i in range(turns):
+            utils.transfer_money(None, self.alice, 10)
+            entry = utils.create_log_entry(self.game,
+                models.LogEntry.TRANSFER_MONEY, acting=None,
+                receiving=self.alice, amount=10)
+            self.states[entry.pk] = self.state()
+            utils.buy_share(self.alice, self.company, utils.Share.IPO, 3)
+            entry = utils.create_log_entry(self.game,
+                models.LogEntry.TRANSFER_SHARE, buyer=self.alice,
+                source=utils.Share.IPO, company=self.company, shares=1,
+                price=3)
+            self.states[entry.pk] = self.state()
+            payments = utils.operate(self.company, 20,
+                utils.OperateMethod.FULL)
+            entry = utils.create_log_entry(self.game,
+                models.LogEntry.OPERATE, company=self.company, amount=20,
+                mode=models.LogEntry.FULL, payments=payments)
+            self.states[entry.pk] = self.state()
+
+    def test_entry_without_deltas_gets_snapshot(self):
+        self.assertEqual(self.start.snapshot.seq, self.start.seq)
+
+    def test_snapshot_is_stored_every_interval(self):
+        self.play(3)
+        self.assertEqual(list(models.LogSnapshot.objects.filter(
+            game=self.game).values_list('seq', flat=True).order_by('seq')),
+            [1, 4, 8])
+
+    def test_snapshot_contains_current_state(self):
+        entry = utils.create_log_entry(self.game, None, text='Snapshot')
+        self.assertEqual(entry.snapshot.state, self.state())
+
+    def test_state_at_matches_state_at_every_entry(self):
+        self.play(4)
+        for entry in self.game.log.exclude(pk=self.start.pk):
+            self.assertEqual(utils.state_at(entry), self.states[entry.pk])
+
+    def test_state_at_replays_at_most_interval(self):
+        self.play(10)
+        entry = self.game.log.get(seq=31)
+        with self.assertNumQueries(2):
+            state = utils.state_at(entry)
+        self.assertEqual(state, self.states[entry.pk])
+
+    def test_state_at_entry_on_redo_stack(self):
+        self.play(2)
+        entry = self.game.log_cursor
+        utils.undo(self.game)
+        utils.undo(self.game)
+        self.assertEqual(utils.state_at(entry), self.states[entry.pk])
+
+    def test_state_at_entry_without_snapshot_is_not_available(self):
+        entry = models.LogEntry.objects.create(game=factories.GameFactory())
+        with self.assertRaises(models.LogSnapshot.DoesNotExist):
+            utils.state_at(entry)
+
+    def test_state_after_entry_without_deltas_is_not_available(self):
+        entry = models.LogEntry.objects.create(game=self.game,
+            action=models.LogEntry.TRANSFER_MONEY, amount=5,
+            receiving_player=self.alice)
+        with self.assertRaises(models.LogSnapshot.DoesNotExist):
+            utils.state_at(entry)
+
+    def test_state_diff_is_difference_between_states(self):
+        self.play(4)
+        start = self.game.log.get(seq=3)
+        end = self.game.log.get(seq=11)
+        self.assertEqual(utils.state_diff(start, end),
+            self.diff(self.states[start.pk], self.states[end.pk]))
+
+    def test_state_diff_backwards_is_inverse(self):
+        self.play(2)
+        start = self.game.log.get(seq=2)
+        end = self.game.log_cursor
+        diff = utils.state_diff(end, start)
+        utils._add_deltas(diff, utils.state_diff(start, end))
+        self.assertEqual(diff, {})
+
+    def test_state_diff_only_contains_changes(self):
+        self.play(1)
+        start = self.game.log.get(seq=2)
+        end = self.game.log.get(seq=3)
+        self.assertEqual(utils.state_diff(start, end), {
+            'game': {'cash': 3},
+            'players': {str(self.alice.pk): {'cash': -3}},
+            'companies': {str(self.company.pk): {'ipo_shares': -1}},
+            'playershares': {str(self.alice.pk): {str(self.company.pk): 1}},
+        })
+
+    def test_state_diff_of_entry_with_itself_is_empty(self):
+        self.play(1)
+        entry = self.game.log_cursor
+        self.assertEqual(utils.state_diff(entry, entry), {})
+
+    def test_state_diff_over_entry_without_deltas(self):
+        self.play(1)
+        start = self.game.log.get(seq=2)
+        carol = factories.PlayerFactory(game=self.game, cash=0)
+        utils.transfer_money(None, carol, 25)
+        utils.create_log_entry(self.game, None, text='Added Carol')
+        self.play(1)
+        self.assertEqual(utils.state_diff(start, self.game.log_cursor),
+            self.diff(self.states[start.pk], self.state()))
+
+    def test_state_diff_reads_range_once(self):
+        self.play(10)
+        start = self.game.log.get(seq=2)
+        with self.assertNumQueries(1):
+            utils.state_diff(start, self.game.log_cursor)
+
+
+class ForkTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.alice = factories.PlayerFactory(game=self.game, name='Alice',
+            cash=100)
+        self.company = factories.CompanyFactory(game=self.game, name='B&O',
+            cash=50, share_count=10, ipo_shares=10)
+        self.start = utils.create_log_entry(self.game, None, text='New game')
+        self.buy_share()
+        self.middle = self.game.log_cursor
+        self.bob = factories.PlayerFactory(game=self.game, name='Bob', cash=0)
+        utils.create_log_entry(self.game, None, text='Added Bob')
+        self.buy_share()
+
+    def buy_share(self):
+        utils.buy_share(self.alice, self.company, utils.Share.IPO, 10)
+        utils.create_log_entry(self.game, models.LogEntry.TRANSFER_SHARE,
+            buyer=self.alice, source=utils.Share.IPO, company=self.company,
+            shares=1, price=10)
+
+    def test_fork_is_new_game(self):
+        fork = utils.fork(self.game)
+        self.assertNotEqual(fork.pk, self.game.pk)
+        self.assertEqual(fork.cash, 1020)
+        self.assertEqual(models.Game.objects.count(), 2)
+
+    def test_fork_copies_players_and_companies(self):
+        fork = utils.fork(self.game)
+        self.assertCountEqual(fork.players.values_list('name', 'cash'),
+            [('Alice', 80), ('Bob', 0)])
+        company = fork.companies.get()
+        self.assertNotEqual(company.pk, self.company.pk)
+        self.assertEqual((company.name, company.cash, company.ipo_shares),
+            ('B&O', 50, 8))
+
+    def test_fork_copies_holdings(self):
+        fork = utils.fork(self.game)
+        share = models.PlayerShare.objects.get(company__game=fork)
+        self.assertEqual(share.owner, fork.players.get(name='Alice'))
+        self.assertEqual(share.company, fork.companies.get())
+        self.assertEqual(share.shares, 2)
+
+    def test_fork_does_not_change_game(self):
+        utils.fork(self.game)
+        self.assertEqual(self.game.players.count(), 2)
+        self.assertEqual(self.game.log.count(), 4)
+        self.assertEqual(models.PlayerShare.objects.get(
+            owner=self.alice).shares, 2)
+
+    def test_fork_copies_log(self):
+        fork = utils.fork(self.game)
+        self.assertEqual(list(fork.log.values_list('seq', 'text')),
+            list(self.game.log.values_list('seq', 'text')))
+        self.assertEqual(fork.log_cursor.seq, 4)
+        self.assertEqual(fork.log_cursor.game, fork)
+
+    def test_fork_remaps_log_references(self):
+        fork = utils.fork(self.game)
+        entry = fork.log_cursor
+        self.assertEqual(entry.player_buyer, fork.players.get(name='Alice'))
+        self.assertEqual(entry.company, fork.companies.get())
+
+    def test_fork_at_entry_has_state_of_entry(self):
+        fork = utils.fork(self.game, self.middle)
+        self.assertEqual(fork.cash, 1010)
+        self.assertEqual(list(fork.players.values_list('name', 'cash')),
+            [('Alice', 90)])
+        self.assertEqual(fork.companies.get().ipo_shares, 9)
+        self.assertEqual(models.PlayerShare.objects.get(
+            company__game=fork).shares, 1)
+        self.assertEqual(fork.log.count(), 2)
+        self.assertEqual(fork.log_cursor.seq, self.middle.seq)
+
+    def test_fork_can_be_undone(self):
+        fork = utils.fork(self.game, self.middle)
+        utils.undo(fork)
+        fork.refresh_from_db()
+        self.assertEqual(fork.cash, 1000)
+        self.assertEqual(fork.players.get().cash, 100)
+        self.assertEqual(fork.companies.get().ipo_shares, 10)
+        self.assertEqual(fork.log_cursor.seq, self.start.seq)
+
+    def test_state_diff_of_fork(self):
+        fork = utils.fork(self.game)
+        alice = str(fork.players.get(name='Alice').pk)
+        company = str(fork.companies.get().pk)
+        diff = utils.state_diff(fork.log.get(seq=1), fork.log_cursor)
+        self.assertEqual(diff, {
+            'game': {'cash': 20},
+            'players': {alice: {'cash': -20}},
+            'companies': {company: {'ipo_shares': -2}},
+            'playershares': {alice: {company: 2}},
+        })
+
+    def test_fork_ledger_matches_cash(self):
+        fork = utils.fork(self.game, self.middle)
+        self.assertEqual(list(utils.ledger_mismatches()), [])
+        self.assertEqual(utils.balance(fork), 1010)
+
+    def test_fork_of_game_without_log(self):
+        game = factories.GameFactory(cash=10)
+        factories.PlayerFactory(game=game)
+        fork = utils.fork(game)
+        self.assertIsNone(fork.log_cursor)
+        self.assertEqual(fork.players.count(), 1)
+
+    def test_query_count_does_not_depend_on_log_length(self):
+        with self.assertNumQueries(11):
+            utils.fork(self.game, self.middle)
+        for i in range(8):
+            self.buy_share()
+        with self.assertNumQueries(11):
+            utils.fork(self.game, self.middle)
+
+
+@override_settings(LOG_SNAPSHOT_INTERVAL=3)
+class VerifyLogTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000, pool_shares_pay=True)
+        self.alice = factories.PlayerFactory(game=self.game, cash=100)
+        self.company = factories.CompanyFactory(game=self.game, cash=50,
+            share_count=10, ipo_shares=10)
+        utils.create_log_entry(self.game, None, text='New game')
+
+        utils.transfer_money(self.alice, self.company, 10)
+        utils.create_log_entry(self.game, models.LogEntry.TRANSFER_MONEY,
+            acting=self.alice, receiving=self.company, amount=10)
+        utils.buy_share(self.alice, self.company, utils.Share.IPO, 10, 3)
+        utils.create_log_entry(self.game, models.LogEntry.TRANSFER_SHARE,
+            buyer=self.alice, source=utils.Share.IPO, company=self.company,
+            shares=3, price=10)
+        payments = utils.operate(self.company, 25, utils.OperateMethod.HALF)
+        utils.create_log_entry(self.game, models.LogEntry.OPERATE,
+            company=self.company, amount=25, mode=models.LogEntry.HALF,
+            payments=payments)
+        utils.transfer_money(None, self.alice, 5)
+        utils.create_log_entry(self.game, models.LogEntry.TRANSFER_MONEY,
+            acting=None, receiving=self.alice, amount=5)
+
+    def test_log_matches_stored_state(self):
+        self.assertEqual(list(utils.verify_log(self.game)), [])
+
+    def test_reports_lost_update(self):
+        self.alice.refresh_from_db()
+        models.Player.objects.filter(pk=self.alice.pk).update(
+            cash=self.alice.cash - 5)
+        self.assertEqual(list(utils.verify_log(self.game)),
+            [(None, 'players', str(self.alice.pk), 'cash', self.alice.cash,
+              self.alice.cash - 5)])
+
+    def test_reports_half_applied_action(self):
+        models.PlayerShare.objects.filter(owner=self.alice).update(shares=2)
+        self.assertEqual(list(utils.verify_log(self.game)),
+            [(None, 'playershares', str(self.alice.pk), str(self.company.pk),
+              3, 2)])
+
+    def test_reports_drift_in_snapshot(self):
+        snapshot = models.LogSnapshot.objects.get(seq=3)
+        snapshot.state['game']['cash'] += 1
+        snapshot.save()
+        self.assertEqual(list(utils.verify_log(self.game)),
+            [(3, 'game', '', 'cash', 1030, 1031)])
+
+    def test_replays_entries_without_deltas(self):
+        for entry in self.game.log.all():
+            entry.deltas = None
+            entry.save()
+        models.LogSnapshot.objects.exclude(seq=1).delete()
+        self.assertEqual(list(utils.verify_log(self.game)), [])
+        models.Company.objects.filter(pk=self.company.pk).update(
+            bank_shares=1)
+        self.assertEqual(len(list(utils.verify_log(self.game))), 1)
+
+    def test_ignores_entries_after_log_cursor(self):
+        utils.undo(self.game)
+        self.assertEqual(list(utils.verify_log(self.game)), [])
+
+    def test_game_without_snapshot_is_not_verified(self):
+        game = factories.GameFactory()
+        models.LogEntry.objects.create(game=game, text='Legacy')
+        self.assertEqual(list(utils.verify_log(game)), [])
+
+    def test_query_count_does_not_depend_on_log_length(self):
+        with self.assertNumQueries(3):
+            list(utils.verify_log(self.game))
+        for i in range(10):
+            utils.transfer_money(None, self.alice, 1)
+            utils.create_log_entry(self.game, models.LogEntry.TRANSFER_MONEY,
+                acting=None, receiving=self.alice, amount=1)
+        with self.assertNumQueries(3):
+            list(utils.verify_log(self.game))
+
+
+@override_settings(LOG_SNAPSHOT_INTERVAL=4)
+class CompactLogTests(TestCase):
+    def setUp(self):
+        self.game = factories.GameFactory(cash=1000)
+        self.alice = factories.PlayerFactory(game=self.game, cash=0)
+        self.start = utils.create_log_entry(self.game, None, text='New game')
+        self.entries = [self.pay(i) for i in range(1, 11)]
+
+    def pay(self, amount):
+        utils.transfer_money(None, self.alice, amount)
+        return utils.create_log_entry(self.game,
+            models.LogEntry.TRANSFER_MONEY, acting=None, receiving=self.alice,
+            amount=amount, text='Paid {}'.format(amount))
+
+    def test_folds_entries_into_checkpoint(self):
+        deleted = utils.compact_log(self.game, self.entries[5])
+        self.assertEqual(deleted, 6)
+        self.assertEqual(list(self.game.log.values_list('seq', flat=True)),
+            [7, 8, 9, 10, 11])
+        checkpoint = self.game.log.first()
+        self.assertEqual(checkpoint, self.entries[5])
+        self.assertFalse(checkpoint.is_undoable)
+        self.assertEqual(checkpoint.payload, {})
+
+    def test_checkpoint_has_state(self):
+        utils.compact_log(self.game, self.entries[6])
+        checkpoint = self.game.log.first()
+        self.assertEqual(checkpoint.snapshot.state['players'],
+            {str(self.alice.pk): {'cash': 28}})
+        self.assertEqual(models.LogSnapshot.objects.filter(
+            game=self.game).count(), 1)
+
+    def test_undo_stops_at_checkpoint(self):
+        utils.compact_log(self.game, self.entries[7])
+        utils.undo(self.game)
+        utils.undo(self.game)
+        self.game.refresh_from_db()
+        self.alice.refresh_from_db()
+        self.assertEqual(self.game.log_cursor, self.entries[7])
+        self.assertFalse(self.game.log_cursor.is_undoable)
+        self.assertEqual(self.alice.cash, 36)
+
+    def test_state_after_checkpoint_is_kept(self):
+        utils.compact_log(self.game, self.entries[5])
+        self.assertEqual(utils.state_at(self.entries[8])['players'],
+            {str(self.alice.pk): {'cash': 45}})
+        self.assertEqual(list(utils.verify_log(self.game)), [])
+
+    def test_text_is_dropped_by_default(self):
+        utils.compact_log(self.game, self.entries[5])
+        self.assertIsNone(self.entries[5].snapshot.history)
+        self.assertEqual(self.entries[5].snapshot.history_entries(), [])
+
+    def test_keeps_text_compressed(self):
+        utils.compact_log(self.game, self.entries[2], keep_text=True)
+        history = models.LogSnapshot.objects.get(
+            entry=self.entries[2]).history_entries()
+        self.assertEqual([(seq, text) for seq, time, text in history],
+            [(1, 'New game'), (2, 'Paid 1'), (3, 'Paid 2'), (4, 'Paid 3')])
+
+    def test_compacting_again_keeps_earlier_text(self):
+        utils.compact_log(self.game, self.entries[2], keep_text=True)
+        utils.compact_log(self.game, self.entries[4], keep_text=True)
+        history = models.LogSnapshot.objects.get(
+            entry=self.entries[4]).history_entries()
+        self.assertEqual([seq for seq, time, text in history],
+            [1, 2, 3, 4, 5, 6])
+
+    def test_cannot_compact_redo_stack(self):
+        utils.undo(self.game)
+        with self.assertRaises(utils.InvalidCheckpoint):
+            utils.compact_log(self.game, self.entries[-1])
+        self.assertEqual(self.game.log.count(), 11)
+
+    @override_settings(LOG_COMPACT_THRESHOLD=10, LOG_COMPACT_KEEP=3)
+    def test_compacts_automatically_past_threshold(self):
+        for i in range(5):
+            self.pay(1)
+        # Checked at every snapshot, at seq 12 the log is compacted up to
+        # the last snapshot that leaves 3 entries
+        self.assertEqual(self.game.log.first().seq, 8)
+        self.assertFalse(self.game.log.first().is_undoable)
+        self.assertEqual(self.game.log.count(), 9)
+        self.assertEqual(list(utils.verify_log(self.game)), [])
+
+    @override_settings(LOG_COMPACT_THRESHOLD=20, LOG_COMPACT_KEEP=3)
+    def test_does_not_compact_below_threshold(self):
+        for i in range(5):
+            self.pay(1)
+        self.assertEqual(self.game.log.count(), 16)
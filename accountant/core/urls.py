@@ -24,6 +24,8 @@ router.add_api_view('colors', url(r'^colors/$', views.ColorsView.as_view(),
     name='colors'))
 router.add_api_view('undo', url(r'^undo/$', views.UndoRedoView.as_view(),
     name='undo'))
+router.add_api_view('jump', url(r'^jump/$', views.JumpView.as_view(),
+    name='jump'))
 
 urlpatterns = [
     url(r'^', include(router.urls)),
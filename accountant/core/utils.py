@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min, Prefetch, Subquery, Sum, \
+    prefetch_related_objects
+from django.utils import timezone
 from enum import Enum
+import datetime
+import functools
+import hashlib
+import json
 import math
+import uuid
+import zlib
 from . import models
 
 class SameEntityError(Exception):
@@ -15,6 +26,14 @@ class DifferentGameException(InvalidShareTransaction):
     pass
 
 
+class InvalidCheckpoint(Exception):
+    pass
+
+
+class NotUndoable(Exception):
+    pass
+
+
 class Share(Enum):
     IPO = 1
     BANK = 2
@@ -26,6 +45,15 @@ class OperateMethod(Enum):
     HALF = 3
 
 
+def add_cash(entity, amount):
+    """
+    Add amount to the cash of a game (the bank), player or company. The
+    cash comes from outside the game, this is recorded in the ledger.
+    Returns the new balance.
+    """
+    _move_cash([(entity, amount), (None, -amount)])
+    return entity.cash
+
 def transfer_money(sender, receiver, amount):
     if sender == receiver:
         raise SameEntityError()
@@ -33,140 +61,383 @@ def transfer_money(sender, receiver, amount):
         sender = receiver.game
     if receiver is None:
         receiver = sender.game
-    sender.cash -= amount
-    receiver.cash += amount
-    sender.save()
-    receiver.save()
+    _move_cash([(sender, -amount), (receiver, amount)])
 
-def buy_share(buyer, company, source, price, amount=1):
-    # Check if shares are available
-    if source == Share.IPO and company.ipo_shares < amount:
-        raise InvalidShareTransaction()
-    elif source == Share.BANK and company.bank_shares < amount:
-        raise InvalidShareTransaction()
+def _move_cash(legs):
+    """
+    Add cash to every (entity, amount) in legs and record the movement in
+    the ledger, all in a single statement. The amounts must add up to 0, an
+    entity of None is outside the game. The changes are done by the
+    database so concurrent changes to the same row are never lost, the new
+    balances are stored on the instances. Raises DoesNotExist when the row
+    of an entity is missing, the other legs are then rolled back with the
+    transaction, which is started here when there is none yet.
+    """
+    legs = [(entity, _round_cash(amount)) for entity, amount in legs]
+    ctes = []
+    params = []
+    entities = [entity for entity, amount in legs if entity != None]
+    for i, (entity, amount) in enumerate(legs):
+        if entity == None:
+            continue
+        opts = entity._meta
+        ctes.append('leg{} AS (UPDATE {} SET cash = cash + %s WHERE {} = %s '
+            'RETURNING cash)'.format(i, connection.ops.quote_name(
+                opts.db_table), connection.ops.quote_name(opts.pk.column)))
+        params += [amount, entity.pk]
+    # Only record the movement if every row exists
+    sql, ledger_params = _ledger_insert(_game_id(entities[0]), legs)
+    if sql:
+        ctes.append('ledger AS ({} WHERE {})'.format(sql, ' AND '.join(
+            'EXISTS (SELECT 1 FROM leg{})'.format(i)
+            for i, (entity, amount) in enumerate(legs) if entity != None)))
+        params += ledger_params
+    # Without a savepoint an outer transaction has to be rolled back too, so
+    # the legs that were applied can never be committed
+    with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+        cursor.execute('WITH {} SELECT {}'.format(', '.join(ctes), ', '.join(
+            '(SELECT cash FROM leg{})'.format(i)
+            for i, (entity, amount) in enumerate(legs) if entity != None)),
+            params)
+        row = cursor.fetchone()
+        for entity, cash in zip(entities, row):
+            if cash == None:
+                raise entity.DoesNotExist()
+    for entity, cash in zip(entities, row):
+        entity.cash = cash
 
-    if isinstance(source, models.Company):  # Share comes from a company
-        try:
-            source_share = models.CompanyShare.objects.get(owner=source,
-                company=company)
-        except models.CompanyShare.DoesNotExist:
-            if amount < 0:
-                source_share = models.CompanyShare.objects.create(
-                    owner=source, company=company, shares=0)
-            else:
-                raise InvalidShareTransaction()
-        if source_share.shares < amount:
-            raise InvalidShareTransaction()
-    elif isinstance(source, models.Player):  # Share comes from a player
-        try:
-            source_share = models.PlayerShare.objects.get(owner=source,
-                company=company)
-        except models.PlayerShare.DoesNotExist:
-            source_share = models.PlayerShare.objects.create(owner=source,
-                company=company, shares=0)
-    else:
-        source_share = None
+def _ledger_insert(game_id, legs):
+    """
+    Build a query that records the movement of cash in legs in the ledger,
+    legs is a list of (entity, amount) where None is outside the game.
+    Amounts are rounded with _round_cash, cash lost to rounding is taken
+    from outside the game. Returns the query and its parameters,
+    or None if no cash moves.
+    """
+    amounts = {}
+    for entity, amount in legs:
+        key = entity.pk if entity != None else None
+        amounts[key] = amounts.get(key, 0) + _round_cash(amount)
+    remainder = sum(amounts.values())
+    if remainder:
+        amounts[None] = amounts.get(None, 0) - remainder
+    rows = [(account, amount) for account, amount in amounts.items()
+        if amount != 0]
+    if not rows:
+        return None, []
+    movement = models.time_uuid()
+    time = timezone.now()
+    params = []
+    for account, amount in rows:
+        params += [models.time_uuid(), game_id, movement, account, amount,
+            time]
+    sql = 'INSERT INTO {} (uuid, game_id, movement, account, amount, time) ' \
+        'SELECT * FROM (VALUES {}) AS v'.format(
+            connection.ops.quote_name(models.LedgerEntry._meta.db_table),
+            ', '.join(['(%s, %s, %s, %s::uuid, %s, %s)'] * len(rows)))
+    return sql, params
 
+def balance(account, time=None):
+    """
+    Return the balance of a game (the bank), player or company in the
+    ledger, or what it was at time when given.
+    """
+    entries = models.LedgerEntry.objects.filter(account=account.pk)
+    if time != None:
+        entries = entries.filter(time__lte=time)
+    return entries.aggregate(balance=Sum('amount'))['balance'] or 0
+
+def ledger_mismatches():
+    """
+    Compare the cash of every game, player and company with its balance in
+    the ledger. The ledger is read once and the results are streamed from
+    the database. Yields (model, pk, cash, balance) for every mismatch.
+    """
+    tables = (models.Game, models.Player, models.Company)
+    quote = connection.ops.quote_name
+    selects = ['SELECT {i}, {table}.{pk}, {table}.cash, COALESCE(balance, 0) '
+        'FROM {table} LEFT JOIN balances ON account = {table}.{pk} '
+        'WHERE {table}.cash <> COALESCE(balance, 0)'.format(i=i,
+            table=quote(model._meta.db_table),
+            pk=quote(model._meta.pk.column))
+        for i, model in enumerate(tables)]
+    with connection.chunked_cursor() as cursor:
+        cursor.execute('WITH balances AS (SELECT account, SUM(amount) AS '
+            'balance FROM {} GROUP BY account) {}'.format(
+                quote(models.LedgerEntry._meta.db_table),
+                ' UNION ALL '.join(selects)))
+        for i, pk, cash, balance in cursor:
+            yield tables[i], pk, cash, balance
+
+def _game_id(entity):
+    if isinstance(entity, models.Game):
+        return entity.pk
+    return entity.game_id
+
+def _round_cash(amount):
+    """
+    Round amount to whole cash with halves away from zero. Cash is always
+    rounded here before it is sent to the database, which would otherwise
+    round halves to even, so balances, the ledger and the log agree.
+    """
+    return int(math.copysign(math.floor(abs(amount) + 0.5), amount))
+
+def buy_share(buyer, company, source, price, amount=1):
+    """
+    Move amount shares of company from source to buyer for price each.
+    Buyer and source can be a player, a company, the IPO or the bank pool.
+    Shares are moved with conditional updates so that a source never sells
+    shares it does not have, and holdings are created when needed. Returns
+    the holdings of the buyer and source that were changed.
+    """
     # Check if the buyer, company and source are in the same game
-    if source not in Share and source.game != company.game:
+    if source not in Share and source.game_id != company.game_id:
         raise DifferentGameException()
-    if buyer not in Share and buyer.game != company.game:
+    if buyer not in Share and buyer.game_id != company.game_id:
         raise DifferentGameException()
 
-    # Buy the shares
+    # Take the shares from the source, this fails if it doesn't have enough.
+    # Players are allowed to short sell, companies are not.
+    holdings = []
+    if source not in Share:
+        holdings.append(_change_holding(source, company, -amount,
+            required=isinstance(source, models.Company)))
+    ipo = bank = 0
+    if source == Share.IPO:
+        ipo -= amount
+    elif source == Share.BANK:
+        bank -= amount
     if buyer == Share.IPO:
-        company.ipo_shares += amount
-        company.save()
+        ipo += amount
     elif buyer == Share.BANK:
-        company.bank_shares += amount
-        company.save()
-    else:  # Comes from company or player
-        # Create share object if necessary
-        try:
-            share = buyer.share_set.get(company=company)
-        except models.PlayerShare.DoesNotExist:
-            share = models.PlayerShare.objects.create(owner=buyer,
-                company=company, shares=0)
-        except models.CompanyShare.DoesNotExist:
-            share = models.CompanyShare.objects.create(owner=buyer,
-                company=company, shares=0)
-        share.shares += amount
-        share.save()
-
-    # Remove the share from the source
-    if source_share:
-        source_share.shares -= amount
-        source_share.save()
-    elif source == Share.IPO:
-        company.ipo_shares -= amount
-        company.save()
-    elif source == Share.BANK:
-        company.bank_shares -= amount
-        company.save()
+        bank += amount
+    if source in Share or buyer in Share:
+        _change_pool_shares(company, ipo, bank,
+            source if source in Share else None, amount)
 
-    # Update buyer instance if company is buying in itself
-    if isinstance(buyer, models.Company) and company.pk == buyer.pk:
-        buyer.refresh_from_db()
-    # Update source instance if company is selling itself
-    if isinstance(source, models.Company) and company.pk == source.pk:
-        source.refresh_from_db()
+    # Give the shares to the buyer
+    if buyer not in Share:
+        holdings.insert(0, _change_holding(buyer, company, amount))
 
-    # Transfer the money
+    # Transfer the money, when the company trades in its own shares the
+    # money is moved through the company instance so it sees the new balance
+    copies = [e for e in (buyer, source)
+        if e == company and e is not company]
+    if buyer in Share or source in Share:
+        # Let everyone share one game instance so that the new balance of
+        # the bank is visible through all of them
+        for entity in (buyer, source):
+            if entity not in Share:
+                entity.game = company.game
     if buyer in (Share.BANK, Share.IPO):
         buyer = None
+    elif buyer == company:
+        buyer = company
     if source in (Share.BANK, Share.IPO):
-        transfer_money(buyer, None, price * amount)
+        source = None
+    elif source == company:
+        source = company
+    transfer_money(buyer, source, price * amount)
+
+    # Bring other copies of the company up to date without reading them back
+    for copy in copies:
+        copy.cash = company.cash
+        copy.ipo_shares = company.ipo_shares
+        copy.bank_shares = company.bank_shares
+    return holdings
+
+def _change_pool_shares(company, ipo, bank, source=None, amount=0):
+    """
+    Add shares to the IPO and bank pool of company in a single UPDATE. When
+    source is Share.IPO or Share.BANK that pool must hold at least amount
+    shares, otherwise nothing is changed and InvalidShareTransaction is
+    raised. The new pool sizes are stored on the instance.
+    """
+    sql = 'UPDATE {table} SET ipo_shares = ipo_shares + %s, ' \
+        'bank_shares = bank_shares + %s WHERE {pk} = %s'
+    params = [ipo, bank, company.pk]
+    if source == Share.IPO:
+        sql += ' AND ipo_shares >= %s'
+        params.append(amount)
+    elif source == Share.BANK:
+        sql += ' AND bank_shares >= %s'
+        params.append(amount)
+    sql += ' RETURNING ipo_shares, bank_shares'
+    row = _execute_returning(models.Company, sql, params)
+    if row is None:
+        raise InvalidShareTransaction()
+    company.ipo_shares, company.bank_shares = row
+
+
+HOLDING_OWNER_SQL = 'COALESCE(player_id, owner_company_id)'
+
+def _change_holding(owner, company, amount, required=False):
+    """
+    Add amount shares of company to the holding of owner, creating the
+    holding if it doesn't exist yet. Normally the holding may go negative
+    (short selling), when required is set the owner must have the shares it
+    gives away. Returns the changed holding.
+    """
+    if isinstance(owner, models.Player):
+        model, column = models.PlayerShare, 'player_id'
     else:
-        transfer_money(buyer, source, price * amount)
+        model, column = models.CompanyShare, 'owner_company_id'
+    # Holdings are changed in the holdings table itself, so every lookup is
+    # answered by its unique index on the company and the owner
+    sql = 'UPDATE {table} SET shares = shares + %s ' \
+        'WHERE company_id = %s AND ' + HOLDING_OWNER_SQL + ' = %s'
+    params = [amount, company.pk, owner.pk]
+    if required:
+        sql += ' AND shares + %s >= 0'
+        params.append(amount)
+    row = _execute_returning(models.Holding,
+        sql + ' RETURNING {pk}, shares', params)
+    if row is None and (not required or amount > 0):
+        # There is no holding yet, only create it if nobody beat us to it
+        row = _execute_returning(models.Holding,
+            'INSERT INTO {table} ({pk}, company_id, ' + column + ', '
+            'game_id, shares) SELECT %s, %s, %s, %s, %s WHERE NOT EXISTS '
+            '(SELECT 1 FROM {table} WHERE company_id = %s AND ' +
+            HOLDING_OWNER_SQL + ' = %s) RETURNING {pk}, shares',
+            [model._meta.pk.get_default(), company.pk, owner.pk,
+             company.game_id, amount, company.pk, owner.pk])
+    if row is None:
+        raise InvalidShareTransaction()
+    holding = model.from_db(connection.alias,
+        ['uuid', 'owner_id', 'company_id', 'shares', 'game_id'],
+        [row[0], owner.pk, company.pk, row[1], company.game_id])
+    holding.owner = owner
+    holding.company = company
+    return holding
 
-    # Refresh company to get changes is cash
-    company.refresh_from_db()
+def _execute_returning(model, sql, params):
+    """
+    Execute a statement with a RETURNING clause on the table of model and
+    return the first row. {table} and {pk} in sql are replaced by the
+    quoted table and primary key names.
+    """
+    opts = model._meta
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(
+            table=connection.ops.quote_name(opts.db_table),
+            pk=connection.ops.quote_name(opts.pk.column)), params)
+        return cursor.fetchone()
 
 def operate(company, amount, method):
+    affected = _operate_payments(company, amount, method,
+        functools.partial(_distribute_dividends, company))
+
+    # Pay actual dividends
+    if affected:
+        pay_from_bank(company.game, affected)
+    return affected
+
+def _operate_payments(company, amount, method, dividends):
+    """
+    Determine what company and its share holders are paid when it operates
+    for amount, dividends(amount) returns what every holder receives when
+    amount is paid out.
+    """
     affected = {}
     if method == OperateMethod.WITHHOLD:
         affected[company] = amount
     elif method == OperateMethod.HALF:
         withhold = amount / 2
         distribute = amount / 2
-        affected = _distribute_dividends(company, distribute)
+        affected = dividends(distribute)
         # If not every entity receives an integer amount then we have to
         # round in favour of the share holders
         if not all(d.is_integer() for e, d in affected.items()):
             distribute = math.ceil(distribute / company.share_count)
             distribute *= company.share_count
             withhold = amount - distribute
-            affected = _distribute_dividends(company, distribute)
+            affected = dividends(distribute)
         if company not in affected:
             affected[company] = 0
         affected[company] += withhold
     elif method == OperateMethod.FULL:
-        affected = _distribute_dividends(company, amount)
+        affected = dividends(amount)
         # If some entities don't receive an integer amount then we have to
         # get rid of the remainder
         if not all(d.is_integer() for e, d in affected.items()):
             for entity in affected:
                 affected[entity] = math.floor(affected[entity])
-
-    # Pay actual dividends
-    for entity, amount in affected.items():
-        transfer_money(None, entity, amount)
     return affected
 
+def pay_from_bank(game, payments):
+    """
+    Pay every player and company in payments the amount it maps to and take
+    the total from the bank of game. All balances are changed and recorded
+    in the ledger by a single statement, the new balances are stored on the
+    instances.
+    """
+    payments = {entity: _round_cash(amount)
+        for entity, amount in payments.items()}
+    groups = (('players', models.Player), ('companies', models.Company))
+    instances = {('game', game.pk): game}
+    names = []
+    ctes = []
+    params = []
+    for name, model in groups:
+        rows = [(e, a) for e, a in payments.items() if isinstance(e, model)]
+        if not rows:
+            continue
+        table = connection.ops.quote_name(model._meta.db_table)
+        pk = connection.ops.quote_name(model._meta.pk.column)
+        names.append(name)
+        ctes.append(
+            '{name} AS (UPDATE {table} SET cash = {table}.cash + v.amount '
+            'FROM (VALUES {values}) AS v (pk, amount) '
+            'WHERE {table}.{pk} = v.pk RETURNING {table}.{pk}, {table}.cash)'
+            .format(name=name, table=table, pk=pk,
+                    values=', '.join(['(%s, %s)'] * len(rows))))
+        for entity, amount in rows:
+            instances[(name, entity.pk)] = entity
+            params += [entity.pk, amount]
+    ctes.append('game AS (UPDATE {table} SET cash = cash - %s '
+        'WHERE {pk} = %s RETURNING {pk}, cash)'.format(
+            table=connection.ops.quote_name(models.Game._meta.db_table),
+            pk=connection.ops.quote_name(models.Game._meta.pk.column)))
+    params += [sum(payments.values()), game.pk]
+    sql, ledger_params = _ledger_insert(game.pk,
+        list(payments.items()) + [(game, -sum(payments.values()))])
+    if sql:
+        ctes.append('ledger AS ({})'.format(sql))
+        params += ledger_params
+    names.append('game')
+    selects = ["SELECT '{0}', * FROM {0}".format(name) for name in names]
+    with connection.cursor() as cursor:
+        cursor.execute('WITH {} {}'.format(', '.join(ctes),
+            ' UNION ALL '.join(selects)), params)
+        for name, pk, cash in cursor.fetchall():
+            instances[(name, pk)].cash = cash
+
+def _prefetch_holders(company):
+    """
+    Load everyone that owns shares in company with a single query on the
+    holdings table. Calling this again on the same instance does not query
+    again.
+    """
+    prefetch_related_objects([company], Prefetch('holdings',
+        queryset=models.Holding.objects.select_related('player',
+            'owner_company')))
+    # A company owning its own shares should be the same instance
+    for holding in company.holdings.all():
+        if holding.owner_company_id == company.pk:
+            holding.owner_company = company
+
 def _distribute_dividends(company, amount):
     result = {}
+    _prefetch_holders(company)
     dividends_per_share = amount / company.share_count
-    # Calculate dividends paid to players
-    for share in company.playershare_set.all():
-        dividend = dividends_per_share * share.shares
+    for holding in company.holdings.all():
+        # Shares held by companies only pay when the game says so
+        if holding.player_id == None and \
+                not company.game.treasury_shares_pay:
+            continue
+        dividend = dividends_per_share * holding.shares
         if dividend != 0:
-            result[share.owner] = dividend
-    # Calculate dividends paid to companies
-    if company.game.treasury_shares_pay:
-        for share in company.companyshare_set.all():
-            dividend = dividends_per_share  * share.shares
-            if dividend != 0:
-                result[share.owner] = dividend
+            result[holding.owner] = dividend
     # Calculate dividends paid by pool shares to the owning company
     if company.game.pool_shares_pay and company.bank_shares != 0:
         dividend = dividends_per_share * company.bank_shares
@@ -185,13 +456,120 @@ def _distribute_dividends(company, amount):
                 result[company] = dividend
     return result
 
+class IdentityMap(object):
+    """
+    Keeps a single instance of every row that is loaded while handling a
+    request, so each row is fetched at most once and every part of the
+    request works on the same state. Instances that belong to the locked
+    game share its instance, which keeps the cash in the bank consistent.
+    """
+    def __init__(self):
+        self.game = None
+        self._instances = {}
+
+    def __iter__(self):
+        return iter(list(self._instances.values()))
+
+    def get(self, model, pk):
+        """Return the instance of model with pk, loading it if needed."""
+        pk = model._meta.pk.to_python(pk)
+        try:
+            return self._instances[model, pk]
+        except KeyError:
+            return self.add(model.objects.get(pk=pk))
+
+    def add(self, instance):
+        """
+        Add instance to the map and return it, if the row has been loaded
+        before the instance that is already in the map is returned instead.
+        """
+        instance = self._instances.setdefault((type(instance), instance.pk),
+            instance)
+        self._bind_game(instance)
+        return instance
+
+    def lock_game(self, pk):
+        """
+        Load the game with pk and lock its row until the end of the current
+        transaction so that actions on the same game are applied one after
+        another. Every action takes exactly this one lock, so they can not
+        deadlock, while actions on different games still run in parallel.
+        If the game was already loaded that instance is updated with the
+        state left behind by the previous action, and so are the other rows
+        of the game that were loaded before it was locked.
+        """
+        pk = models.Game._meta.pk.to_python(pk)
+        locked = models.Game.objects.select_for_update().get(pk=pk)
+        game = self.add(locked)
+        if game is not locked:
+            self._copy_fields(locked, game)
+            # Forget the cached log cursor if another action has moved it
+            cache_name = models.Game.log_cursor.field.get_cache_name()
+            cursor = getattr(game, cache_name, None)
+            if getattr(cursor, 'pk', None) != game.log_cursor_id:
+                game.__dict__.pop(cache_name, None)
+        self.game = game
+        self._reload([instance for instance in self
+            if getattr(instance, 'game_id', None) == pk])
+        for instance in self:
+            self._bind_game(instance)
+        return game
+
+    def _reload(self, instances):
+        """
+        Read instances from the database again, with one query per model,
+        as another action may have changed them before the game was locked.
+        """
+        stale = {}
+        for instance in instances:
+            stale.setdefault(type(instance), []).append(instance)
+        for model, instances in stale.items():
+            found = model.objects.in_bulk([i.pk for i in instances])
+            for instance in instances:
+                if instance.pk not in found:
+                    raise model.DoesNotExist()
+                self._copy_fields(found[instance.pk], instance)
+                instance.__dict__.pop('_prefetched_objects_cache', None)
+
+    def _copy_fields(self, source, target):
+        for field in target._meta.concrete_fields:
+            setattr(target, field.attname, getattr(source, field.attname))
+
+    def _bind_game(self, instance):
+        if self.game != None and \
+                getattr(instance, 'game_id', None) == self.game.pk:
+            instance.game = self.game
+
+def idempotency_key_expiry():
+    """Idempotency keys stored before this time have expired."""
+    return timezone.now() - datetime.timedelta(
+        seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+def get_log_cursor(game):
+    """
+    The entry at the log cursor of game. It is looked up by its game as
+    well as its primary key, so a log that is partitioned by game only
+    searches one partition. The entry is cached on game like
+    game.log_cursor does.
+    """
+    if game.log_cursor_id == None:
+        return None
+    cache_name = models.Game.log_cursor.field.get_cache_name()
+    cursor = getattr(game, cache_name, None)
+    if getattr(cursor, 'pk', None) != game.log_cursor_id:
+        cursor = game.log.get(pk=game.log_cursor_id)
+        setattr(game, cache_name, cursor)
+    return cursor
+
 def create_log_entry(game, action, **kwargs):
     # Delete all entries that are on the redo stack
-    if game.log_cursor:
-        game.log.filter(time__gt=game.log_cursor.time).delete()
+    cursor = get_log_cursor(game)
+    if cursor:
+        game.log.filter(seq__gt=cursor.seq).delete()
 
-    # Create new entry
-    entry = models.LogEntry.objects.create(game=game, action=action)
+    # Create new entry, it directly follows the cursor
+    entry = models.LogEntry(game=game, action=action,
+        seq=cursor.seq + 1 if cursor else None)
     if action == models.LogEntry.TRANSFER_MONEY:
         entry.amount = kwargs['amount']
         if isinstance(kwargs['acting'], models.Player):
@@ -232,47 +610,678 @@ def create_log_entry(game, action, **kwargs):
         entry.text = kwargs['text']
     if 'acting_company' in kwargs.keys():
         entry.acting_company = kwargs['acting_company']
-    entry.save()
+    entry.deltas = _action_deltas(action, **kwargs)
+    entry.save(force_insert=True)
+    # Replaying can't go past entries without deltas, so they always get a
+    # snapshot
+    if entry.deltas == None or \
+            entry.seq % settings.LOG_SNAPSHOT_INTERVAL == 0:
+        create_snapshot(entry)
     game.log_cursor = entry
-    game.save()
+    game.save(update_fields=['log_cursor'])
+    if settings.LOG_COMPACT_THRESHOLD != None and \
+            entry.seq % settings.LOG_SNAPSHOT_INTERVAL == 0:
+        _auto_compact(game, entry)
     return entry
 
+
+SNAPSHOT_STATE_SQL = '''
+    json_build_object(
+        'game', (SELECT json_build_object('cash', cash) FROM core_game
+            WHERE uuid = {game}),
+        'players', COALESCE((SELECT json_object_agg(uuid,
+                json_build_object('cash', cash))
+            FROM core_player WHERE game_id = {game}), '{{}}'),
+        'companies', COALESCE((SELECT json_object_agg(uuid,
+                json_build_object('cash', cash, 'ipo_shares', ipo_shares,
+                    'bank_shares', bank_shares))
+            FROM core_company WHERE game_id = {game}), '{{}}'),
+        'playershares', COALESCE((SELECT json_object_agg(owner_id, shares)
+            FROM (SELECT owner_id, json_object_agg(company_id, shares)
+                    AS shares
+                FROM core_playershare
+                WHERE game_id = {game} GROUP BY owner_id) AS holdings),
+            '{{}}'),
+        'companyshares', COALESCE((SELECT json_object_agg(owner_id, shares)
+            FROM (SELECT owner_id, json_object_agg(company_id, shares)
+                    AS shares
+                FROM core_companyshare
+                WHERE game_id = {game} GROUP BY owner_id) AS holdings),
+            '{{}}')
+    )::jsonb
+'''
+
+def create_snapshot(entry):
+    """
+    Store the current state of the game of entry as the snapshot of entry.
+    The state is read and stored by the database in a single statement.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO core_logsnapshot '
+            '(entry_id, game_id, seq, state) SELECT %s, %s, %s, ' +
+            SNAPSHOT_STATE_SQL.format(game='%s'),
+            [entry.pk, entry.game_id, entry.seq] + [entry.game_id] * 5)
+
+def state_at(entry):
+    """
+    Return the state of the game of entry as it was at entry, in the same
+    form as a snapshot. The changes of the entries after the nearest
+    snapshot before entry are added to it, which are at most
+    LOG_SNAPSHOT_INTERVAL entries. Raises LogSnapshot.DoesNotExist when the
+    state can't be determined.
+    """
+    snapshot = models.LogSnapshot.objects.filter(game=entry.game_id,
+        seq__lte=entry.seq).order_by('-seq').first()
+    if snapshot == None:
+        raise models.LogSnapshot.DoesNotExist()
+    state = snapshot.state
+    for later in models.LogEntry.objects.filter(game=entry.game_id,
+            seq__gt=snapshot.seq, seq__lte=entry.seq):
+        if later.deltas != None:
+            _add_deltas(state, later.deltas, keep_zero=True)
+        elif later.is_undoable:
+            raise models.LogSnapshot.DoesNotExist()
+    return state
+
+def state_diff(start, end):
+    """
+    Return the net changes to the game between the entries start and end
+    in the same form as deltas, so only what changed is included. The
+    deltas of the entries in between are added up going back from the
+    later entry. Entries without deltas, like adding a player, are covered
+    by their snapshot instead, so the range is only read up to the last of
+    those. Raises LogSnapshot.DoesNotExist when the changes can't be
+    determined.
+    """
+    sign = 1
+    if end.seq < start.seq:
+        start, end, sign = end, start, -1
+    total = {}
+    for entry in models.LogEntry.objects.filter(game=start.game_id,
+            seq__gt=start.seq, seq__lte=end.seq).order_by('-seq').iterator():
+        if entry.deltas == None:
+            _add_deltas(total, state_at(entry))
+            _add_deltas(total, state_at(start), -1)
+            break
+        _add_deltas(total, entry.deltas)
+    if sign < 0:
+        inverse = {}
+        _add_deltas(inverse, total, -1)
+        return inverse
+    return total
+
+
+FORK_SQL = '''
+    WITH fork AS (SELECT %s::text AS salt, %s::jsonb AS state,
+        %s::integer AS seq, %s::text AS pattern)
+    INSERT INTO {table} ({columns}) SELECT {values}
+    FROM {table} AS source, fork WHERE {where}
+'''
+FORK_REMAP_SQL = 'md5(fork.salt || {})::uuid'
+FORK_REMAP_JSON_SQL = '''
+    (SELECT string_agg(CASE WHEN part ~ fork.pattern
+            THEN md5(fork.salt || part)::uuid::text ELSE part END,
+        '"' ORDER BY n)
+    FROM regexp_split_to_table(source.{}::text, '"')
+        WITH ORDINALITY AS parts (part, n))::jsonb
+'''
+FORK_STATE_SQL = 'COALESCE(({}->>{})::integer, source.{})'
+UUID_PATTERN = \
+    '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+
+def fork(game, entry=None):
+    """
+    Create a new game that is a copy of game as it was at its log entry
+    entry, or at its log cursor when no entry is given. The players,
+    companies, holdings and the log up to entry are copied along. Every
+    table is copied with a single INSERT ... SELECT, the primary keys of
+    the copies are derived from the originals so every reference, including
+    those in log payloads, is remapped in the same statement. Raises
+    LogSnapshot.DoesNotExist when the state at entry can't be determined.
+    """
+    if entry == None:
+        entry = get_log_cursor(game)
+    state = None
+    if entry != None and entry.pk != game.log_cursor_id:
+        state = json.dumps(state_at(entry))
+    salt = uuid.uuid4().hex
+    fork_pk = uuid.UUID(hashlib.md5(
+        (salt + str(game.pk)).encode()).hexdigest())
+    params = [salt, state, entry.seq if entry != None else 0, UUID_PATTERN,
+        game.pk]
+
+    log_cursor = '(SELECT {} FROM core_logentry WHERE game_id = source.uuid ' \
+        'AND seq = fork.seq)'.format(FORK_REMAP_SQL.format('uuid::text'))
+    players = "fork.state->'players'->source.uuid::text"
+    companies = "fork.state->'companies'->source.uuid::text"
+    _fork_rows(models.Game, 'source.uuid = %s', params, {
+        'cash': FORK_STATE_SQL.format("fork.state->'game'", "'cash'", 'cash'),
+        'log_cursor_id': log_cursor,
+    })
+    _fork_rows(models.Player, 'source.game_id = %s AND (fork.state IS NULL '
+        'OR {} IS NOT NULL)'.format(players), params, {
+            'cash': FORK_STATE_SQL.format(players, "'cash'", 'cash'),
+        })
+    _fork_rows(models.Company, 'source.game_id = %s AND (fork.state IS NULL '
+        'OR {} IS NOT NULL)'.format(companies), params, {
+            column: FORK_STATE_SQL.format(companies, "'{}'".format(column),
+                column)
+            for column in ('cash', 'ipo_shares', 'bank_shares')})
+    for name, model in (('playershares', models.PlayerShare),
+                        ('companyshares', models.CompanyShare)):
+        holding = "fork.state->'{}'->source.owner_id::text".format(name)
+        _fork_rows(model, 'source.game_id = %s AND (fork.state IS NULL OR '
+            '{}->source.company_id::text IS NOT NULL)'.format(holding),
+            params, {
+                'shares': FORK_STATE_SQL.format(holding,
+                    'source.company_id::text', 'shares'),
+            })
+    _fork_rows(models.LogEntry, 'source.game_id = %s AND '
+        'source.seq <= fork.seq', params, {
+            'payload': FORK_REMAP_JSON_SQL.format('payload'),
+        })
+    _fork_rows(models.LogSnapshot, 'source.game_id = %s AND '
+        'source.seq <= fork.seq', params, {
+            'state': FORK_REMAP_JSON_SQL.format('state'),
+        })
+
+    # Open the ledger of the fork with the cash of every account
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO core_ledgerentry
+                (uuid, game_id, movement, account, amount, time)
+            SELECT md5(%s || a.account::text || legs.sign)::uuid, %s,
+                md5(%s || 'opening' || a.account::text)::uuid,
+                CASE WHEN legs.sign = 1 THEN a.account END,
+                legs.sign * a.cash, %s
+            FROM (
+                SELECT uuid AS account, cash FROM core_game WHERE uuid = %s
+                UNION ALL SELECT uuid, cash FROM core_player
+                    WHERE game_id = %s
+                UNION ALL SELECT uuid, cash FROM core_company
+                    WHERE game_id = %s
+            ) AS a, (VALUES (1), (-1)) AS legs (sign)
+            WHERE a.cash <> 0
+            ''', [salt, fork_pk, salt, timezone.now()] + [fork_pk] * 3)
+    return models.Game.objects.get(pk=fork_pk)
+
+def _fork_rows(model, where, params, overrides):
+    """
+    Copy the rows of model that match where with FORK_SQL. Primary keys
+    and references to rows that are forked as well are remapped, the
+    columns in overrides are set to their SQL expression instead.
+    """
+    forked = (models.Game, models.Player, models.Company, models.LogEntry)
+    columns, values = [], []
+    for field in model._meta.concrete_fields:
+        column = field.column
+        columns.append(connection.ops.quote_name(column))
+        if column in overrides:
+            values.append(overrides[column])
+        elif field.primary_key or field.related_model in forked:
+            values.append(FORK_REMAP_SQL.format(
+                'source.{}::text'.format(column)))
+        else:
+            values.append('source.{}'.format(column))
+    with connection.cursor() as cursor:
+        cursor.execute(FORK_SQL.format(
+            table=connection.ops.quote_name(model._meta.db_table),
+            columns=', '.join(columns), values=', '.join(values),
+            where=where), params)
+
+def current_state(game_id):
+    """Return the stored state of a game in the same form as a snapshot"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT ' + SNAPSHOT_STATE_SQL.format(game='%s'),
+            [game_id] * 5)
+        return cursor.fetchone()[0]
+
+def verify_log(game):
+    """
+    Replay the log of game up to its log cursor in memory and compare the
+    result with the snapshots along the way and with what is stored. The
+    replay starts at the first snapshot and entries are streamed from the
+    database, so any log is replayed in bounded memory. Entries without
+    deltas are replayed by modelling their action. Yields (seq, name, key,
+    column, replayed, stored) for every difference, seq is None for
+    differences with what is stored.
+    """
+    share_counts = dict(game.companies.values_list('uuid', 'share_count'))
+    state = None
+    cursor = game.log.filter(pk=game.log_cursor_id)
+    entries = game.log.filter(seq__lte=Subquery(cursor.values('seq'))) \
+        .select_related('snapshot').order_by('seq')
+    for entry in entries.iterator():
+        try:
+            snapshot = entry.snapshot.state
+        except models.LogSnapshot.DoesNotExist:
+            snapshot = None
+        if entry.deltas == None and not entry.is_undoable:
+            # What entries like adding a player changed is only known from
+            # their snapshot
+            state = snapshot
+            continue
+        if state == None:
+            # Replaying starts at the first snapshot
+            state = snapshot
+            continue
+        deltas = entry.deltas
+        if deltas == None:
+            deltas = _replay_deltas(game, share_counts, state, entry)
+        _add_deltas(state, deltas, keep_zero=True)
+        if snapshot != None:
+            for drift in _state_drift(state, snapshot):
+                yield (entry.seq,) + drift
+    if state != None:
+        for drift in _state_drift(state, current_state(game.pk)):
+            yield (None,) + drift
+
+def _replay_deltas(game, share_counts, state, entry):
+    """
+    Determine the deltas of an entry without stored deltas from its action,
+    dividends are paid to the holders in state.
+    """
+    def player(key):
+        pk = entry.payload.get(key)
+        return models.Player(uuid=uuid.UUID(pk)) if pk else None
+
+    def company(key):
+        pk = entry.payload.get(key)
+        return models.Company(uuid=uuid.UUID(pk)) if pk else None
+
+    def party(role, kind):
+        if kind == 'ipo':
+            return Share.IPO
+        elif kind == 'bank':
+            return Share.BANK
+        elif kind == 'player':
+            return player('player_' + role)
+        return company('company_' + role)
+
+    acting_company = models.Company(uuid=entry.acting_company_id,
+        share_count=share_counts.get(entry.acting_company_id, 10))
+    if entry.action == models.LogEntry.TRANSFER_MONEY:
+        acting = player('acting_player')
+        if acting == None and entry.acting_company_id != None:
+            acting = acting_company
+        return _action_deltas(entry.action, acting=acting,
+            receiving=player('receiving_player') or
+            company('receiving_company'), amount=entry.amount)
+    elif entry.action == models.LogEntry.TRANSFER_SHARE:
+        return _action_deltas(entry.action, company=company('company'),
+            buyer=party('buyer', entry.buyer),
+            source=party('source', entry.source), shares=entry.shares,
+            price=entry.price)
+
+    def dividends(amount):
+        per_share = amount / acting_company.share_count
+        holders = [(models.Player, 'playershares')]
+        if game.treasury_shares_pay:
+            holders.append((models.Company, 'companyshares'))
+        result = {}
+        for model, name in holders:
+            for owner, holdings in state.get(name, {}).items():
+                dividend = per_share * holdings.get(str(acting_company.pk), 0)
+                if dividend != 0:
+                    result[model(uuid=uuid.UUID(owner))] = dividend
+        pools = state['companies'].get(str(acting_company.pk), {})
+        for pays, column in ((game.pool_shares_pay, 'bank_shares'),
+                             (game.ipo_shares_pay, 'ipo_shares')):
+            dividend = per_share * pools.get(column, 0)
+            if pays and dividend != 0:
+                result[acting_company] = \
+                    result.get(acting_company, 0) + dividend
+        return result
+
+    methods = {models.LogEntry.FULL: OperateMethod.FULL,
+        models.LogEntry.HALF: OperateMethod.HALF,
+        models.LogEntry.WITHHOLD: OperateMethod.WITHHOLD}
+    return _action_deltas(entry.action, payments=_operate_payments(
+        acting_company, entry.amount, methods[entry.mode], dividends))
+
+def _state_drift(replayed, stored):
+    """
+    Yield (name, key, column, replayed, stored) for every value that
+    differs between two states.
+    """
+    diff = {}
+    _add_deltas(diff, stored)
+    _add_deltas(diff, replayed, -1)
+    for name, rows in sorted(diff.items()):
+        if name == 'game':
+            rows = {'': rows}
+        for key, row in sorted(rows.items()):
+            for column, amount in sorted(row.items()):
+                if name == 'game':
+                    value = stored['game'].get(column, 0)
+                else:
+                    value = stored.get(name, {}).get(key, {}).get(column, 0)
+                yield name, key, column, value - amount, value
+
+def compact_log(game, entry, keep_text=False):
+    """
+    Fold the log of game up to and including entry into entry, which is
+    turned into a checkpoint that can't be undone. Its snapshot holds the
+    state of the game at that point and, with keep_text, the compressed
+    text of every folded entry. Returns the number of deleted entries.
+    """
+    last = get_log_cursor(game)
+    if last == None or entry.seq > last.seq:
+        raise InvalidCheckpoint()
+    snapshot = models.LogSnapshot.objects.filter(entry=entry).first()
+    if snapshot == None:
+        snapshot = models.LogSnapshot(entry=entry, game=game, seq=entry.seq,
+            state=state_at(entry))
+
+    if keep_text:
+        # Earlier checkpoints pass on the text they kept
+        history = []
+        folded = game.log.filter(seq__lte=entry.seq).select_related(
+            'snapshot').order_by('seq')
+        for folded_entry in folded.iterator():
+            try:
+                kept = folded_entry.snapshot.history_entries()
+            except models.LogSnapshot.DoesNotExist:
+                kept = []
+            if kept:
+                history += kept
+            else:
+                history.append((folded_entry.seq,
+                    folded_entry.time.isoformat(), folded_entry.text))
+        snapshot.history = zlib.compress(json.dumps(history).encode())
+    else:
+        snapshot.history = None
+    snapshot.save()
+
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM core_logsnapshot WHERE game_id = %s AND '
+            'seq < %s', [game.pk, entry.seq])
+        cursor.execute('DELETE FROM core_logentry WHERE game_id = %s AND '
+            'seq < %s', [game.pk, entry.seq])
+        deleted = cursor.rowcount
+    entry.action = None
+    entry.acting_company = None
+    entry.payload = {}
+    entry.text = 'Log compacted'
+    entry.save()
+    return deleted
+
+def _auto_compact(game, entry):
+    """
+    Compact the log of game when it has grown past LOG_COMPACT_THRESHOLD
+    entries, keeping the last LOG_COMPACT_KEEP. The checkpoint is the last
+    snapshot before those, so the state doesn't have to be replayed.
+    """
+    first = game.log.aggregate(first=Min('seq'))['first']
+    if entry.seq - first + 1 <= settings.LOG_COMPACT_THRESHOLD:
+        return
+    checkpoint = models.LogEntry.objects.filter(game=game,
+        snapshot__seq__lte=entry.seq - settings.LOG_COMPACT_KEEP,
+        seq__gt=first).order_by('-seq').first()
+    if checkpoint != None:
+        compact_log(game, checkpoint, settings.LOG_COMPACT_KEEP_TEXT)
+
 def undo(game):
-    entry = game.log_cursor
-    f, kwargs, affected = _action_call(entry)
-    kwargs['amount'] *= -1
-    f(**kwargs)
-
-    if 'game' in affected:
-        affected['game'].refresh_from_db()
-    for name in ('companies', 'players', 'shares'):
-        if name in affected:
-            for i, inst in enumerate(affected[name]):
-                inst.refresh_from_db()
-                affected[name][i] = inst
-
-    game.refresh_from_db()
-    game.log_cursor = game.log.filter(time__lt=entry.time).last()
-    game.save()
+    entry = get_log_cursor(game)
+    # The start of the game, adding players and companies and compacted log
+    # checkpoints can't be undone
+    if entry == None or entry.deltas == None and not entry.is_undoable:
+        raise NotUndoable()
+    entry.game = game
+    if entry.deltas != None:
+        affected = apply_deltas(game, entry.deltas, -1)
+    else:
+        # Entries from before deltas were stored are undone by performing
+        # the opposite action
+        f, kwargs, affected = _action_call(entry)
+        kwargs['amount'] *= -1
+        f(**kwargs)
+
+        if 'shares' in affected:
+            for share in affected['shares']:
+                share.refresh_from_db()
+
+    game.log_cursor = game.log.filter(seq__lt=entry.seq).last()
+    game.save(update_fields=['log_cursor'])
     return affected
 
 def redo(game):
-    entry = game.log.filter(time__gt=game.log_cursor.time).first()
-    f, kwargs, affected = _action_call(entry)
-    f(**kwargs)
+    entry = game.log.filter(seq__gt=Subquery(game.log.filter(
+        pk=game.log_cursor_id).values('seq'))).first()
+    if entry == None or entry.deltas == None and not entry.is_undoable:
+        raise NotUndoable()
+    entry.game = game
+    if entry.deltas != None:
+        affected = apply_deltas(game, entry.deltas)
+    else:
+        f, kwargs, affected = _action_call(entry)
+        f(**kwargs)
 
-    for name in ('companies', 'players', 'shares'):
-        if name in affected:
-            for i, inst in enumerate(affected[name]):
-                inst.refresh_from_db()
-                affected[name][i] = inst
+        if 'shares' in affected:
+            for share in affected['shares']:
+                share.refresh_from_db()
 
-    game.refresh_from_db()
     game.log_cursor = entry
-    game.save()
+    game.save(update_fields=['log_cursor'])
     affected['log'] = entry
     return affected
 
+def jump(game, pk):
+    """
+    Move the log cursor of game to its entry with pk, undoing or redoing
+    every entry in between. The changes of all those entries are added up
+    and applied at once, so jumping over many entries costs about as much
+    as a single undo. Returns the changed instances like undo and redo do.
+    Raises NotUndoable when an entry in between can't be undone or redone,
+    such as adding a player or a compacted log.
+    """
+    target = game.log.get(pk=pk)
+    cursor = get_log_cursor(game)
+    if cursor == None or target.seq > cursor.seq:
+        sign = 1
+        entries = game.log.filter(seq__gt=cursor.seq if cursor else 0,
+            seq__lte=target.seq).order_by('seq')
+    else:
+        sign = -1
+        entries = game.log.filter(seq__gt=target.seq,
+            seq__lte=cursor.seq).order_by('-seq')
+    entries = list(entries)
+    if any(entry.deltas == None and not entry.is_undoable
+            for entry in entries):
+        raise NotUndoable()
+
+    affected = {}
+    deltas = {}
+    for entry in entries:
+        if entry.deltas != None:
+            _add_deltas(deltas, entry.deltas, sign)
+        elif entry.is_undoable:
+            # Entries without deltas must be performed again in order, so
+            # apply everything before them first
+            _merge_affected(affected, apply_deltas(game, deltas))
+            deltas = {}
+            entry.game = game
+            f, kwargs, entry_affected = _action_call(entry)
+            kwargs['amount'] *= sign
+            f(**kwargs)
+            for share in entry_affected.get('shares', []):
+                share.refresh_from_db()
+            _merge_affected(affected, entry_affected)
+    _merge_affected(affected, apply_deltas(game, deltas))
+
+    game.log_cursor = target
+    game.save(update_fields=['log_cursor'])
+    return affected
+
+def _add_deltas(total, deltas, sign=1, keep_zero=False):
+    """
+    Add deltas multiplied by sign to total, dropping what adds up to 0
+    unless keep_zero is set.
+    """
+    for name, rows in deltas.items():
+        if name == 'game':
+            rows, total_rows = {'': rows}, {'': total.setdefault(name, {})}
+        else:
+            total_rows = total.setdefault(name, {})
+        for key, row in rows.items():
+            total_row = total_rows.setdefault(key, {})
+            for column, amount in row.items():
+                total_row[column] = total_row.get(column, 0) + sign * amount
+                if total_row[column] == 0 and not keep_zero:
+                    del total_row[column]
+            if not total_row and not keep_zero:
+                del total_rows[key]
+        if not total.get(name) and not keep_zero:
+            total.pop(name, None)
+
+def _merge_affected(affected, other):
+    """
+    Add the instances in other to affected, instances of rows that are
+    already in affected replace those as they are more recent.
+    """
+    if 'game' in other:
+        affected['game'] = other['game']
+    for name in ('players', 'companies', 'shares'):
+        if name not in other:
+            continue
+        instances = {(type(i), i.pk): i for i in affected.get(name, [])}
+        for instance in other[name]:
+            instances[(type(instance), instance.pk)] = instance
+        affected[name] = list(instances.values())
+
+def _action_deltas(action, **kwargs):
+    """
+    Determine the changes to cash and shares made by an action from the
+    arguments of its log entry. The dividends paid when operating depend on
+    who held shares at the time, so they must be given as payments.
+    Returns None when the changes can not be determined.
+    """
+    deltas = {}
+
+    def add(name, key, column, amount):
+        row = deltas.setdefault(name, {}).setdefault(str(key), {})
+        row[column] = row.get(column, 0) + amount
+
+    def add_cash(entity, amount):
+        if isinstance(entity, models.Player):
+            add('players', entity.pk, 'cash', amount)
+        elif isinstance(entity, models.Company):
+            add('companies', entity.pk, 'cash', amount)
+        else:
+            deltas.setdefault('game', {})
+            deltas['game']['cash'] = deltas['game'].get('cash', 0) + amount
+
+    def add_shares(entity, company, amount):
+        if entity == Share.IPO:
+            add('companies', company.pk, 'ipo_shares', amount)
+        elif entity == Share.BANK:
+            add('companies', company.pk, 'bank_shares', amount)
+        elif isinstance(entity, models.Player):
+            add('playershares', entity.pk, str(company.pk), amount)
+        else:
+            add('companyshares', entity.pk, str(company.pk), amount)
+
+    if action == models.LogEntry.TRANSFER_MONEY:
+        add_cash(kwargs['acting'], -kwargs['amount'])
+        add_cash(kwargs.get('receiving'), kwargs['amount'])
+    elif action == models.LogEntry.TRANSFER_SHARE:
+        add_shares(kwargs['buyer'], kwargs['company'], kwargs['shares'])
+        add_shares(kwargs['source'], kwargs['company'], -kwargs['shares'])
+        add_cash(kwargs['buyer'], -kwargs['price'] * kwargs['shares'])
+        add_cash(kwargs['source'], kwargs['price'] * kwargs['shares'])
+    elif action == models.LogEntry.OPERATE and 'payments' in kwargs:
+        for entity, amount in kwargs['payments'].items():
+            add_cash(entity, _round_cash(amount))
+        add_cash(None, -sum(_round_cash(amount)
+            for amount in kwargs['payments'].values()))
+    else:
+        return None
+
+    # Leave out everything that did not change
+    for name in list(deltas):
+        rows = deltas[name] if name != 'game' else {'': deltas[name]}
+        for key in list(rows):
+            for column in list(rows[key]):
+                if rows[key][column] == 0:
+                    del rows[key][column]
+            if not rows[key]:
+                del rows[key]
+        if not rows:
+            del deltas[name]
+    return deltas
+
+def apply_deltas(game, deltas, sign=1):
+    """
+    Make the changes to cash and shares stored with a log entry again, or
+    revert them when sign is -1. Every table is changed by a single UPDATE,
+    no matter how many of its rows change, and the cash that moves is
+    recorded in the ledger. Returns the changed game,
+    players, companies and shares the same way as undo and redo do.
+    """
+    affected = {}
+    if 'game' in deltas:
+        changed, = _add_to_rows(models.Game, ['uuid'], ['cash'],
+            [[game.pk, sign * deltas['game']['cash']]])
+        game.cash = changed.cash
+        affected['game'] = game
+    tables = (
+        ('players', models.Player, ('cash',)),
+        ('companies', models.Company, ('cash', 'ipo_shares', 'bank_shares')),
+    )
+    for name, model, columns in tables:
+        rows = [[uuid.UUID(pk)] + [sign * row.get(c, 0) for c in columns]
+            for pk, row in deltas.get(name, {}).items()]
+        if rows:
+            affected[name] = _add_to_rows(model, ['uuid'], columns, rows)
+            for instance in affected[name]:
+                if instance.game_id == game.pk:
+                    instance.game = game
+    for name, model in (('playershares', models.PlayerShare),
+                        ('companyshares', models.CompanyShare)):
+        rows = [[uuid.UUID(owner), uuid.UUID(company), sign * amount]
+            for owner, row in deltas.get(name, {}).items()
+            for company, amount in row.items()]
+        if rows:
+            affected.setdefault('shares', []).extend(_add_to_rows(model,
+                ['owner_id', 'company_id'], ['shares'], rows))
+
+    # Record the cash that moved in the ledger
+    legs = [(game, sign * deltas.get('game', {}).get('cash', 0))]
+    for name in ('players', 'companies'):
+        legs += [(instance, sign * deltas[name][str(instance.pk)].get('cash',
+            0)) for instance in affected.get(name, [])]
+    sql, params = _ledger_insert(game.pk, legs)
+    if sql:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+    return affected
+
+def _add_to_rows(model, keys, columns, rows):
+    """
+    Add amounts to columns of many rows of model in a single UPDATE. Each
+    row is a list with the values of the key columns that identify it,
+    followed by the amounts to add to each column. Returns the changed rows
+    as instances of model.
+    """
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    fields = model._meta.concrete_fields
+    sql = 'UPDATE {table} SET {sets} FROM (VALUES {values}) AS v ({names}) ' \
+        'WHERE {where} RETURNING {returning}'.format(table=table,
+            sets=', '.join('{0} = {1}.{0} + v.{0}'.format(quote(c), table)
+                for c in columns),
+            values=', '.join(['({})'.format(
+                ', '.join(['%s'] * (len(keys) + len(columns))))] * len(rows)),
+            names=', '.join(quote(c) for c in keys + list(columns)),
+            where=' AND '.join('{1}.{0} = v.{0}'.format(quote(k), table)
+                for k in keys),
+            returning=', '.join('{}.{}'.format(table, quote(f.column))
+                for f in fields))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [value for row in rows for value in row])
+        return [model.from_db(connection.alias, [f.attname for f in fields],
+            row) for row in cursor.fetchall()]
+
 def _action_call(entry):
     affected = {'players': [], 'companies': []}
     kwargs = {}
@@ -334,10 +1343,16 @@ def _action_call(entry):
                 company=entry.company))
     elif entry.action == models.LogEntry.OPERATE:
         f = operate
+        company = entry.acting_company
+        # Load the holders up front, operate uses the same owner instances
+        # so their balances are up to date afterwards
+        _prefetch_holders(company)
         affected['game'] = entry.game
-        affected['players'] = list(entry.acting_company.player_owners.all())
-        affected['companies'] = list(entry.acting_company.company_owners.all())
-        kwargs['company'] = entry.acting_company
+        affected['players'] = [h.player for h in company.holdings.all()
+            if h.player_id != None]
+        affected['companies'] = [h.owner_company
+            for h in company.holdings.all() if h.owner_company_id != None]
+        kwargs['company'] = company
         kwargs['amount'] = entry.amount
         if entry.mode == models.LogEntry.FULL:
             kwargs['method'] = OperateMethod.FULL
@@ -349,6 +1364,14 @@ def _action_call(entry):
             affected['players'] = []
             affected['companies'] = [entry.acting_company]
 
+    # Let every entity share the game instance of the entry so changes to
+    # the bank's cash end up in affected['game']
+    for name in ('players', 'companies'):
+        for instance in affected[name]:
+            instance.game = entry.game
+    if 'company' in kwargs:
+        kwargs['company'].game = entry.game
+
     # Remove empty items from affected
     if not affected['players']:
         del affected['players']
@@ -1,15 +1,37 @@
 # -*- coding: utf-8 -*-
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import Q, Subquery, prefetch_related_objects
+from django.http import Http404, StreamingHttpResponse
 from django.utils.translation import ugettext as _
 from rest_framework import status
 from rest_framework import viewsets
+from rest_framework.decorators import detail_route
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
+import hashlib
+import json
+import uuid
 
-from . import models, serializers, utils
+from . import models, pagination, serializers, utils
 
 NO_AVAILABLE_SHARES_ERROR = _("Source doesn't have enough shares to sell")
 DIFFERENT_GAME_ERROR = \
     _("The transaction is not between individuals in the same game")
+STALE_LOG_CURSOR_ERROR = \
+    _("The game has changed since you last saw it")
+INVALID_IF_MATCH_ERROR = _("If-Match must contain log cursors")
+INVALID_IDEMPOTENCY_KEY_ERROR = _("Idempotency-Key is too long")
+REUSED_IDEMPOTENCY_KEY_ERROR = \
+    _("Idempotency-Key was already used for a different request")
+STATE_NOT_AVAILABLE_ERROR = \
+    _("The state of the game at this log entry is not available")
+MISSING_ENTRY_ERROR = _("This field is required.")
+UNKNOWN_ENTRY_ERROR = _("There is no such log entry in this game")
+NOT_UNDOABLE_ERROR = _("The log can not be moved past this entry")
 
 class GameViewSet(viewsets.ModelViewSet):
     """
@@ -19,6 +41,28 @@ class GameViewSet(viewsets.ModelViewSet):
     queryset = models.Game.objects.all()
     serializer_class = serializers.GameSerializer
 
+    @detail_route(methods=['post'])
+    def fork(self, request, pk=None):
+        """
+        Create a copy of this game as it was at the log entry given as
+        'entry', or as it is now, to try something without changing it
+        """
+        with transaction.atomic():
+            game = self.get_object()
+            game = models.Game.objects.select_for_update().get(pk=game.pk)
+            entry = None
+            if request.data.get('entry'):
+                try:
+                    entry = game.log.get(pk=request.data['entry'])
+                except (models.LogEntry.DoesNotExist, DjangoValidationError):
+                    raise NotFound(UNKNOWN_ENTRY_ERROR)
+            try:
+                fork = utils.fork(game, entry)
+            except models.LogSnapshot.DoesNotExist:
+                raise NotFound(STATE_NOT_AVAILABLE_ERROR)
+        return Response(self.get_serializer(fork).data,
+            status=status.HTTP_201_CREATED)
+
 
 class PlayerViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.PlayerSerializer
@@ -53,7 +97,7 @@ class PlayerShareViewSet(viewsets.ModelViewSet):
         if player_uuid is not None:
             return models.PlayerShare.objects.filter(owner=player_uuid)
         if game_uuid is not None:
-            return models.PlayerShare.objects.filter(owner__game=game_uuid)
+            return models.PlayerShare.objects.filter(game=game_uuid)
         return models.PlayerShare.objects.all()
 
 
@@ -66,284 +110,504 @@ class CompanyShareViewSet(viewsets.ModelViewSet):
         if company_uuid is not None:
             return models.CompanyShare.objects.filter(owner=company_uuid)
         if game_uuid is not None:
-            return models.CompanyShare.objects.filter(owner__game=game_uuid)
+            return models.CompanyShare.objects.filter(game=game_uuid)
         return models.CompanyShare.objects.all()
 
 
 class LogEntryViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.LogEntrySerializer
+    pagination_class = pagination.LogEntryPagination
 
     def get_queryset(self):
         game_uuid = self.request.query_params.get('game', None)
         if game_uuid is not None:
-            game = models.Game.objects.get(pk=game_uuid)
-            if game.log_cursor == None:
-                return None
-            queryset = game.log.filter(time__lte=game.log_cursor.time)
+            # Everything up to and including the log cursor of the game, the
+            # cursor is looked up by game too so a partitioned log is pruned
+            cursor = models.LogEntry.objects.filter(game=game_uuid,
+                pk=Subquery(models.Game.objects.filter(pk=game_uuid).values(
+                    'log_cursor'))).values('seq')
+            queryset = models.LogEntry.objects.filter(game=game_uuid,
+                seq__lte=Subquery(cursor))
         else:
             queryset = models.LogEntry.objects.all()
         return queryset
 
-
-class TransferMoneyView(APIView):
-    serializer_class = serializers.TransferMoneySerializer
-
+    def list(self, request, *args, **kwargs):
+        stream = request.query_params.get('stream', '').lower()
+        if stream in ('1', 'true', 'yes', 'on'):
+            return self.stream(self.filter_queryset(self.get_queryset()))
+        return super(LogEntryViewSet, self).list(request, *args, **kwargs)
+
+    def stream(self, queryset):
+        """
+        Send the entries as a JSON list that is serialized while they are
+        read from the database with a server-side cursor, so the first byte
+        goes out right away and memory use doesn't grow with the log.
+        """
+        def chunks():
+            yield '['
+            separator = ''
+            for entry in queryset.iterator():
+                yield separator + json.dumps(self.get_serializer(entry).data,
+                    cls=JSONEncoder)
+                separator = ','
+            yield ']'
+        return StreamingHttpResponse(chunks(),
+            content_type='application/json')
+
+    @detail_route()
+    def state(self, request, pk=None):
+        """The cash and shares of everyone in the game at this entry"""
+        entry = self.get_object()
+        try:
+            state = utils.state_at(entry)
+        except models.LogSnapshot.DoesNotExist:
+            raise NotFound(STATE_NOT_AVAILABLE_ERROR)
+        return Response(dict(self.state_response(entry.game_id, state),
+            entry=entry.pk, seq=entry.seq))
+
+    @detail_route()
+    def diff(self, request, pk=None):
+        """
+        What changed in the game between this entry and the entry given as
+        'to', only the changed columns of changed rows are included
+        """
+        entry = self.get_object()
+        to = request.query_params.get('to', None)
+        if to is None:
+            raise ValidationError({'to': [MISSING_ENTRY_ERROR]})
+        try:
+            other = models.LogEntry.objects.get(pk=to, game=entry.game_id)
+        except (models.LogEntry.DoesNotExist, DjangoValidationError):
+            raise NotFound(UNKNOWN_ENTRY_ERROR)
+        try:
+            diff = utils.state_diff(entry, other)
+        except models.LogSnapshot.DoesNotExist:
+            raise NotFound(STATE_NOT_AVAILABLE_ERROR)
+        return Response(dict(self.state_response(entry.game_id, diff),
+            entry=entry.pk, to=other.pk))
+
+    def state_response(self, game_id, state):
+        """Turn the rows of a state or diff into lists of objects"""
+        response = {'game': dict(state['game'], uuid=game_id)
+            if 'game' in state else None}
+        for name in ('players', 'companies'):
+            response[name] = [dict(row, uuid=pk)
+                for pk, row in state.get(name, {}).items()]
+        for name in ('playershares', 'companyshares'):
+            response[name] = [
+                {'owner': owner, 'company': company, 'shares': shares}
+                for owner, holdings in state.get(name, {}).items()
+                for company, shares in holdings.items()]
+        return response
+
+
+class ActionView(APIView):
+    """
+    Base view for actions that change the state of a game. Every POST goes
+    through the same pipeline: the request is validated and the instances
+    it refers to are looked up, after which the action is performed, logged
+    and serialized. Everything after validation happens in one transaction
+    so a failure never leaves cash, shares and the log out of sync.
+
+    Between validating and performing the game of the action is locked, so
+    concurrent actions on one game never interleave. The rows of the game
+    that were loaded while validating are read again once it is locked, so
+    the action never works on state from before the lock. A client can pass
+    the log cursor it expects the game to be at, in the log_cursor field or
+    an If-Match header, in which case the action is refused with a 409
+    Conflict when the game has moved on. The response always carries the
+    current log cursor as its ETag. When the request has an Idempotency-Key
+    header its response and ETag are stored, and retries with the same key
+    get them without performing the action again. A key that is used again
+    for another path or body is refused with a 422 Unprocessable Entity.
+
+    Subclasses implement validate_action(), which returns a dictionary
+    describing the action, including its 'game_id', and must not write
+    anything, and perform_action() which carries out that action and
+    returns the response data. The locked game is added to the action as
+    'game'. Both can raise a ValidationError to reject the action. Rows
+    are loaded through the identity map of the request with get_instance()
+    so every row is fetched once and shares the instance of the game.
+    """
     def get(self, request, format=None):
         return Response()
 
     def post(self, request, format=None):
-        serializer = serializers.TransferMoneySerializer(data=request.data)
-        if serializer.is_valid():
-            # Check if the transfer is valid (within same game)
-            if serializer.source_instance != None \
-                    and serializer.dest_instance != None \
-                    and serializer.source_instance.game != \
-                        serializer.dest_instance.game:  # noqa
-                return Response(
-                    {'non_field_errors': serializers.DIFFERENT_GAME_ERROR},
-                    status=status.HTTP_400_BAD_REQUEST)
-            # Do the transfering
-            utils.transfer_money(serializer.source_instance,
-                serializer.dest_instance, serializer.validated_data['amount'])
-            # Create the log entry
-            if serializer.source_instance != None:
-                game = serializer.source_instance.game
-                source_name = serializer.source_instance.name
-            else:
-                game = serializer.dest_instance.game
-                source_name = 'The bank'
-            if serializer.dest_instance != None:
-                dest_name = serializer.dest_instance.name
-            else:
-                dest_name = 'the bank'
-            entry = utils.create_log_entry(game,
-                models.LogEntry.TRANSFER_MONEY,
-                acting=serializer.source_instance,
-                receiving=serializer.dest_instance,
-                amount=serializer.validated_data['amount'],
-                text='{source} transfered {cash} to {dest}'.format(
-                    source=source_name, dest=dest_name,
-                    cash=serializer.validated_data['amount']))
-
-            # Construct the response, starting with the game
-            context = {'request': self.request}
-            res = {}
-            if (serializer.source_instance == None or
-                    serializer.dest_instance == None):
-                res['game'] = serializers.GameSerializer(game,
-                    context=context).data
-            # Add the log entry
-            res['log'] = serializers.LogEntrySerializer(entry,
-                context=context).data
-            # Next do players
-            players = []
-            if isinstance(serializer.source_instance, models.Player):
-                players.append(serializers.PlayerSerializer(
-                    serializer.source_instance, context=context).data)
-            if isinstance(serializer.dest_instance, models.Player):
-                players.append(serializers.PlayerSerializer(
-                    serializer.dest_instance, context=context).data)
-            if players:
-                res['players'] = players
-            # Finally do companies
-            companies = []
-            if isinstance(serializer.source_instance, models.Company):
-                companies.append(serializers.CompanySerializer(
-                    serializer.source_instance, context=context).data)
-            if isinstance(serializer.dest_instance, models.Company):
-                companies.append(serializers.CompanySerializer(
-                    serializer.dest_instance, context=context).data)
-            if companies:
-                res['companies'] = companies
-
-            return Response(res, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-
-class TransferShareView(APIView):
-    serializer_class = serializers.TransferShareSerializer
+        self.identity_map = utils.IdentityMap()
+        serializer = self.serializer_class(data=request.data, context={
+            'request': request, 'identity_map': self.identity_map})
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                status=status.HTTP_400_BAD_REQUEST)
+        expected = self.expected_log_cursors(serializer)
+        key = self.idempotency_key()
+        request_hash = self.request_hash(serializer)
+        try:
+            with transaction.atomic():
+                action = self.validate_action(serializer)
+                game_id = action['game_id']
+                # Check before locking to turn away retries and stale
+                # clients without waiting, and again after to catch actions
+                # that came in between
+                early = self.early_response(game_id, key, request_hash,
+                    expected)
+                if early != None:
+                    return early
+                game = action['game'] = self.identity_map.lock_game(game_id)
+                early = self.early_response(game_id, key, request_hash,
+                    expected, game)
+                if early != None:
+                    return early
+                response = self.perform_action(action)
+                self.store_response(game_id, key, request_hash, response,
+                    game.log_cursor_id)
+        except ObjectDoesNotExist:
+            raise Http404()
+        return Response(response, status=status.HTTP_200_OK,
+            headers={'ETag': self.etag(game.log_cursor_id)})
+
+    def get_instance(self, model, pk):
+        """Return the instance of model with pk from the identity map."""
+        return self.identity_map.get(model, pk)
+
+    def expected_log_cursors(self, serializer):
+        """
+        Return the log cursors the client expects the game to be at, or
+        None if it accepts any state. The log_cursor field takes precedence
+        over the If-Match header.
+        """
+        if 'log_cursor' in serializer.validated_data:
+            return [serializer.validated_data['log_cursor']]
+        header = self.request.META.get('HTTP_IF_MATCH', '').strip()
+        if not header or header == '*':
+            return None
+        cursors = []
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            tag = tag.strip('"')
+            try:
+                cursors.append(uuid.UUID(tag) if tag else None)
+            except ValueError:
+                raise ValidationError({'log_cursor': [INVALID_IF_MATCH_ERROR]})
+        return cursors
+
+    def early_response(self, game_id, key, request_hash, expected,
+            game=None):
+        """
+        Return the response to send without performing the action, either
+        because it was performed before or because the client is stale.
+        Without the (locked) game only the log cursor is read.
+        """
+        stored = self.stored_response(game_id, key, request_hash)
+        if stored != None:
+            return stored
+        if expected == None:
+            return None
+        if game != None:
+            cursor = game.log_cursor_id
+        else:
+            cursor = models.Game.objects.values_list('log_cursor_id',
+                flat=True).get(pk=game_id)
+        if cursor not in expected:
+            return Response({'detail': STALE_LOG_CURSOR_ERROR,
+                    'log_cursor': cursor},
+                status=status.HTTP_409_CONFLICT,
+                headers={'ETag': self.etag(cursor)})
+        return None
+
+    def idempotency_key(self):
+        key = self.request.META.get('HTTP_IDEMPOTENCY_KEY', '').strip()
+        if len(key) > models.IdempotencyKey._meta.get_field('key').max_length:
+            raise ValidationError(
+                {'non_field_errors': [INVALID_IDEMPOTENCY_KEY_ERROR]})
+        return key or None
+
+    def request_hash(self, serializer):
+        """
+        Hash the path and the validated body of the request, a stored
+        response is only sent for requests with the same hash.
+        """
+        body = json.dumps(serializer.validated_data, cls=JSONEncoder,
+            sort_keys=True)
+        return hashlib.sha256('{}\n{}'.format(self.request.path,
+            body).encode()).hexdigest()
+
+    def stored_response(self, game_id, key, request_hash):
+        """
+        Return the response to an earlier request with the same idempotency
+        key in the game, if it has not expired.
+        """
+        if key == None:
+            return None
+        stored = models.IdempotencyKey.objects.filter(game_id=game_id,
+            key=key, time__gte=utils.idempotency_key_expiry()).first()
+        if stored == None:
+            return None
+        # Keys stored before requests were hashed match any request
+        if stored.request_hash not in ('', request_hash):
+            return Response({'detail': REUSED_IDEMPOTENCY_KEY_ERROR},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        return Response(json.loads(stored.response), status=stored.status,
+            headers={'ETag': self.etag(stored.log_cursor)})
+
+    def store_response(self, game_id, key, request_hash, response,
+            log_cursor):
+        if key == None:
+            return
+        # Make room for the key and expire the other keys of this game
+        models.IdempotencyKey.objects.filter(game_id=game_id).filter(
+            Q(key=key) | Q(time__lt=utils.idempotency_key_expiry())).delete()
+        models.IdempotencyKey.objects.create(game_id=game_id, key=key,
+            request_hash=request_hash, status=status.HTTP_200_OK,
+            response=json.dumps(response, cls=JSONEncoder),
+            log_cursor=log_cursor)
+
+    def etag(self, log_cursor):
+        return '"{}"'.format(log_cursor or '')
+
+    def prefetch_response(self, instances):
+        """
+        Load the relations that the serializers show of the players and
+        companies in instances with one query per relation.
+        """
+        players = [i for i in instances if isinstance(i, models.Player)]
+        companies = [i for i in instances if isinstance(i, models.Company)]
+        prefetch_related_objects(players, 'shares', 'share_set')
+        prefetch_related_objects(companies, 'player_owners', 'share_set')
+
+    def validate_action(self, serializer):  # pragma: no cover
+        raise NotImplementedError()
+
+    def perform_action(self, action):  # pragma: no cover
+        raise NotImplementedError()
+
+    @property
+    def context(self):
+        return {'request': self.request}
+
+
+class TransferMoneyView(ActionView):
+    serializer_class = serializers.TransferMoneySerializer
 
-    def get(self, request, format=None):
-        return Response()
+    def validate_action(self, serializer):
+        source = serializer.source_instance
+        dest = serializer.dest_instance
+        game_id = source.game_id if source != None else dest.game_id
+        return {'source': source, 'dest': dest, 'game_id': game_id,
+            'amount': serializer.validated_data['amount']}
+
+    def perform_action(self, action):
+        source = action['source']
+        dest = action['dest']
+        game = action['game']
+        # Do the transfering
+        utils.transfer_money(source, dest, action['amount'])
+        # Create the log entry
+        source_name = source.name if source != None else 'The bank'
+        dest_name = dest.name if dest != None else 'the bank'
+        entry = utils.create_log_entry(game, models.LogEntry.TRANSFER_MONEY,
+            acting=source, receiving=dest, amount=action['amount'],
+            text='{source} transfered {cash} to {dest}'.format(
+                source=source_name, dest=dest_name, cash=action['amount']))
+
+        # Construct the response, starting with the game
+        self.prefetch_response([source, dest])
+        res = {}
+        if source == None or dest == None:
+            res['game'] = serializers.GameSerializer(game,
+                context=self.context).data
+        # Add the log entry
+        res['log'] = serializers.LogEntrySerializer(entry,
+            context=self.context).data
+        # Next do players
+        players = [serializers.PlayerSerializer(p, context=self.context).data
+            for p in (source, dest) if isinstance(p, models.Player)]
+        if players:
+            res['players'] = players
+        # Finally do companies
+        companies = [serializers.CompanySerializer(c,
+                context=self.context).data
+            for c in (source, dest) if isinstance(c, models.Company)]
+        if companies:
+            res['companies'] = companies
+        return res
+
+
+class TransferShareView(ActionView):
+    serializer_class = serializers.TransferShareSerializer
 
-    def post(self, request, format=None):
-        serializer = self.serializer_class(data=request.data)
-        if serializer.is_valid():
-            # determine buyer
-            buyer_name = None
-            if serializer.validated_data['buyer_type'] == 'ipo':
-                buyer = utils.Share.IPO
-            elif serializer.validated_data['buyer_type'] == 'bank':
-                buyer = utils.Share.BANK
-            elif serializer.validated_data['buyer_type'] == 'player':
-                buyer = models.Player.objects.get(
-                    pk=serializer.validated_data['player_buyer'])
-                buyer_name = buyer.name
-            elif serializer.validated_data['buyer_type'] == 'company':
-                buyer = models.Company.objects.get(
-                    pk=serializer.validated_data['company_buyer'])
-                buyer_name = buyer.name
-
-            # determine source
-            if serializer.validated_data['source_type'] == 'ipo':
-                source = utils.Share.IPO
-                source_name = 'the IPO'
-            elif serializer.validated_data['source_type'] == 'bank':
-                source = utils.Share.BANK
-                source_name = 'the bank'
-            elif serializer.validated_data['source_type'] == 'player':
-                source = models.Player.objects.get(
-                    pk=serializer.validated_data['player_source'])
-                source_name = source.name
-            elif serializer.validated_data['source_type'] == 'company':
-                source = models.Company.objects.get(
-                    pk=serializer.validated_data['company_source'])
-                source_name = source.name
-
-            # determine which company is being bought/sold
-            share = models.Company.objects.get(
-                pk=serializer.validated_data['share'])
-            # Get amount of shares being bought/sold
-            amount = serializer.validated_data['amount']
-            # buy/sell the share
-            price = serializer.validated_data['price']
-            try:
-                utils.buy_share(buyer, share, source, price, amount)
-            except utils.DifferentGameException:
-                return Response({'non_field_errors': [DIFFERENT_GAME_ERROR]},
-                    status=status.HTTP_400_BAD_REQUEST)
-            except utils.InvalidShareTransaction:
-                return Response(
-                    {'non_field_errors': [NO_AVAILABLE_SHARES_ERROR]},
-                    status=status.HTTP_400_BAD_REQUEST)
-
-            # create log entry
-            share.game.refresh_from_db()
-            if amount > 0:
-                log_string = '{buyer} bought {amount} shares {company} ' + \
-                             'from {source} for {price} each'
-            else:
-                log_string = '{buyer} sold {amount} shares {company} ' + \
-                             'to {source} for {price} each'
-            entry = utils.create_log_entry(share.game,
-                models.LogEntry.TRANSFER_SHARE, shares=amount, price=price,
-                buyer=buyer, source=source, company=share,
-                text=log_string.format(buyer=buyer_name, amount=abs(amount),
-                                       company=share.name, source=source_name,
-                                       price=price))
-
-            # Construct the response, starting with the game
-            context = {'request': request}
-            response = {}
-            if (buyer == utils.Share.IPO or buyer == utils.Share.BANK or
-                    source == utils.Share.IPO or source == utils.Share.BANK):
-                response['game'] = serializers.GameSerializer(
-                    share.game, context=context).data
-            # Add the log entry
-            response['log'] = serializers.LogEntrySerializer(entry,
+    def validate_action(self, serializer):
+        data = serializer.validated_data
+        # determine buyer
+        buyer_name = None
+        if data['buyer_type'] == 'ipo':
+            buyer = utils.Share.IPO
+        elif data['buyer_type'] == 'bank':
+            buyer = utils.Share.BANK
+        elif data['buyer_type'] == 'player':
+            buyer = self.get_instance(models.Player, data['player_buyer'])
+            buyer_name = buyer.name
+        elif data['buyer_type'] == 'company':
+            buyer = self.get_instance(models.Company, data['company_buyer'])
+            buyer_name = buyer.name
+
+        # determine source
+        if data['source_type'] == 'ipo':
+            source = utils.Share.IPO
+            source_name = 'the IPO'
+        elif data['source_type'] == 'bank':
+            source = utils.Share.BANK
+            source_name = 'the bank'
+        elif data['source_type'] == 'player':
+            source = self.get_instance(models.Player, data['player_source'])
+            source_name = source.name
+        elif data['source_type'] == 'company':
+            source = self.get_instance(models.Company, data['company_source'])
+            source_name = source.name
+
+        # determine which company is being bought/sold
+        share = self.get_instance(models.Company, data['share'])
+        # Everyone has to be in the same game before anything is changed
+        for entity in (buyer, source):
+            if entity not in utils.Share and entity.game_id != share.game_id:
+                raise ValidationError(
+                    {'non_field_errors': [DIFFERENT_GAME_ERROR]})
+        return {'buyer': buyer, 'buyer_name': buyer_name, 'source': source,
+            'source_name': source_name, 'share': share,
+            'game_id': share.game_id,
+            'amount': data['amount'], 'price': data['price']}
+
+    def perform_action(self, action):
+        buyer = action['buyer']
+        source = action['source']
+        share = action['share']
+        amount = action['amount']
+        price = action['price']
+        # buy/sell the share
+        try:
+            holdings = utils.buy_share(buyer, share, source, price, amount)
+        except utils.DifferentGameException:
+            raise ValidationError({'non_field_errors': [DIFFERENT_GAME_ERROR]})
+        except utils.InvalidShareTransaction:
+            raise ValidationError(
+                {'non_field_errors': [NO_AVAILABLE_SHARES_ERROR]})
+
+        # create log entry
+        if amount > 0:
+            log_string = '{buyer} bought {amount} shares {company} ' + \
+                         'from {source} for {price} each'
+        else:
+            log_string = '{buyer} sold {amount} shares {company} ' + \
+                         'to {source} for {price} each'
+        entry = utils.create_log_entry(action['game'],
+            models.LogEntry.TRANSFER_SHARE, shares=amount, price=price,
+            buyer=buyer, source=source, company=share,
+            text=log_string.format(buyer=action['buyer_name'],
+                                   amount=abs(amount), company=share.name,
+                                   source=action['source_name'], price=price))
+
+        # Construct the response, starting with the game
+        self.prefetch_response([buyer, source, share])
+        context = self.context
+        response = {}
+        if buyer in utils.Share or source in utils.Share:
+            response['game'] = serializers.GameSerializer(action['game'],
                 context=context).data
-            # Add players next
-            players = []
-            if isinstance(buyer, models.Player):
-                players.append(serializers.PlayerSerializer(buyer,
+        # Add the log entry
+        response['log'] = serializers.LogEntrySerializer(entry,
+            context=context).data
+        # Add players next
+        players = []
+        if isinstance(buyer, models.Player):
+            players.append(serializers.PlayerSerializer(buyer,
+                context=context).data)
+        if isinstance(source, models.Player):
+            players.append(serializers.PlayerSerializer(source,
+                context=context).data)
+        if players:
+            response['players'] = players
+        # Add companies
+        companies = [serializers.CompanySerializer(share, context=context)
+                .data]
+        if isinstance(buyer, models.Company) and buyer != share:
+            companies.append(serializers.CompanySerializer(buyer,
+                context=context).data)
+        if isinstance(source, models.Company) and source != share:
+            companies.append(serializers.CompanySerializer(source,
+                context=context).data)
+        response['companies'] = companies
+        # Add the share holding records
+        shares = []
+        for holding in holdings:
+            if isinstance(holding, models.PlayerShare):
+                shares.append(serializers.PlayerShareSerializer(holding,
                     context=context).data)
-            if isinstance(source, models.Player):
-                players.append(serializers.PlayerSerializer(source,
-                    context=context).data)
-            if players:
-                response['players'] = players
-            # Add companies
-            companies = [serializers.CompanySerializer(share, context=context)
-                    .data]
-            if isinstance(buyer, models.Company) and buyer != share:
-                companies.append(serializers.CompanySerializer(buyer,
-                    context=context).data)
-            if isinstance(source, models.Company) and source != share:
-                companies.append(serializers.CompanySerializer(source,
+            else:
+                shares.append(serializers.CompanyShareSerializer(holding,
                     context=context).data)
-            response['companies'] = companies
-            # Add the share holding records
-            shares = []
-            if isinstance(buyer, models.Player):
-                shares.append(serializers.PlayerShareSerializer(
-                    buyer.share_set.get(company=share), context=context).data)
-            if isinstance(buyer, models.Company):
-                shares.append(serializers.CompanyShareSerializer(
-                    buyer.share_set.get(company=share), context=context).data)
-            if isinstance(source, models.Player):
-                shares.append(serializers.PlayerShareSerializer(
-                    source.share_set.get(company=share), context=context).data)
-            if isinstance(source, models.Company):
-                shares.append(serializers.CompanyShareSerializer(
-                    source.share_set.get(company=share), context=context).data)
-            response['shares'] = shares
-
-            return Response(response, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-
-class OperateView(APIView):
-    serializer_class = serializers.OperateSerializer
+        response['shares'] = shares
+        return response
 
-    def get(self, request, format=None):
-        return Response()
 
-    def post(self, request, format=None):
-        serializer = self.serializer_class(data=request.data)
-        if serializer.is_valid():
-            amount = serializer.validated_data['amount']
-            if serializer.validated_data['method'] == 'full':
-                method = utils.OperateMethod.FULL
-                log_text = '{company} operates for {amount} which is paid ' + \
-                           'as dividends'
-            elif serializer.validated_data['method'] == 'half':
-                method = utils.OperateMethod.HALF
-                log_text = '{company} operates for {amount} of which it ' + \
-                           'retains half'
-            elif serializer.validated_data['method'] == 'withhold':
-                method = utils.OperateMethod.WITHHOLD
-                log_text = '{company} withholds {amount}'
-
-            company = models.Company.objects.get(
-                pk=serializer.validated_data['company'])
-            affected = utils.operate(company, amount, method)
-
-            company.refresh_from_db()
-            company.game.refresh_from_db()
-
-            # Create log entry
-            if method == utils.OperateMethod.FULL:
-                mode = models.LogEntry.FULL
-            elif method == utils.OperateMethod.HALF:
-                mode = models.LogEntry.HALF
-            else:
-                mode = models.LogEntry.WITHHOLD
-            entry = utils.create_log_entry(company.game,
-                models.LogEntry.OPERATE, amount=amount, company=company,
-                mode=mode,
-                text=log_text.format(company=company.name, amount=amount))
-
-            # Construct response
-            context = {'request': request}
-            response = {
-                'companies': [],
-                'game': serializers.GameSerializer(company.game,
-                    context=context).data,
-                'log': serializers.LogEntrySerializer(entry,
-                    context=context).data
-            }
-            for entity, amount in affected.items():
-                if isinstance(entity, models.Player):
-                    if 'players' not in response:
-                        response['players'] = []
-                    response['players'].append(serializers.PlayerSerializer(
-                        entity, context=context).data)
-                elif isinstance(entity, models.Company):
-                    response['companies'].append(serializers.CompanySerializer(
-                        entity, context=context).data)
-
-            return Response(response, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+class OperateView(ActionView):
+    serializer_class = serializers.OperateSerializer
+
+    def validate_action(self, serializer):
+        data = serializer.validated_data
+        if data['method'] == 'full':
+            method = utils.OperateMethod.FULL
+            mode = models.LogEntry.FULL
+            log_text = '{company} operates for {amount} which is paid ' + \
+                       'as dividends'
+        elif data['method'] == 'half':
+            method = utils.OperateMethod.HALF
+            mode = models.LogEntry.HALF
+            log_text = '{company} operates for {amount} of which it ' + \
+                       'retains half'
+        elif data['method'] == 'withhold':
+            method = utils.OperateMethod.WITHHOLD
+            mode = models.LogEntry.WITHHOLD
+            log_text = '{company} withholds {amount}'
+        company = self.get_instance(models.Company, data['company'])
+        return {'company': company, 'game_id': company.game_id,
+            'amount': data['amount'], 'method': method, 'mode': mode,
+            'log_text': log_text}
+
+    def perform_action(self, action):
+        company = action['company']
+        amount = action['amount']
+        affected = utils.operate(company, amount, action['method'])
+
+        # Create log entry
+        entry = utils.create_log_entry(action['game'],
+            models.LogEntry.OPERATE, amount=amount, company=company,
+            mode=action['mode'], payments=affected,
+            text=action['log_text'].format(company=company.name,
+                amount=amount))
+
+        # Construct response
+        self.prefetch_response(affected)
+        context = self.context
+        response = {
+            'companies': [],
+            'game': serializers.GameSerializer(action['game'],
+                context=context).data,
+            'log': serializers.LogEntrySerializer(entry,
+                context=context).data
+        }
+        for entity, amount in affected.items():
+            if isinstance(entity, models.Player):
+                if 'players' not in response:
+                    response['players'] = []
+                response['players'].append(serializers.PlayerSerializer(
+                    entity, context=context).data)
+            elif isinstance(entity, models.Company):
+                response['companies'].append(serializers.CompanySerializer(
+                    entity, context=context).data)
+        return response
 
 
 class ColorsView(APIView):
@@ -351,52 +615,72 @@ class ColorsView(APIView):
         return Response(models.Company.COLOR_CODES)
 
 
-class UndoRedoView(APIView):
+class UndoRedoView(ActionView):
     serializer_class = serializers.UndoRedoSerializer
 
-    def get(self, request, format=None):
-        return Response()
-
-    def post(self, request, format=None):
-        serializer = self.serializer_class(data=request.data)
-        if serializer.is_valid():
-            if serializer.validated_data['action'] == 'undo':
-                func = utils.undo
-            else:
-                func = utils.redo
-            affected = func(models.Game.objects.get(
-                pk=serializer.validated_data['game']))
-
-            # Construct response
-            response = {}
-            context = {'request': request}
-            if 'game' in affected:
-                response['game'] = serializers.GameSerializer(affected['game'],
-                    context=context).data
-            if 'players' in affected:
-                response['players'] = []
-                for player in affected['players']:
-                    response['players'].append(serializers.PlayerSerializer(
-                        player, context=context).data)
-            if 'companies' in affected:
-                response['companies'] = []
-                for company in affected['companies']:
-                    response['companies'].append(serializers.CompanySerializer(
-                        company, context=context).data)
-            if 'shares' in affected:
-                response['shares'] = []
-                for share in affected['shares']:
-                    if isinstance(share, models.PlayerShare):
-                        response['shares'].append(
-                            serializers.PlayerShareSerializer(share,
-                                context=context).data)
-                    else:
-                        response['shares'].append(
-                            serializers.CompanyShareSerializer(share,
-                                context=context).data)
-            if 'log' in affected:
-                response['log'] = serializers.LogEntrySerializer(
-                    affected['log'], context=context).data
-
-            return Response(response, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def validate_action(self, serializer):
+        if serializer.validated_data['action'] == 'undo':
+            func = utils.undo
+        else:
+            func = utils.redo
+        return {'game_id': serializer.validated_data['game'], 'func': func}
+
+    def perform_action(self, action):
+        try:
+            affected = action['func'](action['game'])
+        except utils.NotUndoable:
+            raise ValidationError({'non_field_errors': [NOT_UNDOABLE_ERROR]})
+        return self.affected_response(affected)
+
+    def affected_response(self, affected):
+        self.prefetch_response(affected.get('players', []) +
+            affected.get('companies', []))
+        response = {}
+        context = self.context
+        if 'game' in affected:
+            response['game'] = serializers.GameSerializer(affected['game'],
+                context=context).data
+        if 'players' in affected:
+            response['players'] = []
+            for player in affected['players']:
+                response['players'].append(serializers.PlayerSerializer(
+                    player, context=context).data)
+        if 'companies' in affected:
+            response['companies'] = []
+            for company in affected['companies']:
+                response['companies'].append(serializers.CompanySerializer(
+                    company, context=context).data)
+        if 'shares' in affected:
+            response['shares'] = []
+            for share in affected['shares']:
+                if isinstance(share, models.PlayerShare):
+                    response['shares'].append(
+                        serializers.PlayerShareSerializer(share,
+                            context=context).data)
+                else:
+                    response['shares'].append(
+                        serializers.CompanyShareSerializer(share,
+                            context=context).data)
+        if 'log' in affected:
+            response['log'] = serializers.LogEntrySerializer(
+                affected['log'], context=context).data
+        return response
+
+
+class JumpView(UndoRedoView):
+    """
+    Move the log cursor of a game to any of its log entries, undoing or
+    redoing all entries in between at once.
+    """
+    serializer_class = serializers.JumpSerializer
+
+    def validate_action(self, serializer):
+        return {'game_id': serializer.validated_data['game'],
+            'entry': serializer.validated_data['entry']}
+
+    def perform_action(self, action):
+        try:
+            affected = utils.jump(action['game'], action['entry'])
+        except utils.NotUndoable:
+            raise ValidationError({'non_field_errors': [NOT_UNDOABLE_ERROR]})
+        return self.affected_response(affected)
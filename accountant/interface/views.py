@@ -5,6 +5,7 @@ from django.views.generic import FormView, TemplateView
 
 from . import forms
 from core import models
+from core import utils
 
 class MainPageView(FormView):
     template_name = 'interface/index.html'
@@ -42,10 +43,11 @@ class AddPlayerView(FormView):
         return reverse('ui:game', kwargs={'uuid': self.kwargs['uuid']})
 
     def form_valid(self, form):
+        # The starting cash comes from the bank
+        cash = form.instance.cash
+        form.instance.cash = 0
         form.save()
-        # Decrease the bank's cash
-        form.instance.game.cash -= form.instance.cash
-        form.instance.game.save()
+        utils.transfer_money(None, form.instance, cash)
         return super(FormView, self).form_valid(form)
 
     def get_initial(self):
@@ -66,10 +68,11 @@ class AddCompanyView(FormView):
     form_class = forms.AddCompanyForm
 
     def form_valid(self, form):
+        # The starting cash comes from the bank
+        cash = form.instance.cash
+        form.instance.cash = 0
         form.save()
-        # Decrease the bank's cash
-        form.instance.game.cash -= form.instance.cash
-        form.instance.game.save()
+        utils.transfer_money(None, form.instance, cash)
         return super(AddCompanyView, self).form_valid(form)
 
     def get_success_url(self):
@@ -13,7 +13,9 @@ export class LogService {
 	constructor(private http: Http) { }
 
 	getLog(gameUuid: string): Promise<LogEntry[]> {
-		return this.http.get(this.logEntryUrl + '?game=' + gameUuid)
+		// The log is streamed so the server never holds all of it in memory
+		return this.http.get(this.logEntryUrl + '?game=' + gameUuid +
+				'&stream=1')
 			.toPromise()
 			.then(response => {
 				let res = [];